@@ -0,0 +1,68 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Measures how fast ExternalCmd.run_remote() receives large outputs compared to the transport's limit.
+
+The limit is measured by reading the same output on the same pooled connection with a bare paramiko recv() loop. Both
+run against the in-process server in sshd_stub.py, so no real sshd or network is involved.
+
+Usage:
+    python benchmarks/remote_throughput.py [--size MB] [--runs N]
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+
+
+import os, sys, time, argparse, getpass
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sshd_stub
+from robutils.ExternalCmd import ExternalCmd
+from robutils.SSHPool import default_pool
+
+
+def raw_recv(port, command):
+    """Reads command's stdout with a bare recv() loop. Returns (bytes, seconds)."""
+    channel = default_pool.open_session('127.0.0.1', port, getpass.getuser())
+    start = time.time()
+    channel.exec_command(command)
+    size = 0
+    for data in iter(lambda: channel.recv(1048576), b''): size += len(data)
+    channel.recv_exit_status()
+    seconds = time.time() - start
+    default_pool.release(channel)
+    return size, seconds
+
+
+def external_cmd(port, command):
+    """Reads command's stdout with ExternalCmd.run_remote(). Returns (bytes, seconds)."""
+    cmd = ExternalCmd(command)
+    cmd.run_remote('127.0.0.1', getpass.getuser(), port=port)
+    cmd.wait()
+    if cmd.ssh_error: raise SystemExit(cmd.ssh_error)
+    return len(cmd.stdout), cmd.end_time - cmd.start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=200, help='Output size in MB (default 200).')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per method, the best one counts (default 3).')
+    args = parser.parse_args()
+    port = sshd_stub.setup()
+    command = 'head -c {0} /dev/zero'.format(args.size * 1048576)
+    external_cmd(port, 'true') # Authenticate once, both methods share the pooled connection.
+    for name, method in (('raw paramiko recv()', raw_recv), ('ExternalCmd.run_remote()', external_cmd)):
+        size, seconds = min((method(port, command) for i in range(args.runs)), key=lambda r: r[1])
+        print('{0:<26} {1:6d} MB in {2:7.3f}s = {3:8.2f} MB/s'.format(name, size // 1048576, seconds,
+                                                                      size / seconds / 1048576))
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+In-process SSH server (paramiko) used by the benchmarks, so run_remote() can be measured without a real sshd.
+
+The server accepts any user and any public key, and runs exec requests locally with /bin/sh, streaming stdout/stderr
+back over the channel. The sftp subsystem serves the local file system. setup() also creates a throw-away $HOME
+with a known_hosts file and a client key, so ExternalCmd.run_remote() works against it unmodified.
+
+For more information:
+    * import sshd_stub; help(sshd_stub)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+
+
+import os, socket, subprocess, threading, tempfile
+import paramiko # https://github.com/paramiko/paramiko
+
+
+class StubSFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP server interface backed by the local file system, paths are used as they are.
+    """
+    
+    def _error(self, err):
+        return paramiko.SFTPServer.convert_errno(err.errno)
+    
+    def _attributes(self, path, stat_function=os.stat):
+        attr = paramiko.SFTPAttributes.from_stat(stat_function(path))
+        attr.filename = os.path.basename(path)
+        return attr
+    
+    def list_folder(self, path):
+        # lstat() like OpenSSH's sftp-server, symlinks are listed as such.
+        try: return [self._attributes(os.path.join(path, name), os.lstat) for name in os.listdir(path)]
+        except OSError as err: return self._error(err)
+    
+    def stat(self, path):
+        try: return self._attributes(path)
+        except OSError as err: return self._error(err)
+    
+    def lstat(self, path):
+        try: return self._attributes(path, os.lstat)
+        except OSError as err: return self._error(err)
+    
+    def open(self, path, flags, attr):
+        mode = 'rb' if not flags & (os.O_WRONLY | os.O_RDWR) else 'ab' if flags & os.O_APPEND else \
+               'r+b' if not flags & os.O_TRUNC and os.path.exists(path) else 'wb'
+        try:
+            handle = paramiko.SFTPHandle(flags)
+            handle.readfile = handle.writefile = open(path, mode)
+        except (OSError, IOError) as err:
+            return self._error(err)
+        if attr is not None and attr.st_mode is not None: os.chmod(path, attr.st_mode & 0o7777)
+        return handle
+    
+    def remove(self, path):
+        try: os.remove(path)
+        except OSError as err: return self._error(err)
+        return paramiko.SFTP_OK
+    
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None: os.chmod(path, attr.st_mode & 0o7777)
+        except OSError as err:
+            return self._error(err)
+        return paramiko.SFTP_OK
+
+
+class StubServer(paramiko.ServerInterface):
+    """
+    paramiko server interface accepting everyone. Each exec request runs in its own thread.
+    """
+    
+    def get_allowed_auths(self, username):
+        return 'publickey,none'
+    
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+    
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+    
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session': return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+    
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._exec, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    def _exec(self, channel, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        def pump(pipe, send):
+            for data in iter(lambda: os.read(pipe.fileno(), 65536), b''): send(data)
+            return None
+        def pump_stderr():
+            try: pump(process.stderr, channel.sendall_stderr)
+            except (EnvironmentError, paramiko.SSHException): pass # Client went away, handled below.
+            return None
+        def feed():
+            try:
+                for data in iter(lambda: channel.recv(65536), b''): os.write(process.stdin.fileno(), data)
+            except (EnvironmentError, paramiko.SSHException):
+                pass
+            try: process.stdin.close()
+            except EnvironmentError: pass
+            return None
+        threads = [threading.Thread(target=pump_stderr), threading.Thread(target=feed)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            pump(process.stdout, channel.sendall)
+            threads[0].join()
+            channel.send_exit_status(process.wait())
+            channel.shutdown_write() # EOF.
+            channel.close()
+        except (EnvironmentError, paramiko.SSHException):
+            process.kill() # Client went away (e.g. timeout).
+            process.wait()
+        return None
+
+
+def serve(host='127.0.0.1', port=0):
+    """
+    Starts the server in a daemon thread.
+    
+    Returns
+    -------
+    tuple : (port, paramiko.RSAKey host key).
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    def accept():
+        while True:
+            client, address = sock.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Like OpenSSH's sshd.
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTP)
+            transport.start_server(server=StubServer())
+        return None
+    thread = threading.Thread(target=accept, name='sshd_stub')
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1], host_key
+
+
+def setup(host='127.0.0.1'):
+    """
+    Starts the server and points $HOME at a temporary directory whose ~/.ssh has a matching known_hosts entry and a
+    client key, so ExternalCmd.run_remote(host, port=port) authenticates without touching the real ~/.ssh.
+    
+    Returns
+    -------
+    integer : The port the server listens on.
+    """
+    port, host_key = serve(host)
+    home = tempfile.mkdtemp(prefix='robutils-bench-')
+    os.environ['HOME'] = home
+    os.mkdir(os.path.join(home, '.ssh'), 0o700)
+    entry = '{0} {1}\n'.format(host_key.get_name(), host_key.get_base64())
+    with open(os.path.join(home, '.ssh', 'known_hosts'), 'w') as known_hosts:
+        known_hosts.write('{0} {1}'.format(host, entry)) # Used by run_remote()'s pre-flight check.
+        known_hosts.write('[{0}]:{1} {2}'.format(host, port, entry)) # Used by paramiko for non-standard ports.
+    paramiko.RSAKey.generate(2048).write_private_key_file(os.path.join(home, '.ssh', 'id_rsa'))
+    return port
@@ -0,0 +1,228 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Benchmark suite for ExternalCmd, writes its results as JSON so runs can be compared across versions.
+
+Measures, locally:
+    * spawn: spawn-to-completion latency of "true", run one at a time (fork and posix_spawn backends).
+    * concurrency: commands per second with 1 to 64 commands in flight.
+    * output: throughput of reading 1KB to 1GB of stdout.
+    * timeout: how late commands are ended after their timeout, for one that exits on SIGTERM and one which ignores it.
+And against the in-process SSH server of sshd_stub.py (no real sshd or network involved):
+    * remote_handshake: first command on a new connection (TCP + key exchange + auth + exec) and on a pooled one.
+    * remote_output: run_remote() throughput, next to a bare paramiko recv() loop on the same connection.
+
+Every latency is reported as min/median/p90/p99/max in milliseconds, every throughput as the best of the runs. The
+JSON also records the robutils version, git revision, Python and host, see --compare to diff two result files.
+
+Usage:
+    python benchmarks/suite.py [--output FILE] [--runs N] [--quick] [--only NAME [NAME ...]]
+    python benchmarks/suite.py --compare OLD.json NEW.json
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+
+
+import os, sys, time, json, socket, getpass, platform, argparse, subprocess
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sshd_stub
+from remote_throughput import raw_recv, external_cmd
+from robutils.ExternalCmd import ExternalCmd, Supervisor, wait_any, wait_all
+from robutils.SSHPool import SSHPool
+from robutils.version import __version__
+
+
+SIZES = [('1KB', 1024), ('1MB', 1048576), ('100MB', 100 * 1048576), ('1GB', 1024 * 1048576)]
+CONCURRENCY = [1, 4, 16, 64]
+
+
+def stats(seconds):
+    """Summarizes a list of durations (seconds) in milliseconds."""
+    values = sorted(seconds)
+    pick = lambda p: values[int(round(p / 100.0 * (len(values) - 1)))] * 1000
+    return {'runs':len(values), 'min':values[0] * 1000, 'median':pick(50), 'p90':pick(90), 'p99':pick(99),
+            'max':values[-1] * 1000}
+
+
+def bench_spawn(args):
+    """Spawn-to-completion latency of one command at a time."""
+    results = {}
+    for backend, fast_spawn in (('fork', False), ('posix_spawn', True)):
+        durations = []
+        for i in range(args.runs * 20 + 5):
+            cmd = ExternalCmd(['true'])
+            cmd.fast_spawn = fast_spawn
+            start = time.time()
+            cmd.run_local()
+            cmd.wait()
+            if i >= 5: durations.append(time.time() - start) # The first few warm up the page cache and Supervisor.
+        results[backend] = stats(durations)
+    return results
+
+
+def bench_concurrency(args):
+    """Commands per second, keeping a fixed number of commands in flight."""
+    results = {}
+    total = args.runs * 100
+    for concurrency in CONCURRENCY:
+        running = []
+        start = time.time()
+        for i in range(total):
+            if len(running) >= concurrency: running.remove(wait_any(running))
+            cmd = ExternalCmd(['true'])
+            cmd.run_local()
+            running.append(cmd)
+        wait_all(running)
+        seconds = time.time() - start
+        results[str(concurrency)] = {'commands':total, 'seconds':seconds, 'per_second':total / seconds}
+    return results
+
+
+def bench_output(args):
+    """Throughput of reading stdout. Outputs above 64MB are spilled to disk like large outputs should be."""
+    results = {}
+    for name, size in SIZES:
+        if args.quick and size > 100 * 1048576: continue
+        best = None
+        for i in range(args.runs):
+            cmd = ExternalCmd(['head', '-c', str(size), '/dev/zero'], spill_threshold=64 * 1048576)
+            cmd.run_local()
+            cmd.wait()
+            if len(cmd.stdout) != size: raise SystemExit('Expected {0} bytes, got {1}.'.format(size, len(cmd.stdout)))
+            seconds = cmd.end_time - cmd.start_time
+            if best is None or seconds < best: best = seconds
+            if hasattr(cmd.stdout, 'close'): cmd.stdout.close()
+            del cmd
+        results[name] = {'bytes':size, 'seconds':best, 'mb_per_second':size / best / 1048576}
+    return results
+
+
+def bench_timeout(args):
+    """How long after its timeout a command is done, with SIGTERM and with SIGKILL after Supervisor.leniency."""
+    results = {}
+    timeout, leniency = 0.2, Supervisor.leniency
+    Supervisor.leniency = 0.5
+    try:
+        for name, command in (('sigterm', ['sleep', '60']), ('sigkill', ['sh', '-c', "trap '' TERM; sleep 60"])):
+            delays = []
+            for i in range(args.runs * 3):
+                cmd = ExternalCmd(command, timeout=timeout)
+                cmd.run_local()
+                cmd.wait()
+                late = cmd.end_time - cmd.start_time - timeout
+                delays.append(late - Supervisor.leniency if name == 'sigkill' else late)
+            results[name] = stats(delays)
+    finally:
+        Supervisor.leniency = leniency
+    return results
+
+
+def bench_remote_handshake(args, port):
+    """First command on a new connection vs. a command on an already authenticated one."""
+    user = getpass.getuser()
+    cold, warm = [], []
+    for i in range(args.runs * 3):
+        pool = SSHPool()
+        for durations in (cold, warm):
+            cmd = ExternalCmd('true')
+            cmd.run_remote('127.0.0.1', user, port=port, pool=pool)
+            cmd.wait()
+            if cmd.ssh_error: raise SystemExit(cmd.ssh_error)
+            durations.append(cmd.end_time - cmd.start_time)
+        pool.close()
+    return {'new_connection':stats(cold), 'pooled_connection':stats(warm)}
+
+
+def bench_remote_output(args, port):
+    """run_remote() throughput next to the transport's limit (bare recv() loop)."""
+    size = (10 if args.quick else 200) * 1048576
+    command = 'head -c {0} /dev/zero'.format(size)
+    external_cmd(port, 'true') # Authenticate once, both methods share the pooled connection.
+    results = {}
+    for name, method in (('raw_recv', raw_recv), ('run_remote', external_cmd)):
+        received, seconds = min((method(port, command) for i in range(args.runs)), key=lambda r: r[1])
+        results[name] = {'bytes':received, 'seconds':seconds, 'mb_per_second':received / seconds / 1048576}
+    return results
+
+
+BENCHMARKS = [('spawn', bench_spawn), ('concurrency', bench_concurrency), ('output', bench_output),
+              ('timeout', bench_timeout), ('remote_handshake', bench_remote_handshake),
+              ('remote_output', bench_remote_output)]
+
+
+def environment():
+    """What the results depend on, stored next to them."""
+    try:
+        revision = subprocess.Popen(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        revision = revision.communicate()[0].decode('ascii', 'replace').strip() or None
+    except OSError:
+        revision = None
+    return {'robutils':'.'.join(str(v) for v in __version__[:3]), 'revision':revision,
+            'python':platform.python_version(), 'implementation':platform.python_implementation(),
+            'platform':platform.platform(), 'hostname':socket.gethostname(), 'cpus':os.sysconf('SC_NPROCESSORS_ONLN'),
+            'loadavg':os.getloadavg(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def flatten(results, prefix=''):
+    """Yields (dotted name, value) of every number in results."""
+    for key in sorted(results):
+        value = results[key]
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'): yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(old_path, new_path):
+    """Prints every result of two JSON files side by side with the relative change."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    print('{0:<50} {1:>14} {2:>14} {3:>8}'.format('', old['environment']['revision'] or old_path,
+                                                  new['environment']['revision'] or new_path, 'change'))
+    old_values = dict(flatten(old['results']))
+    for name, value in flatten(new['results']):
+        if name not in old_values or name.rsplit('.', 1)[-1] in ('bytes', 'runs', 'commands'): continue
+        change = '{0:+.1%}'.format(float(value) / old_values[name] - 1) if old_values[name] else ''
+        print('{0:<50} {1:>14.3f} {2:>14.3f} {3:>8}'.format(name, old_values[name], value, change))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+    parser.add_argument('--runs', type=int, default=3, help='Repetitions per measurement (default 3).')
+    parser.add_argument('--quick', action='store_true', help='Skip the 1GB output and stream 10MB instead of 200MB.')
+    parser.add_argument('--only', nargs='+', choices=[name for name, function in BENCHMARKS], metavar='NAME',
+                        help='Only run these benchmarks: {0}.'.format(', '.join(n for n, f in BENCHMARKS)))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit.')
+    args = parser.parse_args()
+    if args.compare: return compare(*args.compare)
+    port = None
+    results = {}
+    for name, function in BENCHMARKS:
+        if args.only and name not in args.only: continue
+        sys.stderr.write('{0}...\n'.format(name))
+        if name.startswith('remote_'):
+            if port is None: port = sshd_stub.setup()
+            results[name] = function(args, port)
+        else:
+            results[name] = function(args)
+    report = {'environment':environment(), 'settings':{'runs':args.runs, 'quick':args.quick}, 'results':results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output: output.write(text + '\n')
+    else:
+        print(text)
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Awaitable version of ExternalCmd for asyncio event loops.
+
+AsyncExternalCmd provides the AsyncExternalCmd class, a subclass of robutils.ExternalCmd.ExternalCmd whose run_local()
+and run_remote() return asyncio Futures instead of None. Processes are still watched by the same background thread as
+ExternalCmd (a single thread for all local commands), which hands output and completion over to the event loop with
+call_soon_threadsafe(). So thousands of commands can be awaited on one event loop without a thread per command, with
+exactly the same timeout semantics (SIGTERM, then SIGKILL after Supervisor.leniency seconds).
+
+This module requires asyncio (Python 3.4+) or its Python 2.7 backport trollius <http://pypi.python.org/pypi/trollius>.
+
+For more information:
+    * import robutils.AsyncExternalCmd; help(robutils.AsyncExternalCmd)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['AsyncExternalCmd',]
+
+
+import collections
+try:
+    import asyncio # Python 3.4+
+except ImportError:
+    import trollius as asyncio # http://pypi.python.org/pypi/trollius
+from robutils.ExternalCmd import ExternalCmd, Supervisor
+
+try:
+    StopAsyncIteration
+except NameError:
+    StopAsyncIteration = StopIteration # Python < 3.5, there is no "async for" there anyway.
+
+
+class AsyncExternalCmd(ExternalCmd):
+    """
+    ExternalCmd whose run_local() and run_remote() return an asyncio.Future. The process starts immediately, the future
+    resolves to this instance once code, stdout, stderr and end_time are set (or ssh_error/error if it couldn't start).
+    Cancelling the future terminates the command.
+    
+    Output can be consumed while the command runs with read_chunk() and readline(), which return futures, or by
+    iterating over the instance with "async for" (stdout, line by line). They read from the command's own capture
+    (see ExternalCmd's spill_threshold, tail_bytes and tail_lines) and nothing is buffered while no read is pending,
+    so memory stays bounded whether or not the output is consumed. With tail_bytes or tail_lines, output discarded
+    before it was read is skipped.
+    
+    Examples
+    --------
+    >>> async def main():
+    ...     cmd = AsyncExternalCmd(['ls', '-lahd', '/tmp'])
+    ...     await cmd.run_local()
+    ...     print(cmd.code, cmd.stdout)
+    ...     cmds = [AsyncExternalCmd('uptime') for host in hosts]
+    ...     await asyncio.gather(*[c.run_remote(h) for c, h in zip(cmds, hosts)])
+    ...     tail = AsyncExternalCmd('tail -n 100 -f /var/log/messages', timeout=60)
+    ...     done = tail.run_local()
+    ...     async for line in tail:
+    ...         if b'error' in line: print(line)
+    ...     await done
+    ...
+    >>> asyncio.get_event_loop().run_until_complete(main())
+    >>>
+    """
+    
+    _loop = None # Event loop the futures belong to.
+    _future = None # Future returned by run_local()/run_remote().
+    _offsets = None # Stream name: how far read_chunk()/readline() have read the stream's capture.
+    _partial = None # Stream name: bytearray read from the capture but not returned yet (the start of a line).
+    _waiters = None # Stream name: deque of (Future, 'chunk' or 'line') waiting for output.
+    _eof = False # True once the command is done, set in the event loop's thread.
+    
+    def __init__(self, command, timeout=0, on_output=None, spill_threshold=0, tail_bytes=0, tail_lines=0, stdin=None,
+                 matchers=None, **kwargs):
+        """
+        Creates new class instance for an external command, see ExternalCmd.__init__().
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to execute, see ExternalCmd.
+        timeout : integer, default 0
+            Sets the timeout value in seconds, see ExternalCmd.
+        on_output : function, default None
+            Called as on_output(cmd, stream, data) from the background thread, see ExternalCmd.
+        spill_threshold : integer, default 0
+            Spool output larger than this many bytes to a temporary file, see ExternalCmd.
+        tail_bytes : integer, default 0
+            Only keep the last tail_bytes bytes of each stream, see ExternalCmd.
+        tail_lines : integer, default 0
+            Only keep the last tail_lines lines of each stream, see ExternalCmd.
+        stdin : string, file object or iterable, default None
+            Data streamed to the command's stdin, see ExternalCmd.
+        matchers : list, default None
+            robutils.Matcher.Matcher instances searching the output as it is read, see ExternalCmd.
+        loop : asyncio event loop, default None
+            Keyword only. The loop the returned futures belong to. Uses asyncio.get_event_loop() when the command is
+            started if None.
+        """
+        loop = kwargs.pop('loop', None) # Keyword only, so positional arguments stay the same as ExternalCmd's.
+        if kwargs: raise TypeError("__init__() got an unexpected keyword argument '{0}'".format(sorted(kwargs)[0]))
+        ExternalCmd.__init__(self, command, timeout, on_output, spill_threshold, tail_bytes, tail_lines, stdin,
+                             matchers)
+        self._loop = loop
+        self._offsets = {'stdout':0, 'stderr':0}
+        self._partial = {'stdout':bytearray(), 'stderr':bytearray()}
+        self._waiters = {'stdout':collections.deque(), 'stderr':collections.deque()}
+        self._done_callbacks.append(lambda cmd: self._loop.call_soon_threadsafe(self._resolve))
+        return None
+    
+    def _start(self):
+        """Creates the future resolved by _resolve(). Called before the process starts."""
+        if self._loop is None: self._loop = asyncio.get_event_loop()
+        self._future = asyncio.Future(loop=self._loop)
+        self._future.add_done_callback(self._cancelled)
+        return self._future
+    
+    def _feed(self, stream, data):
+        ExternalCmd._feed(self, stream, data)
+        # Only wake up the event loop for pending reads, the output itself stays in the capture until it's read.
+        if self._waiters[stream]: self._loop.call_soon_threadsafe(self._satisfy, stream)
+        return None
+    
+    def _resolve(self):
+        """Runs in the event loop once the command is done. Output callbacks queued before this one already ran."""
+        self._eof = True
+        for stream in self._waiters: self._satisfy(stream)
+        if not self._future.done(): self._future.set_result(self)
+        return None
+    
+    def _cancelled(self, future):
+        """Terminates the command if the future returned by run_local()/run_remote() is cancelled."""
+        if future.cancelled(): Supervisor.terminate(self)
+        return None
+    
+    def _satisfy(self, stream):
+        """
+        Runs in the event loop. Hands output to waiting read_chunk()/readline() futures in the order they were
+        requested, reading it from the capture only as far as they need.
+        """
+        partial, waiters = self._partial[stream], self._waiters[stream]
+        while waiters:
+            future, kind = waiters[0]
+            if future.done():
+                waiters.popleft() # Cancelled.
+                continue
+            end = partial.find(b'\n') + 1 if kind == 'line' else len(partial)
+            if not end:
+                with self._cond: chunks, self._offsets[stream] = self._output[stream].read(self._offsets[stream])
+                if chunks:
+                    for chunk in chunks: partial.extend(chunk)
+                    continue
+                if not self._eof: return None # Need more output.
+                end = len(partial) # Last line without a newline, or b'' at EOF.
+            waiters.popleft()
+            future.set_result(bytes(partial[:end]))
+            del partial[:end]
+        return None
+    
+    def _wait_for(self, stream, kind):
+        future = asyncio.Future(loop=self._loop or asyncio.get_event_loop())
+        self._waiters[stream].append((future, kind))
+        if self._loop: self._satisfy(stream)
+        return future
+    
+    def run_local(self, *args, **kwargs):
+        """
+        Starts the command locally, takes the same arguments as ExternalCmd.run_local().
+        
+        Returns
+        -------
+        asyncio.Future : Resolves to this instance once the command is done.
+        """
+        future = self._start()
+        try:
+            ExternalCmd.run_local(self, *args, **kwargs)
+        except Exception as err:
+            future.set_exception(err)
+        return future
+    
+    def run_remote(self, *args, **kwargs):
+        """
+        Starts the command on a remote host over SSH, takes the same arguments as ExternalCmd.run_remote().
+        
+        Returns
+        -------
+        asyncio.Future : Resolves to this instance once the command is done. ssh_error is set if it couldn't run.
+        """
+        future = self._start()
+        ExternalCmd.run_remote(self, *args, **kwargs)
+        return future
+    
+    def read_chunk(self, stream='stdout'):
+        """
+        Returns a future resolving to the output produced since the last call (at least one byte), or to b'' once the
+        command is done and everything has been read.
+        
+        Parameters
+        ----------
+        stream : string, default 'stdout'
+            Which stream to read: 'stdout' or 'stderr'.
+        """
+        return self._wait_for(stream, 'chunk')
+    
+    def readline(self, stream='stdout'):
+        """
+        Returns a future resolving to the next line including its newline. The last line may lack the newline, b''
+        means the command is done and everything has been read.
+        
+        Parameters
+        ----------
+        stream : string, default 'stdout'
+            Which stream to read: 'stdout' or 'stderr'.
+        """
+        return self._wait_for(stream, 'line')
+    
+    def __aiter__(self):
+        return self
+    
+    def __anext__(self):
+        """Used by "async for", yields stdout line by line."""
+        future = asyncio.Future(loop=self._loop or asyncio.get_event_loop())
+        def chain(line):
+            if future.done(): return None
+            if line.cancelled(): future.cancel()
+            elif line.result(): future.set_result(line.result())
+            else: future.set_exception(StopAsyncIteration())
+            return None
+        self.readline().add_done_callback(chain)
+        return future
@@ -0,0 +1,306 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Stores the output of external commands in memory or, past a size threshold, in a temporary file.
+
+Capture provides the Capture class used by robutils.ExternalCmd to accumulate stdout and stderr, and the MappedOutput
+class which ExternalCmd.stdout/stderr become when the output was spilled to disk. MappedOutput memory-maps the
+temporary file, so a multi-gigabyte output costs page cache instead of Python heap, and can be sliced, searched and
+iterated line by line without reading all of it.
+
+TailCapture is used instead when only the end of the output matters: it keeps the last N bytes and/or lines in a
+bounded buffer, so memory stays constant no matter how much the command prints.
+
+For more information:
+    * import robutils.Capture; help(robutils.Capture)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd.ExternalCmd.__init__)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Capture', 'TailCapture', 'MappedOutput',]
+
+
+import os, mmap, bisect, tempfile
+
+
+class MappedOutput:
+    """
+    Read-only, memory-mapped view of a command's output which was spilled to a temporary file. The file is already
+    deleted from the file system, its space is freed once close() is called or the instance is garbage collected.
+    
+    Indexing and slicing behave like a byte string and return copies of just the requested range. view() returns a
+    zero-copy buffer instead. Iterating yields lines including their trailing newline.
+    
+    Examples
+    --------
+    >>> cmd = ExternalCmd('tar tvf /backup/everything.tar', spill_threshold=64 * 1024 * 1024)
+    >>> cmd.run_local()
+    >>> len(cmd.stdout)
+    4294967296
+    >>> cmd.stdout[:10]
+    '-rw-r--r--'
+    >>> [line for line in cmd.stdout if b' etc/shadow' in line]
+    ['-rw------- root/root       1024 2012-11-20 04:02 etc/shadow\\n']
+    >>> cmd.stdout.find(b'etc/passwd')
+    18337
+    >>> cmd.stdout.close()
+    >>>
+    """
+    
+    _file = None # The (already unlinked) temporary file.
+    _mmap = None # mmap.mmap of the whole file.
+    
+    def __init__(self, spool):
+        """
+        Maps a file which already holds all of the output.
+        
+        Parameters
+        ----------
+        spool : file object
+            The temporary file, must not be empty. This instance takes ownership of it.
+        """
+        self._file = spool
+        self._mmap = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        return None
+    
+    def __len__(self):
+        return len(self._mmap)
+    
+    def __getitem__(self, index):
+        return self._mmap[index]
+    
+    def __iter__(self):
+        return self.iter_lines()
+    
+    def __contains__(self, sub):
+        return self._mmap.find(sub) != -1
+    
+    def __str__(self):
+        """Copies the whole output into a string. Defeats the purpose for large outputs, use slicing or view()."""
+        return self._mmap[:]
+    
+    def __repr__(self):
+        return '<MappedOutput {0} bytes>'.format(len(self._mmap))
+    
+    def find(self, sub, start=0, end=None):
+        """
+        Returns the lowest index where sub is found, or -1. Same as str.find().
+        
+        Parameters
+        ----------
+        sub : string
+            The bytes to look for.
+        start : integer, default 0
+            Index to start searching at.
+        end : integer, default None
+            Index to stop searching at, the end of the output if None.
+        """
+        return self._mmap.find(sub, start, len(self._mmap) if end is None else end)
+    
+    def view(self, start=0, stop=None):
+        """
+        Returns a zero-copy buffer of the output between start and stop (memoryview on Python 3, buffer on Python 2).
+        It can be written to files or sockets or passed to re.search() without copying the data.
+        
+        Parameters
+        ----------
+        start : integer, default 0
+            First byte of the view.
+        stop : integer, default None
+            End of the view (exclusive), the end of the output if None.
+        """
+        stop = len(self._mmap) if stop is None else min(stop, len(self._mmap))
+        try:
+            return memoryview(self._mmap)[start:stop]
+        except TypeError:
+            return buffer(self._mmap, start, max(stop - start, 0)) # Python 2's mmap has no memoryview support.
+    
+    def iter_lines(self, start=0):
+        """
+        Generator yielding the output line by line, including the trailing newline. The last line is yielded without a
+        newline if the command didn't print one. Only one line is copied out of the mapping at a time.
+        
+        Parameters
+        ----------
+        start : integer, default 0
+            Byte offset to start at.
+        """
+        size = len(self._mmap)
+        while start < size:
+            end = self._mmap.find(b'\n', start) + 1 or size
+            yield self._mmap[start:end]
+            start = end
+    
+    def close(self):
+        """Unmaps and closes the temporary file. Slices and views taken so far must not be used anymore."""
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass # A memoryview from view() is still alive, the mapping is released once it's garbage collected.
+        self._file.close()
+        return None
+
+
+class Capture:
+    """
+    This class isn't designed to be used manually!
+    Accumulates one output stream of an ExternalCmd instance. Chunks are kept in a list until their total size exceeds
+    threshold, then everything is written to an anonymous temporary file and later chunks are appended to it. value()
+    returns a string in the first case and a MappedOutput instance in the second.
+    
+    Instances aren't thread safe, ExternalCmd only uses them while holding its _cond.
+    """
+    
+    threshold = 0 # Spill to disk once more than this many bytes were written. 0 never spills.
+    directory = None # Where temporary files are created, tempfile's default ($TMPDIR, /tmp) if None.
+    size = 0 # Number of bytes written so far.
+    lines = 0 # Number of lines written so far, an unterminated last line counts as one.
+    read_size = 1048576 # Maximum number of bytes read() returns at once from a spilled capture.
+    _chunks = None # Strings written so far, None once spilled.
+    _starts = None # Offset of each chunk in _chunks, for read().
+    _file = None # Temporary file, once spilled.
+    _value = None # Returned by value(), cached.
+    _partial = False # True if the last chunk didn't end with a newline.
+    
+    def __init__(self, threshold=0, directory=None):
+        self.threshold = threshold
+        self.directory = directory
+        self._chunks = []
+        self._starts = []
+        return None
+    
+    def _count(self, data):
+        """Updates size and lines with a new chunk."""
+        self.lines += data.count(b'\n') - self._partial
+        self._partial = not data.endswith(b'\n')
+        self.lines += self._partial
+        self.size += len(data)
+        return None
+    
+    def _write(self, data):
+        fd = self._file.fileno()
+        while data: data = data[os.write(fd, data):]
+        return None
+    
+    def write(self, data):
+        """Appends a chunk of output, spilling everything to disk if it crosses the threshold."""
+        if not data: return None
+        if self._file is None and self.threshold and self.size + len(data) > self.threshold:
+            self._file = tempfile.TemporaryFile(prefix='robutils-', dir=self.directory)
+            for chunk in self._chunks: self._write(chunk)
+            self._chunks = self._starts = None
+        if self._file is None:
+            self._starts.append(self.size)
+            self._chunks.append(data)
+        else:
+            self._write(data)
+        self._count(data)
+        return None
+    
+    def read(self, offset):
+        """
+        Returns the output written after offset (a byte count) as a tuple: a list of strings (empty if there is none
+        yet) and the offset to pass to the next call. Spilled captures return at most read_size bytes per call.
+        """
+        if offset >= self.size: return [], offset
+        if self._file is None:
+            index = bisect.bisect_right(self._starts, offset) - 1
+            chunks = self._chunks[index:]
+            if offset > self._starts[index]: chunks[0] = chunks[0][offset - self._starts[index]:]
+            return chunks, self.size
+        fd = self._file.fileno()
+        os.lseek(fd, offset, os.SEEK_SET)
+        try:
+            data = os.read(fd, min(self.size - offset, self.read_size))
+            return [data], offset + len(data)
+        finally:
+            os.lseek(fd, 0, os.SEEK_END) # write() appends.
+    
+    def peek(self):
+        """
+        Returns everything written so far while output may still be written: a string, or a MappedOutput instance of
+        the temporary file as it is now if it was spilled (with its own file descriptor, close it when done with it).
+        """
+        if self._file is not None: return MappedOutput(os.fdopen(os.dup(self._file.fileno()), 'rb'))
+        if len(self._chunks) > 1: self._chunks, self._starts = [b''.join(self._chunks)], [0] # Join once, not per peek.
+        return self._chunks[0] if self._chunks else b''
+    
+    def value(self):
+        """Returns everything written as a string, or a MappedOutput instance if it was spilled. Call once done."""
+        if self._value is not None: return self._value
+        if self._file is None:
+            self._value = b''.join(self._chunks)
+            self._chunks, self._starts = [self._value], [0] # Don't keep the output in memory twice.
+        else:
+            self._value = MappedOutput(self._file)
+        return self._value
+
+
+class TailCapture(Capture):
+    """
+    This class isn't designed to be used manually!
+    Accumulates one output stream of an ExternalCmd instance but only keeps its end: at most max_bytes bytes and/or
+    max_lines lines, older output is discarded as new output arrives. size and lines still count everything written.
+    value() returns the kept tail as a string.
+    
+    max_bytes bounds memory no matter what, max_lines alone doesn't if the command prints one endless line.
+    """
+    
+    max_bytes = 0 # Keep at most this many bytes, 0 for no byte limit.
+    max_lines = 0 # Keep at most this many lines, 0 for no line limit.
+    _buffer = None # bytearray holding the kept tail.
+    _newlines = 0 # Number of newlines in _buffer.
+    
+    def __init__(self, max_bytes=0, max_lines=0):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self._buffer = bytearray()
+        return None
+    
+    def _drop(self, count):
+        """Discards the first count bytes of the buffer."""
+        self._newlines -= self._buffer.count(b'\n', 0, count)
+        del self._buffer[:count]
+        return None
+    
+    def write(self, data):
+        """Appends a chunk of output and discards whatever falls out of the limits."""
+        if not data: return None
+        self._count(data)
+        if self.max_bytes and len(data) >= self.max_bytes:
+            self._buffer[:] = data[-self.max_bytes:] # Everything kept so far falls out.
+            self._newlines = self._buffer.count(b'\n')
+        else:
+            self._buffer.extend(data)
+            self._newlines += data.count(b'\n')
+            if self.max_bytes and len(self._buffer) > self.max_bytes: self._drop(len(self._buffer) - self.max_bytes)
+        if self.max_lines:
+            excess = self._newlines + (not self._buffer.endswith(b'\n')) - self.max_lines
+            end = 0
+            for i in range(excess): end = self._buffer.find(b'\n', end) + 1
+            if end: self._drop(end)
+        return None
+    
+    def read(self, offset):
+        """
+        Returns the output written after offset (a byte count) as a tuple: a list of strings (empty if there is none
+        yet) and the offset to pass to the next call, which is always size. Output which was already discarded is
+        skipped.
+        """
+        if offset >= self.size: return [], offset
+        return [bytes(self._buffer[max(len(self._buffer) - (self.size - offset), 0):])], self.size
+    
+    def peek(self):
+        """Returns the kept tail as a string, while output may still be written."""
+        return bytes(self._buffer)
+    
+    def value(self):
+        """Returns the kept tail as a string."""
+        return bytes(self._buffer)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+A clock for timeouts and deadlines which never jumps when the system time is changed (NTP, date -s).
+
+time.time() follows the system time, so a deadline computed from it expires early or much too late when the clock is
+stepped. Clock provides monotonic(): time.monotonic() on Python >= 3.3, clock_gettime(CLOCK_MONOTONIC) through ctypes
+on Python 2.7. It has no dependencies on the rest of robutils, so every module can import it.
+
+For more information:
+    * import robutils.Clock; help(robutils.Clock)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['monotonic',]
+
+
+import os, time, ctypes, ctypes.util
+
+
+def _clock():
+    """Returns the function used as monotonic(): time.monotonic() or clock_gettime() through ctypes on Python 2."""
+    if hasattr(time, 'monotonic'): return time.monotonic # Python >= 3.3
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        # clock_gettime() moved from librt to libc in glibc 2.17, librt still has it.
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return time.time # Not Linux, timeouts are thrown off if the system time is changed.
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        spec = timespec()
+        if clock_gettime(1, ctypes.byref(spec)): # CLOCK_MONOTONIC
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+
+# Seconds from a clock which never jumps when the system time is changed (NTP, date -s), only meaningful relative to
+# other calls. Used for every timeout and deadline, start_time and end_time stay wall-clock times.
+monotonic = _clock()
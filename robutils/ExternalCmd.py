@@ -8,11 +8,16 @@
 Executes external commands over SSH (paramiko) or locally (subprocess) with timeouts.
 
 ExternalCmd provides the ExternalCmd class which is a wrapper for paramiko or subprocess. This class automatically
-launches threads which poll the process in the background, populating the instance object with relevant data.
+launches threads which watch the process in the background, populating the instance object with relevant data. All
+commands share a single thread (Supervisor) which reads their output as it arrives and reaps each process the moment it
+exits.
+
+Each local command runs in its own session (process group), so a timeout terminates the whole tree a command started
+(e.g. the commands run by a shell) instead of just its direct child.
 
 As a side note, when this module is imported, the function kill_children_on_exit() is registered with atexit. When the
 main Python thread exits without being killed any external process launched by the parent Python process will be 
-interrupted or killed (if SIGINT doesn't end the process).
+terminated or killed (if SIGTERM doesn't end the process within Supervisor.leniency seconds).
 
 For more information:
     * import robutils.ExternalCmd; help(robutils.ExternalCmd)
@@ -23,12 +28,41 @@ For more information:
 __author__ = 'Robpol86 (http://robpol86.com)'
 __copyright__ = 'Copyright 2012, Robpol86'
 __license__ = 'MIT'
-__all__ = ['ExternalCmd',]
+__all__ = ['ExternalCmd', 'Resources', 'wait_any', 'wait_all', 'as_completed',]
 
 
-import os, time, subprocess, threading, atexit
+import os, sys, time, subprocess, threading, atexit, select, errno, fcntl, heapq, traceback, collections, signal
 import psutil # http://code.google.com/p/psutil/
 import paramiko # https://github.com/paramiko/paramiko
+from robutils.Clock import monotonic
+from robutils.SSHPool import default_pool
+from robutils.KeyCache import default_cache
+from robutils.Capture import Capture, TailCapture
+from robutils.Spawn import SpawnedProcess, DEFAULT_SIGNALS, supported as spawn_supported
+
+
+_groups = set() # Process group IDs (the leaders' pids) of local commands which haven't been reaped yet.
+_groups_lock = threading.Lock()
+
+
+def _signal(function, target, sig):
+    """Calls os.kill() or os.killpg(). Returns False if the process (or every process in the group) is gone."""
+    try:
+        function(target, sig)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def _reap_any():
+    """Reaps every child process which already exited, without blocking."""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR: continue
+            return None # ECHILD, no children left.
+        if not pid: return None
 
 
 @atexit.register
@@ -38,55 +72,427 @@ def kill_children_on_exit():
     When ExternalCmd is imported, this function will automatically be added to atexit. This means when this python
     session exits (without being killed), all remaining processes launched by this python process will be killed and
     reaped (to avoid zombie processes).
+    
+    The process group of every running local command and every other child process get SIGTERM at once. Whatever is
+    left after Supervisor.leniency seconds gets SIGKILL. Children are reaped without blocking as they exit, so this
+    takes at most about leniency seconds no matter how many children are running.
     """
-    for proc in psutil.Process(os.getpid()).get_children():
-        try:
-            proc.kill() # Kill child process.
-        except psutil.NoSuchProcess:
-            pass
-        os.waitpid(proc.pid, os.WUNTRACED) # Avoid zombies.
+    with _groups_lock: groups = set(_groups)
+    proc = psutil.Process(os.getpid())
+    try:
+        children = (proc.children if hasattr(proc, 'children') else proc.get_children)()
+    except psutil.Error:
+        children = []
+    targets = [(os.killpg, pgid) for pgid in groups] + [(os.kill, c.pid) for c in children if c.pid not in groups]
+    targets = [t for t in targets if _signal(t[0], t[1], signal.SIGTERM)]
+    deadline = monotonic() + Supervisor.leniency
+    while targets and monotonic() < deadline:
+        time.sleep(0.01)
+        _reap_any()
+        targets = [t for t in targets if _signal(t[0], t[1], 0)]
+    for function, target in targets: _signal(function, target, signal.SIGKILL)
+    deadline = monotonic() + 0.5
+    while targets and monotonic() < deadline:
+        _reap_any()
+        targets = [t for t in targets if _signal(t[0], t[1], 0)]
+        if targets: time.sleep(0.01)
     return None
 
 
-class PollLocal(threading.Thread):
+def _preexec(limits=None):
+    """
+    Runs in local children (forked by subprocess) before the command is executed. Only used on Python 2 and when limits
+    are given, Python 3's subprocess does the rest itself (start_new_session, restore_signals).
+    """
+    os.setsid() # New session, see kill_children_on_exit().
+    # Python ignores SIGPIPE and Python 2's subprocess doesn't restore it. Without this, "yes" would keep running with
+    # EPIPE errors after "head -1" exited instead of being killed like in a shell. Same as robutils.Spawn.
+    for name in DEFAULT_SIGNALS: signal.signal(getattr(signal, name), signal.SIG_DFL)
+    if limits is not None: limits.apply() # robutils.Limits.Limits given to run_local().
+    return None
+
+
+def _stdin_chunks(source, size):
+    """Generator yielding the stdin given to an ExternalCmd instance as strings, at most size bytes at a time."""
+    encode = lambda data: data.encode('utf-8') if isinstance(data, type(u'')) else data
+    source = encode(source)
+    if isinstance(source, (bytes, bytearray)):
+        for i in range(0, len(source), size): yield bytes(source[i:i + size])
+    elif hasattr(source, 'read'):
+        for data in iter(lambda: source.read(size), b''):
+            if not data: return # Text mode files return u'' at EOF.
+            yield encode(data)
+    else:
+        for data in source:
+            if data: yield encode(data)
+
+
+def _set_nonblocking(fd):
+    """Sets O_NONBLOCK on a file descriptor."""
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return None
+
+
+class Resources:
+    """
+    Resource usage of a local command, see ExternalCmd.resources.
+    
+    Everything except the peak_* members comes from the rusage the kernel returns when the Supervisor reaps the child
+    with os.wait4(), so it is exact and free. It covers the child and every descendant it waited for (e.g. the
+    commands run by a shell), but not descendants still running or reaped by someone else. max_rss can't be lower than
+    what the forked Python process used before exec() replaced it with the command.
+    
+    The peak_* members are only set if run_local() was given a sample_interval. They come from periodically sampling
+    the whole process tree with psutil, which also catches background processes rusage doesn't cover, but can miss
+    short spikes between samples.
+    
+    Examples
+    --------
+    >>> cmd = ExternalCmd('tar czf /tmp/etc.tgz /etc')
+    >>> cmd.run_local(sample_interval=0.5)
+    >>> cmd.wait()
+    True
+    >>> cmd.resources.cpu_time, cmd.resources.max_rss, cmd.resources.block_writes
+    (1.84, 3637248, 20312)
+    >>> cmd.resources.as_dict()['peak_processes']
+    2
+    >>> 
+    """
+    
+    user_time = None # Seconds of CPU time spent in user mode.
+    system_time = None # Seconds of CPU time spent in the kernel.
+    cpu_time = None # user_time + system_time.
+    max_rss = None # Largest resident set size (bytes) of the child or any one of its waited-for descendants.
+    block_reads = None # Number of 512-byte blocks read from disk (page cache hits don't count).
+    block_writes = None # Number of 512-byte blocks written to disk.
+    minor_faults = None # Page faults serviced without I/O.
+    major_faults = None # Page faults which needed I/O.
+    voluntary_switches = None # Context switches because the process waited (usually for I/O).
+    involuntary_switches = None # Context switches because the time slice ran out (CPU contention).
+    sample_interval = 0 # Seconds between psutil samples, 0 disables sampling.
+    samples = 0 # Number of psutil samples taken.
+    peak_rss = None # Highest sampled sum of the resident set sizes (bytes) of the whole process tree.
+    peak_processes = None # Highest sampled number of processes in the tree.
+    
+    def __init__(self, sample_interval=0):
+        self.sample_interval = sample_interval
+        return None
+    
+    def _rusage(self, rusage):
+        """Called by the background thread with the struct returned by os.wait4()."""
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss * 1024 # Linux reports kilobytes.
+        self.block_reads = rusage.ru_inblock
+        self.block_writes = rusage.ru_oublock
+        self.minor_faults = rusage.ru_minflt
+        self.major_faults = rusage.ru_majflt
+        self.voluntary_switches = rusage.ru_nvcsw
+        self.involuntary_switches = rusage.ru_nivcsw
+        return None
+    
+    def _sample(self, pid):
+        """Called by the background thread every sample_interval seconds while the command runs."""
+        try:
+            proc = psutil.Process(pid)
+            tree = [proc] + (proc.children if hasattr(proc, 'children') else proc.get_children)(recursive=True)
+        except psutil.Error:
+            return None # Exited.
+        rss = 0
+        for proc in tree:
+            try: rss += (proc.memory_info if hasattr(proc, 'memory_info') else proc.get_memory_info)().rss
+            except psutil.Error: pass # Exited (or zombie) since get_children().
+        self.samples += 1
+        self.peak_rss = max(self.peak_rss or 0, rss)
+        self.peak_processes = max(self.peak_processes or 0, len(tree))
+        return None
+    
+    def as_dict(self):
+        """Returns every member as a dictionary, e.g. for json.dumps()."""
+        names = ('user_time', 'system_time', 'cpu_time', 'max_rss', 'block_reads', 'block_writes', 'minor_faults',
+                 'major_faults', 'voluntary_switches', 'involuntary_switches', 'samples', 'peak_rss', 'peak_processes')
+        return dict((name, getattr(self, name)) for name in names)
+
+
+class Supervisor(threading.Thread):
     """
     This class isn't designed to be used manually!
-    When a local command is executed, ExternalCmd.run_local() launches an instance of this class in a thread to
-    habitually poll the process until it exits or the main python thread exits. This is responsible for obtaining data
-    from the external command.
+    ExternalCmd.run_local() and PollRemote hand running commands to the single instance of this class. One thread
+    watches the stdout/stderr pipes of every local child and the channel of every remote command at once with
+    select.poll(). A child's pipes are closed by the kernel the moment it exits, so it is reaped as soon as both pipes
+    reach EOF instead of on the next polling interval. paramiko channels provide a file descriptor which becomes
+    readable when data arrives, so remote output is read as soon as it is received and in as few calls as possible.
+    Timeouts are kept in a heap so the thread sleeps exactly until the next one is due. Their deadlines use monotonic(),
+    so changing the system time doesn't fire or delay them, and ExternalCmd.set_timeout() reschedules them at any time.
+    The thread exits when there is nothing left to watch and is started again by the next command.
     """
     
     _interrupt = False # See robutils/__init__.py: signal_threads_shutdown_imminent
-    parent = None # The ExternalCmd class instance object.
+    _instance = None # The running Supervisor, None while idle.
+    _lock = threading.Lock() # Guards _instance and _queue.
+    leniency = 5 # Number of seconds to wait between SIGTERM and SIGKILL.
+    fallback_interval = 0.2 # Seconds between waitpid() checks for children whose pipes are held open by others.
+    chunk_size = 65536 # Maximum bytes read from a pipe at once.
     
-    def __init__(self, parent):
-        super(PollLocal, self).__init__()
-        self.name = 'robutils.ExternalCmd.PollLocal' # Used by signal_threads_shutdown_imminent.
-        self.parent = parent
+    def __init__(self):
+        super(Supervisor, self).__init__()
+        self.name = 'robutils.ExternalCmd.Supervisor' # Used by signal_threads_shutdown_imminent.
+        self.daemon = True
+        self._queue = [] # (method name, args) to run in the thread, e.g. ('_register', (cmd,)).
+        self._running = {} # ExternalCmd instances which haven't been reaped yet: set of their watched fds.
+        self._readers = {} # File descriptor: (ExternalCmd instance, 'stdout', 'stderr' or 'channel').
+        self._timers = [] # Heap of (time, sequence, ExternalCmd instance, action, argument).
+        self._sequence = 0 # Tie breaker for the heap, ExternalCmd instances don't compare.
+        self._poller = select.poll()
+        self._wake_r, self._wake_w = os.pipe() # Self-pipe used to interrupt poll() when work is queued.
+        for fd in (self._wake_r, self._wake_w): _set_nonblocking(fd)
+        self._poller.register(self._wake_r, select.POLLIN)
+        return None
+    
+    @classmethod
+    def _submit(cls, method, *args):
+        """Queues a method call for the thread, starting the thread if it isn't running."""
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            cls._instance._queue.append((method, args))
+            try: os.write(cls._instance._wake_w, b'\0')
+            except OSError: pass # Pipe is full, the thread is going to wake up anyway.
+        return None
+    
+    @classmethod
+    def watch(cls, cmd):
+        """Hands a freshly started ExternalCmd instance (local process or remote channel) to the thread."""
+        cls._submit('_register', cmd)
+        return None
+    
+    @classmethod
+    def terminate(cls, cmd):
+        """Terminates a running command as if it timed out."""
+        if not cmd._done(): cls._submit('_fire', cmd, 'terminate', None, monotonic())
+        return None
+    
+    @classmethod
+    def retime(cls, cmd):
+        """Makes the thread pick up a changed cmd.timeout, see ExternalCmd.set_timeout()."""
+        if not cmd._done(): cls._submit('_retime', cmd)
+        return None
+    
+    def _schedule(self, when, cmd, action, argument=None):
+        self._sequence += 1
+        heapq.heappush(self._timers, (when, self._sequence, cmd, action, argument))
+        return None
+    
+    def _watch_fd(self, cmd, fd, stream):
+        self._readers[fd] = (cmd, stream)
+        self._running[cmd].add(fd)
+        self._poller.register(fd, select.POLLIN | select.POLLPRI)
+        return None
+    
+    def _register(self, cmd):
+        self._running[cmd] = set()
+        if cmd._channel is not None:
+            self._watch_fd(cmd, cmd._channel.fileno(), 'channel')
+        else:
+            for stream in ('stdout', 'stderr'):
+                if getattr(cmd._process, stream) is None: continue # Connected to another process, see Pipeline.
+                fd = getattr(cmd._process, stream).fileno()
+                _set_nonblocking(fd)
+                self._watch_fd(cmd, fd, stream)
+        self._retime(cmd)
+        if cmd.resources is not None and cmd.resources.sample_interval: self._fire(cmd, 'sample', None, monotonic())
+        return None
+    
+    def _retime(self, cmd):
+        """Schedules cmd's timeout. Timers left over from an earlier timeout are ignored when they fire."""
+        if cmd in self._running and cmd.timeout: self._schedule(cmd._started + cmd.timeout, cmd, 'timeout')
+        return None
+    
+    def _read(self, fd):
+        """Reads whatever is available on a pipe or channel. Returns False on EOF."""
+        cmd, stream = self._readers[fd]
+        if stream == 'channel': return self._recv(cmd)
+        while True:
+            try:
+                data = os.read(fd, self.chunk_size)
+            except OSError as err:
+                if err.errno == errno.EINTR: continue
+                if err.errno == errno.EAGAIN: return True
+                data = b'' # Treat any other error like EOF.
+            if not data: return False
+            cmd._feed(stream, data)
+            if len(data) < self.chunk_size: return True # Pipe is most likely empty, go back to poll().
+    
+    def _recv(self, cmd):
+        """Takes everything paramiko has buffered for a channel in one call per stream. Returns False on EOF."""
+        channel = cmd._channel
+        while channel.recv_ready(): cmd._feed('stdout', channel.recv(max(len(channel.in_buffer), 1)))
+        while channel.recv_stderr_ready():
+            cmd._feed('stderr', channel.recv_stderr(max(len(channel.in_stderr_buffer), 1)))
+        return not (channel.eof_received or channel.closed)
+    
+    def _close(self, fd):
+        cmd, stream = self._readers.pop(fd)
+        self._running[cmd].discard(fd)
+        self._poller.unregister(fd)
+        if stream != 'channel': getattr(cmd._process, stream).close() # paramiko owns the channel's fd.
+        return None
+    
+    def _wait4(self, cmd):
+        """Reaps a local child with os.wait4() to collect its rusage. Returns False if it hasn't exited yet."""
+        process = cmd._process
+        if process.returncode is not None: return True
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR: return False
+            if err.errno != errno.ECHILD: raise
+            return process.poll() is not None # Reaped by someone else (e.g. a SIGCHLD handler), no rusage.
+        if not pid: return False
+        # Same as subprocess, which won't wait for it again now that returncode is set.
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        cmd.resources._rusage(rusage)
+        return True
+    
+    def _reap(self, cmd):
+        """Finishes cmd if its process has exited (or the remote side sent its exit status). Returns False if not."""
+        if cmd._channel is not None:
+            if not cmd._channel.exit_status_ready(): return False
+        elif not self._wait4(cmd):
+            return False
+        for fd in list(self._running[cmd]):
+            self._read(fd) # Drain what's left, a grandchild may still be holding the pipe open.
+            self._close(fd)
+        del self._running[cmd]
+        if cmd._channel is not None:
+            code = cmd._channel.recv_exit_status() # -1 if the channel was closed without one.
+            cmd._ssh_pool.release(cmd._channel)
+        else:
+            code = cmd._process.returncode
+            # Stragglers of a command which was terminated had their chance, don't leave them running.
+            if cmd._terminated: _signal(os.killpg, cmd.pid, signal.SIGKILL)
+            with _groups_lock: _groups.discard(cmd.pid)
+        cmd._finish(code)
+        return True
+    
+    def _fire(self, cmd, action, argument, now):
+        if cmd not in self._running: return None # Already reaped, stale timer.
+        if action == 'timeout':
+            # The timeout may have been changed or cancelled since this timer was scheduled.
+            if cmd.timeout and cmd._started + cmd.timeout <= now: self._fire(cmd, 'terminate', None, now)
+        elif action == 'terminate' and cmd._channel is not None:
+            # Remote command timed out. Closing the channel closes its fd, so stop watching it first.
+            for fd in list(self._running[cmd]): self._close(fd)
+            cmd._channel.close() # Close the SSH session (the connection stays in the pool).
+            self._reap(cmd)
+        elif action == 'terminate' and not cmd._terminated:
+            # Process timed out. There's an easy way and a hard way. The choice is yoouuurs.
+            cmd._terminated = True
+            _signal(os.killpg, cmd.pid, signal.SIGTERM) # Easy way, the whole process group.
+            self._schedule(now + self.leniency, cmd, 'kill')
+        elif action == 'kill':
+            _signal(os.killpg, cmd.pid, signal.SIGKILL) # Hard way.
+        elif action == 'sample':
+            cmd.resources._sample(cmd.pid)
+            self._schedule(now + cmd.resources.sample_interval, cmd, 'sample')
+        elif action == 'reap':
+            # Pipes reached EOF (argument is when) but the kernel may not have turned the child into a zombie yet, this
+            # takes a few milliseconds on a busy host. SSH servers may also send the exit status after EOF. Retry every
+            # millisecond until the fallback sweep takes over.
+            if not self._reap(cmd) and now - argument < self.fallback_interval:
+                self._schedule(now + 0.001, cmd, 'reap', argument)
+        return None
+    
+    def _guard(self, cmd, method, *args):
+        """Calls a method handling one command. If it raises, that command is dropped instead of the whole thread."""
+        try:
+            getattr(self, method)(*args)
+        except Exception as err:
+            traceback.print_exc() # One broken command (or a paramiko bug) mustn't hang every other one.
+            self._drop(cmd, str(err) or err.__class__.__name__)
+        return None
+    
+    def _drop(self, cmd, error):
+        """Stops watching a command which can't be handled anymore and aborts it with error."""
+        for fd in list(self._running.pop(cmd, ())):
+            stream = self._readers.pop(fd)[1]
+            self._poller.unregister(fd)
+            if stream != 'channel':
+                try: getattr(cmd._process, stream).close()
+                except EnvironmentError: pass
+        if cmd._channel is not None:
+            try: cmd._ssh_pool.release(cmd._channel)
+            except Exception: traceback.print_exc()
+        elif cmd.pid is not None:
+            _signal(os.killpg, cmd.pid, signal.SIGKILL) # Nothing is watching it anymore, don't leave it running.
+            with _groups_lock: _groups.discard(cmd.pid)
+        if not cmd._done(): cmd._abort(error)
+        return None
+    
+    def _event(self, fd):
+        """Reads a pipe or channel poll() reported as ready."""
+        if self._read(fd): return None
+        # EOF. Once both pipes are closed the process has exited (or closed them itself).
+        cmd = self._readers[fd][0]
+        self._close(fd)
+        if not self._running[cmd]: self._fire(cmd, 'reap', monotonic(), monotonic())
         return None
     
     def run(self):
-        leniency = 5 # Number of seconds to wait between SIGTERM and SIGKILL.
-        sigterm = None # Time SIGTERM was sent.
-        while self.parent._process.poll() == None:
+        try:
+            self._loop()
+        except Exception as err:
+            traceback.print_exc() # The thread can't go on, abort what it was watching instead of hanging it.
+            with self._lock: queue, self._queue = self._queue, []
+            orphans = list(self._running) + [args[0] for method, args in queue if method == '_register']
+            for cmd in orphans:
+                try: self._drop(cmd, str(err) or err.__class__.__name__)
+                except Exception: traceback.print_exc()
+        finally:
+            with self._lock:
+                # The next command starts a new thread, even if this one died or was interrupted.
+                if self.__class__._instance is self: self.__class__._instance = None
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+        return None
+    
+    def _loop(self):
+        next_sweep = monotonic() + self.fallback_interval
+        while True:
+            if self._interrupt: return None
+            with self._lock:
+                queue, self._queue = self._queue, []
+                if not queue and not self._running:
+                    # Nothing left to watch. The next command will start a new thread.
+                    self.__class__._instance = None
+                    return None
+            for method, args in queue: self._guard(args[0], method, *args)
+            # Sleep until the next timer or the fallback sweep, whichever comes first.
+            deadline = min(self._timers[0][0], next_sweep) if self._timers else next_sweep
+            try:
+                events = self._poller.poll(max(deadline - monotonic(), 0) * 1000)
+            except (select.error, IOError, OSError) as err:
+                if err.args[0] != errno.EINTR: raise
+                events = []
             if self._interrupt: return None
-            # Process still running.
-            if self.parent.timeout and time.time() - self.parent.start_time >= self.parent.timeout:
-                # Process timed out. There's an easy way and a hard way. The choice is yoouuurs.
-                if not sigterm:
-                    # Easy way.
-                    sigterm = time.time()
-                    try: self.parent._process.terminate()
+            for fd, event in events:
+                if fd == self._wake_r:
+                    try: os.read(fd, 4096)
                     except OSError: pass
-                elif time.time() - sigterm >= leniency:
-                    # Hard way.
-                    try: self.parent._process.kill()
-                    except OSError: break
-            time.sleep(0.2)
-        # Process is not running anymore.
-        self.parent.code = self.parent._process.returncode
-        self.parent.stdout, self.parent.stderr = self.parent._process.communicate()
-        self.parent.end_time = time.time()
+                elif fd in self._readers:
+                    self._guard(self._readers[fd][0], '_event', fd)
+            now = monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                when, sequence, cmd, action, argument = heapq.heappop(self._timers)
+                self._guard(cmd, '_fire', cmd, action, argument, now)
+            if now >= next_sweep:
+                # A child's pipes don't reach EOF while a grandchild (e.g. "sleep 60 &") holds them open. Remote
+                # commands are only reaped after EOF, their exit status may arrive before the last of their output.
+                for cmd in list(self._running):
+                    if cmd._channel is None or not self._running[cmd]: self._guard(cmd, '_reap', cmd)
+                next_sweep = now + self.fallback_interval
         return None
 
 
@@ -94,8 +500,9 @@ class PollRemote(threading.Thread):
     """
     This class isn't designed to be used manually!
     When a remote command is executed, ExternalCmd.run_remote() launches an instance of this class in a thread to
-    habitually poll the paramiko session until it finishes or the main python thread exits. This is responsible for
-    obtaining data from the SSH session.
+    open a session channel on a pooled connection (see robutils.SSHPool) and execute the command, which may have to
+    authenticate first. The channel is then handed to Supervisor, which reads its output as it arrives and gives the
+    channel back to the pool when the command is done, so this thread exits right away.
     """
     
     _interrupt = False # See robutils/__init__.py: signal_threads_shutdown_imminent
@@ -104,8 +511,9 @@ class PollRemote(threading.Thread):
     user = None # SSH username.
     key = None # SSH private key.
     port = None # SSH port on the remote host.
+    pool = None # robutils.SSHPool.SSHPool instance the channel is borrowed from.
     
-    def __init__(self, parent, host, user, key, port):
+    def __init__(self, parent, host, user, key, port, pool):
         super(PollRemote, self).__init__()
         self.name = 'robutils.ExternalCmd.PollRemote' # Used by signal_threads_shutdown_imminent.
         self.parent = parent
@@ -113,37 +521,104 @@ class PollRemote(threading.Thread):
         self.user = user
         self.key = key
         self.port = port
+        self.pool = pool
         return None
     
     def run(self):
         # Execute the command.
-        self.parent.start_time = time.time()
-        self.parent._process.connect(self.host, self.port, self.user, key_filename=self.key,
-                                     timeout=self.parent.timeout) # Authenticate.
-        self.parent._channel = self.parent._process.get_transport().open_session()
-        self.parent._channel.exec_command(self.parent.command) # Execute the command on the remote host.
-        self.parent.stdout = ''
-        self.parent.stderr = ''
-        while not self.parent._channel.exit_status_ready():
-            if self._interrupt: return None
-            # Read stdout/stderr.
-            if self.parent._channel.recv_ready(): self.parent.stdout += self.parent._channel.recv(4096)
-            if self.parent._channel.recv_stderr_ready(): self.parent.stderr += self.parent._channel.recv_stderr(4096)
-            # Remote process still running.
-            if self.parent.timeout and time.time() - self.parent.start_time >= self.parent.timeout:
-                # Process timed out.
-                self.parent._process.close() # Close the SSH session.
-                break
-            time.sleep(0.2)
-        # Process is not running anymore.
-        self.parent.code = self.parent._channel.recv_exit_status()
-        while self.parent._channel.recv_ready(): self.parent.stdout += self.parent._channel.recv(4096)
-        while self.parent._channel.recv_stderr_ready(): self.parent.stderr += self.parent._channel.recv_stderr(4096)
-        self.parent._process.close()
-        self.parent.end_time = time.time()
+        self.parent.start_time, self.parent._started = time.time(), monotonic()
+        # Any exception is reported in ssh_error, a dead thread would leave the command (and whoever waits) hanging.
+        try:
+            channel = self.pool.open_session(self.host, self.port, self.user, self.key,
+                                             timeout=self.parent.timeout) # Authenticate if needed.
+        except Exception as err:
+            self.parent._abort(str(err) or err.__class__.__name__, ssh=True)
+            return None
+        try:
+            channel.exec_command(self.parent.command) # Execute the command on the remote host.
+        except Exception as err:
+            self.pool.release(channel)
+            self.parent._abort(str(err) or err.__class__.__name__, ssh=True)
+            return None
+        if self._interrupt:
+            self.pool.release(channel)
+            return None
+        self.parent._ssh_pool = self.pool
+        self.parent._channel = channel
+        Supervisor.watch(self.parent) # Read output in the background.
+        if self.parent._stdin is not None:
+            self.parent.stdin_size = 0
+            StdinFeeder(self.parent, channel.sendall, channel.shutdown_write).start()
         return None
 
 
+class StdinFeeder(threading.Thread):
+    """
+    This class isn't designed to be used manually!
+    When an ExternalCmd instance was given stdin, run_local() and PollRemote launch an instance of this class in a
+    thread which writes it to the command's stdin pipe (or sendall()s it on the channel) chunk by chunk, then closes
+    stdin (or shuts down the channel's write side) so the command sees EOF. Writes block while the pipe buffer or the
+    SSH window is full, so the source is only read as fast as the command consumes it and no more than chunk_size bytes
+    of it are held in memory. A slow source (e.g. a generator reading from the network) only holds up its own thread,
+    not Supervisor.
+    """
+    
+    _interrupt = False # See robutils/__init__.py: signal_threads_shutdown_imminent
+    chunk_size = 65536 # Bytes read from a file object at once, and written at once.
+    parent = None # The ExternalCmd class instance object.
+    write = None # Function writing a string to the command's stdin, blocking until it's all written.
+    close = None # Function closing the command's stdin.
+    
+    def __init__(self, parent, write, close):
+        super(StdinFeeder, self).__init__()
+        self.name = 'robutils.ExternalCmd.StdinFeeder' # Used by signal_threads_shutdown_imminent.
+        self.daemon = True
+        self.parent = parent
+        self.write = write
+        self.close = close
+        return None
+    
+    def run(self):
+        chunks = _stdin_chunks(self.parent._stdin, self.chunk_size)
+        try:
+            while not self._interrupt:
+                try:
+                    data = next(chunks)
+                except StopIteration:
+                    break
+                except Exception:
+                    # Broken source. Don't let the command run to completion on truncated input: keep stdin open (no
+                    # EOF) until it's terminated.
+                    traceback.print_exc()
+                    Supervisor.terminate(self.parent)
+                    self.parent.wait()
+                    break
+                try:
+                    self.write(data)
+                except (EnvironmentError, EOFError, paramiko.SSHException):
+                    break # The command exited or closed its stdin (EPIPE), or the channel was closed (timeout).
+                self.parent.stdin_size += len(data)
+        finally:
+            try: self.close()
+            except (EnvironmentError, EOFError, paramiko.SSHException): pass
+        return None
+
+
+def _output_property(stream):
+    """
+    Returns the property behind ExternalCmd.stdout and stderr. The value assigned once the command is done is stored in
+    the instance's __dict__ (Python 2's old-style classes skip the setter and put it there anyway). Until then remote
+    commands return the output read so far, local ones None.
+    """
+    def get(self):
+        if stream in self.__dict__: return self.__dict__[stream]
+        if self._channel is None: return None
+        with self._cond: return self._output[stream].peek()
+    def set(self, value):
+        self.__dict__[stream] = value
+    return property(get, set)
+
+
 class ExternalCmd:
     """
     Main class responsible for handling external commands. Each class instance may only be used once (not designed to
@@ -169,27 +644,84 @@ class ExternalCmd:
     
     >>> cmd = ExternalCmd('echo first && sleep 10 && echo done')
     >>> cmd.run_remote('localhost')
+    >>> time.sleep(1)
     >>> (cmd.code, cmd.stdout)
-    (None, '')
+    (None, 'first\\n')
     >>> time.sleep(10)
     >>> (cmd.code, cmd.stdout)
     (0, 'first\\ndone\\n')
     >>> 
+    
+    >>> cmd = ExternalCmd('for i in 1 2 3; do echo line $i; sleep 1; done')
+    >>> cmd.run_local()
+    >>> for line in cmd.iter_lines(): print line,
+    ... 
+    line 1
+    line 2
+    line 3
+    >>> 
+    
+    >>> cmd = ExternalCmd('sleep 2; echo done')
+    >>> cmd.run_local()
+    >>> cmd.wait(timeout=1)
+    False
+    >>> cmd.wait()
+    True
+    >>> cmds = [ExternalCmd('uptime') for host in hosts]
+    >>> for cmd, host in zip(cmds, hosts): cmd.run_remote(host)
+    >>> wait_all(cmds, timeout=30)
+    True
+    >>> 
+    
+    >>> cmd = ExternalCmd('pg_dump huge_db', spill_threshold=256 * 1024 * 1024)
+    >>> cmd.run_local()
+    >>> cmd.stdout
+    <MappedOutput 4294967296 bytes>
+    >>> cmd.stdout[:26]
+    '--\\n-- PostgreSQL database '
+    >>> 
+    
+    >>> cmd = ExternalCmd('make -j8 world', tail_lines=20, tail_bytes=8192)
+    >>> cmd.run_local()
+    >>> (cmd.code, cmd.stdout_lines, cmd.stdout_size)
+    (2, 1048576, 73400320)
+    >>> print cmd.stderr,
+    make[1]: *** [world] Error 2
+    >>> 
     """
     
     command = None # Command to run. If a list: shell=False; if a string: shell=True
     timeout = None # Terminate process if timeout value is reached.
     code = None # Command's exit code.
-    stdout = None
-    stderr = None
+    stdout = _output_property('stdout') # String, or robutils.Capture.MappedOutput if larger than spill_threshold.
+    stderr = _output_property('stderr') # Same as stdout. Both hold the output so far while remote commands run.
+    stdout_size = None # Total number of bytes the command printed to stdout, even if only the tail was kept.
+    stdout_lines = None # Total number of lines printed to stdout, an unterminated last line counts as one.
+    stderr_size = None
+    stderr_lines = None
+    stdin_size = None # Number of bytes written to the command's stdin so far, None if it wasn't given any.
     pid = None
     start_time = None
     end_time = None
-    _process = None # The subprocess/paramiko object.
+    _started = None # monotonic() at start_time, the timeout counts from it.
+    resources = None # Resources instance with the CPU, memory and I/O used (local commands only), set when done.
+    fast_spawn = False # Start local commands with posix_spawn() instead of fork(), see robutils.Spawn.
+    _process = None # The subprocess object, or robutils.Spawn.SpawnedProcess (local commands only).
+    _terminated = False # True once the process group was sent SIGTERM because of the timeout or terminate().
     _channel = None # The paramiko channel object.
+    _ssh_pool = None # robutils.SSHPool.SSHPool instance _channel was borrowed from.
+    _stdin = None # The stdin given to __init__(), see StdinFeeder.
+    _output = None # stdout/stderr read so far: {'stdout':Capture(), 'stderr':Capture()} (or TailCapture instances)
+    _cond = None # threading.Condition notified whenever output is read or the command finishes.
+    on_output = None # Callback function, see __init__().
+    matchers = None # robutils.Matcher.Matcher instances searching the output as it is read, see __init__().
+    stopped_by = None # The Matcher which terminated the command once it found its matches, None otherwise.
+    _done_callbacks = None # Functions called with this instance once it is done (see robutils.ExternalCmdPool).
     ssh_error = None # Error string related to SSH (before command is executed).
+    error = None # Error string if the command couldn't be started in the background (e.g. by ExternalCmdPool).
     
-    def __init__(self, command, timeout=0):
+    def __init__(self, command, timeout=0, on_output=None, spill_threshold=0, tail_bytes=0, tail_lines=0, stdin=None,
+                 matchers=None):
         """
         Creates new class instance for an external command. This is where the command itself and the optional timeout
         value (in seconds) is given.
@@ -203,34 +735,234 @@ class ExternalCmd:
         timeout : integer, default 0
             Sets the timeout value in seconds. If > 0, the external command will be terminated or killed if it runs
             longer than the timeout period.
+        on_output : function, default None
+            Called as on_output(cmd, stream, data) with every chunk of output as soon as it is read, where stream is
+            'stdout' or 'stderr'. Runs in the background thread, so it should return quickly.
+        spill_threshold : integer, default 0
+            If > 0, a stream's output is moved to a temporary file once it grows past this many bytes, and stdout or
+            stderr become a robutils.Capture.MappedOutput instance (memory-mapped, sliceable, iterable by line)
+            instead of a string. Outputs below the threshold are plain strings. 0 keeps everything in memory.
+        tail_bytes : integer, default 0
+            If > 0, only the last tail_bytes bytes of stdout and stderr are kept, older output is discarded as new
+            output arrives. Memory used per command stays constant. stdout_size/stdout_lines (and stderr_*) still
+            count everything printed. Overrides spill_threshold.
+        tail_lines : integer, default 0
+            If > 0, only the last tail_lines lines of stdout and stderr are kept. Can be combined with tail_bytes,
+            whichever limit is hit first applies.
+        stdin : string, file object or iterable, default None
+            Data written to the command's stdin while it runs, then stdin is closed. A string, a file object opened
+            for reading (read in chunks), or an iterable/generator of strings. Unicode is encoded as UTF-8. It is
+            streamed with backpressure, so inputs larger than memory work with file objects and generators, see
+            StdinFeeder. If the command exits without reading all of it, the rest is dropped (like in a shell). If
+            None, local commands inherit this process' stdin and remote commands get none.
+        matchers : list, default None
+            robutils.Matcher.Matcher instances searching stdout/stderr as it is read, which can terminate the command
+            once they found what they're looking for. Each one belongs to this command only.
         """
         self.command = command
         if timeout: self.timeout = timeout
+        self.on_output = on_output
+        self._stdin = stdin
+        if tail_bytes or tail_lines:
+            self._output = {'stdout':TailCapture(tail_bytes, tail_lines), 'stderr':TailCapture(tail_bytes, tail_lines)}
+        else:
+            self._output = {'stdout':Capture(spill_threshold), 'stderr':Capture(spill_threshold)}
+        self._cond = threading.Condition()
+        self._done_callbacks = []
+        self.matchers = list(matchers or [])
+        for matcher in self.matchers: matcher._attach(self)
+        return None
+    
+    def _finish_matchers(self):
+        for matcher in self.matchers:
+            try: matcher._finish(self)
+            except Exception: traceback.print_exc()
+        return None
+    
+    def _done(self):
+        """True once the command finished or failed to start."""
+        return self.end_time is not None or self.ssh_error is not None or self.error is not None
+    
+    def _run_done_callbacks(self):
+        for callback in list(self._done_callbacks): # as_completed() removes its callback from other threads.
+            try: callback(self)
+            except Exception: traceback.print_exc() # Don't let a broken callback take down the background thread.
+        return None
+    
+    def _feed(self, stream, data):
+        """Called by the background thread with every chunk of output read from the process."""
+        with self._cond:
+            self._output[stream].write(data)
+            self._cond.notify_all()
+        if self.on_output:
+            try: self.on_output(self, stream, data)
+            except Exception: traceback.print_exc() # Don't let a broken callback take down the background thread.
+        for matcher in self.matchers:
+            try: matcher._feed(self, stream, data)
+            except Exception: traceback.print_exc() # E.g. a broken predicate function.
+        return None
+    
+    def _finish(self, code):
+        """Called by the background thread once the process has exited and its output has been drained."""
+        self._finish_matchers() # Before wait() returns, so the last line of output has been searched.
+        with self._cond:
+            self.stdout = self._output['stdout'].value()
+            self.stderr = self._output['stderr'].value()
+            self.stdout_size, self.stdout_lines = self._output['stdout'].size, self._output['stdout'].lines
+            self.stderr_size, self.stderr_lines = self._output['stderr'].size, self._output['stderr'].lines
+            self.code = code
+            self.end_time = time.time()
+            self._cond.notify_all()
+        self._run_done_callbacks()
+        return None
+    
+    def _abort(self, error, ssh=False):
+        """Called when the command couldn't be started. Sets ssh_error (or error) and wakes up anyone waiting."""
+        self._finish_matchers()
+        with self._cond:
+            if ssh: self.ssh_error = error
+            else: self.error = error
+            self._cond.notify_all()
+        self._run_done_callbacks()
+        return None
+    
+    def wait(self, timeout=None):
+        """
+        Blocks until the command is done (code, stdout, stderr and end_time are set) or couldn't be started (ssh_error
+        or error is set). Wakes up as soon as the background thread records it.
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Maximum number of seconds to wait. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if the command is done, False if timeout was reached first.
+        """
+        with self._cond:
+            if timeout is None:
+                while not self._done(): self._cond.wait()
+            else:
+                deadline = monotonic() + timeout
+                while not self._done() and monotonic() < deadline: self._cond.wait(deadline - monotonic())
+            return self._done()
+    
+    def set_timeout(self, timeout):
+        """
+        Changes or cancels the timeout, before or while the command runs. Takes effect right away: the background
+        thread is woken up to reschedule it.
+        
+        Parameters
+        ----------
+        timeout : float
+            The new timeout in seconds, counted from when the command started (not from now) like the one given to
+            __init__(). If it already elapsed the command is terminated right away. 0 or None cancels the timeout
+            (a command which was already sent SIGTERM is still killed after Supervisor.leniency seconds).
+        """
+        self.timeout = timeout or None
+        if self._started is not None: Supervisor.retime(self)
         return None
     
-    def run_local(self, cwd=None):
+    def iter_chunks(self, stream='stdout'):
+        """
+        Generator yielding output as it is produced, chunk by chunk, until the command finishes. Output read before
+        this is called is yielded first. Chunks may split lines, see iter_lines(). With tail_bytes or tail_lines, output
+        discarded before the generator got to it is skipped.
+        
+        Parameters
+        ----------
+        stream : string, default 'stdout'
+            Which stream to follow: 'stdout' or 'stderr'.
+        """
+        offset = 0
+        while True:
+            with self._cond:
+                while self._output[stream].size <= offset and not self._done(): self._cond.wait()
+                chunks, offset = self._output[stream].read(offset) # Skips past output a TailCapture discarded.
+                done = self._done()
+            for chunk in chunks: yield chunk
+            if done and not chunks: return
+    
+    def iter_lines(self, stream='stdout'):
         """
-        Executes the command in the class instance locally. It is the developer's job to poll this class instance's
-        code or end_time members to determine when the process ends (the class will take care of polling the process
-        directly every 0.2 seconds).
+        Generator yielding output line by line (including the trailing newline) as it is produced, until the command
+        finishes. The last line is yielded without a newline if the command didn't print one.
+        
+        Parameters
+        ----------
+        stream : string, default 'stdout'
+            Which stream to follow: 'stdout' or 'stderr'.
+        """
+        partial = b''
+        for chunk in self.iter_chunks(stream):
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for line in lines: yield line + b'\n'
+        if partial: yield partial
+    
+    def run_local(self, cwd=None, sample_interval=0, env=None, limits=None):
+        """
+        Executes the command in the class instance locally. The command runs in the background, use wait() (or the
+        module's wait_any(), wait_all() and as_completed() functions) to block until it ends. The class takes care of
+        reaping the process as soon as it exits, see Supervisor.
+        
+        The process is started by subprocess. Python 2 forks, which takes longer the more memory this Python process
+        uses (so does Python 3 when limits are given). Set fast_spawn to True (on the class or the instance) to start
+        it with posix_spawn() instead, see robutils.Spawn. subprocess is still used where posix_spawn() isn't
+        available, and when limits are given (they are applied between fork() and exec()).
         
         Parameters
         ----------
         cwd : string, default None
             Use this as the current working directory if set.
+        sample_interval : float, default 0
+            If > 0, the process tree's memory is sampled with psutil every sample_interval seconds while the command
+            runs, see Resources.peak_rss. CPU time, max RSS and block I/O are always recorded in resources.
+        env : dict, default None
+            Environment variables of the command. Replaces (doesn't extend) this process' environment if set.
+        limits : robutils.Limits.Limits, default None
+            rlimits, niceness, I/O priority and CPU affinity applied to the command before it executes.
         """
         if cwd: os.listdir(cwd) # Check if directory exists. No need to write my own logic for this.
+        self._spawn(cwd, env, sample_interval, limits=limits)
+        return None
+    
+    def _spawn(self, cwd, env, sample_interval, stdin=None, stdout=subprocess.PIPE, limits=None):
+        """
+        Starts the local process and hands it to Supervisor. stdin/stdout are passed to Popen as they are, stdin
+        defaults to a pipe fed by StdinFeeder if this instance was given stdin.
+        """
+        if stdin is None and self._stdin is not None: stdin = subprocess.PIPE
         shell = False if isinstance(self.command, list) else True
-        self.start_time = time.time()
-        self._process = subprocess.Popen(self.command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         shell=shell)
+        self.start_time, self._started = time.time(), monotonic()
+        if self.fast_spawn and limits is None and spawn_supported(cwd): # posix_spawn() can't run _preexec().
+            self._process = SpawnedProcess(self.command, cwd, env, stdin, stdout)
+        else:
+            # preexec_fn makes Python 3 fork() instead of vfork(), which is slow with a large parent and unsafe with
+            # other threads running (Supervisor always is). Python 3 can start the session and restore the signals
+            # itself (restore_signals defaults to True), so _preexec() only runs on Python 2 or to apply limits.
+            if limits is None and sys.version_info[0] > 2: session = dict(start_new_session=True)
+            else: session = dict(preexec_fn=lambda: _preexec(limits))
+            self._process = subprocess.Popen(self.command, cwd=cwd, env=env, stdin=stdin, stdout=stdout,
+                                             stderr=subprocess.PIPE, shell=shell, **session)
         self.pid = self._process.pid
-        thread = PollLocal(self) # Monitor the process in the background.
-        thread.daemon = True
-        thread.start()
+        with _groups_lock: _groups.add(self.pid)
+        self.resources = Resources(sample_interval)
+        Supervisor.watch(self) # Monitor the process in the background.
+        if self._process.stdin is not None:
+            fd = self._process.stdin.fileno()
+            def write(data):
+                while data:
+                    try: data = data[os.write(fd, data):] # Not through the file object, it may buffer.
+                    except OSError as err:
+                        if err.errno != errno.EINTR: raise
+                return None
+            self.stdin_size = 0
+            StdinFeeder(self, write, self._process.stdin.close).start()
         return None
     
-    def run_remote(self, host, user='', key=None, port=22):
+    def run_remote(self, host, user='', key=None, port=22, pool=None):
         """
         Similar to run_local(), but runs the command over SSH on a remote host using public key authentication. The key
         must not be password protected.
@@ -246,21 +978,121 @@ class ExternalCmd:
             parameter is left blank. Otherwise authentication will fail.
         port : integer, default 22
             The SSH port to use.
+        pool : robutils.SSHPool.SSHPool, default None
+            Pool of authenticated connections to run the command on. Uses robutils.SSHPool.default_pool if not set, so
+            successive commands on the same host share one connection.
         
         See also
         --------
         http://stackoverflow.com/questions/10745138/python-paramiko-ssh
         http://stackoverflow.com/questions/3562403/how-can-paramiko-get-ssh-command-return-code
         """
-        if not user: user = psutil.Process(os.getpid()).username # If user not specified, use current user.
+        if not user:
+            user = psutil.Process(os.getpid()).username # If user not specified, use current user.
+            if callable(user): user = user() # psutil >= 2.0
         if isinstance(self.command, list): self.command = ' '.join(self.command)
-        self._process = paramiko.SSHClient()
-        self._process.load_system_host_keys()
-        if host not in _process._system_host_keys:
-            self.ssh_error = 'Server not found in known_hosts'
+        if not default_cache.known(host, port): # Parses known_hosts only if it changed, see robutils.KeyCache.
+            self._abort('Server not found in known_hosts', ssh=True)
             return None
-        thread = PollRemote(self, host, user, key, port)
+        thread = PollRemote(self, host, user, key, port, pool or default_pool)
         thread.daemon = True
         thread.start()
         return None
 
+
+def as_completed(cmds, timeout=None):
+    """
+    Generator yielding ExternalCmd instances in the order they finish (or fail to start), as soon as each one is done.
+    Instances which are already done are yielded first.
+    
+    Parameters
+    ----------
+    cmds : list
+        ExternalCmd instances, already started or about to be.
+    timeout : float, default None
+        Stop yielding after this many seconds even if some commands are still running. Waits forever if None.
+    
+    Examples
+    --------
+    >>> cmds = [ExternalCmd(['gzip', '-t', f]) for f in glob.glob('/var/log/*.gz')]
+    >>> for cmd in cmds: cmd.run_local()
+    >>> for cmd in as_completed(cmds, timeout=60):
+    ...     if cmd.code: print cmd.command[-1], cmd.stderr,
+    ... 
+    /var/log/corrupted.gz gzip: /var/log/corrupted.gz: unexpected end of file
+    >>> 
+    """
+    pending = set(cmds)
+    finished = collections.deque()
+    cond = threading.Condition()
+    def notify(cmd):
+        with cond:
+            finished.append(cmd)
+            cond.notify()
+        return None
+    watched = list(pending)
+    for cmd in watched: cmd._done_callbacks.append(notify)
+    try:
+        for cmd in watched:
+            if cmd._done(): notify(cmd) # Done before the callback was added. Duplicates are skipped below.
+        deadline = None if timeout is None else monotonic() + timeout
+        while pending:
+            with cond:
+                while not finished:
+                    if deadline is None: cond.wait()
+                    elif monotonic() >= deadline: return
+                    else: cond.wait(deadline - monotonic())
+                cmd = finished.popleft()
+            if cmd in pending:
+                pending.remove(cmd)
+                yield cmd
+    finally:
+        # Also runs when the generator is closed early (e.g. by wait_any()), or the callbacks would pile up on
+        # commands which are waited for over and over.
+        for cmd in watched:
+            try: cmd._done_callbacks.remove(notify)
+            except ValueError: pass
+
+
+def wait_any(cmds, timeout=None):
+    """
+    Blocks until at least one of the commands is done.
+    
+    Parameters
+    ----------
+    cmds : list
+        ExternalCmd instances.
+    timeout : float, default None
+        Maximum number of seconds to wait. Waits forever if None.
+    
+    Returns
+    -------
+    ExternalCmd : The first instance found done, None if timeout was reached first (or cmds is empty).
+    """
+    completed = as_completed(cmds, timeout)
+    try:
+        for cmd in completed: return cmd
+    finally:
+        completed.close() # Removes its callbacks right away.
+    return None
+
+
+def wait_all(cmds, timeout=None):
+    """
+    Blocks until every command is done.
+    
+    Parameters
+    ----------
+    cmds : list
+        ExternalCmd instances.
+    timeout : float, default None
+        Maximum number of seconds to wait. Waits forever if None.
+    
+    Returns
+    -------
+    boolean : True if all commands are done, False if timeout was reached first.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    for cmd in cmds:
+        if not cmd.wait(None if deadline is None else max(deadline - monotonic(), 0)): return False
+    return True
@@ -0,0 +1,326 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Runs large batches of external commands with a limit on how many run at the same time.
+
+ExternalCmdPool provides the ExternalCmdPool class which queues ExternalCmd instances and only starts a new one when a
+running one finishes. No extra threads are created: local commands are multiplexed by the single
+robutils.ExternalCmd.Supervisor thread, and the next queued command is started from its completion callback.
+
+FanOut is built on top of it and runs one command on many hosts over SSH, aggregating the results as they come in.
+
+For more information:
+    * import robutils.ExternalCmdPool; help(robutils.ExternalCmdPool)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['ExternalCmdPool', 'FanOut',]
+
+
+import time, threading, heapq, traceback
+from robutils.ExternalCmd import ExternalCmd, monotonic
+
+
+class ExternalCmdPool:
+    """
+    Queues ExternalCmd instances and runs at most max_in_flight of them at once. Commands with a lower priority value
+    start first, commands with the same priority start in the order they were submitted (FIFO).
+    
+    submit() returns the ExternalCmd instance itself, so code, stdout, stderr, start_time and end_time are populated
+    exactly as if run_local() or run_remote() had been called directly. A command which couldn't be started has its
+    error (or ssh_error) member set instead.
+    
+    Examples
+    --------
+    >>> pool = ExternalCmdPool(16)
+    >>> cmds = [pool.submit(['gzip', '-t', f]) for f in glob.glob('/var/log/*.gz')]
+    >>> urgent = pool.submit('df -P', priority=-1)
+    >>> pool.join()
+    True
+    >>> [f for f, c in zip(glob.glob('/var/log/*.gz'), cmds) if c.code]
+    ['/var/log/corrupted.gz']
+    >>> remote = pool.submit('uname -r', host='server1', user='root')
+    >>>
+    """
+    
+    max_in_flight = 0 # Maximum number of commands running at the same time.
+    timeout = 0 # Timeout used when submit() is given a command instead of an ExternalCmd instance.
+    in_flight = 0 # Number of commands currently running.
+    queued = 0 # Number of commands waiting for a free slot.
+    completed = 0 # Number of commands done (finished or failed to start).
+    _queue = None # Heap of (priority, sequence, ExternalCmd instance, host, run_local()/run_remote() kwargs).
+    _sequence = 0 # Tie breaker for the heap, keeps FIFO order within the same priority.
+    _cond = None # threading.Condition guarding all of the above.
+    _local = None # threading.local, prevents recursion when commands finish while starting others.
+    
+    def __init__(self, max_in_flight=8, timeout=0):
+        """
+        Creates a new pool.
+        
+        Parameters
+        ----------
+        max_in_flight : integer, default 8
+            Maximum number of commands running at the same time. Must be at least 1.
+        timeout : integer, default 0
+            Timeout in seconds for commands submitted as a list or string instead of an ExternalCmd instance.
+        """
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.timeout = timeout
+        self._queue = []
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        return None
+    
+    def submit(self, cmd, priority=0, host=None, **kwargs):
+        """
+        Queues a command. It starts immediately if fewer than max_in_flight commands are running.
+        
+        Parameters
+        ----------
+        cmd : robutils.ExternalCmd.ExternalCmd, list or string
+            The command to run. Lists and strings are wrapped in a new ExternalCmd instance using the pool's timeout.
+        priority : integer, default 0
+            Commands with lower values start first.
+        host : string, default None
+            If set the command runs on this host with run_remote(), otherwise it runs with run_local().
+        **kwargs : Passed on to run_local() (e.g. cwd) or run_remote() (e.g. user, key, port).
+        
+        Returns
+        -------
+        robutils.ExternalCmd.ExternalCmd : The queued instance.
+        """
+        if not isinstance(cmd, ExternalCmd): cmd = ExternalCmd(cmd, self.timeout)
+        cmd._done_callbacks.append(self._release)
+        with self._cond:
+            self._sequence += 1
+            heapq.heappush(self._queue, (priority, self._sequence, cmd, host, kwargs))
+            self.queued += 1
+        self._dispatch()
+        return cmd
+    
+    def _dispatch(self):
+        """Starts queued commands while there are free slots."""
+        if getattr(self._local, 'dispatching', False): return None # Already looping further up the stack.
+        self._local.dispatching = True
+        try:
+            while True:
+                with self._cond:
+                    if not self._queue or self.in_flight >= self.max_in_flight: return None
+                    priority, sequence, cmd, host, kwargs = heapq.heappop(self._queue)
+                    self.queued -= 1
+                    self.in_flight += 1
+                try:
+                    if host: cmd.run_remote(host, **kwargs)
+                    else: cmd.run_local(**kwargs)
+                except Exception as err:
+                    cmd._abort(str(err) or err.__class__.__name__) # Calls _release(), frees the slot.
+        finally:
+            self._local.dispatching = False
+    
+    def _release(self, cmd):
+        """Done callback of every submitted ExternalCmd instance. Frees its slot and starts the next command."""
+        with self._cond:
+            self.in_flight -= 1
+            self.completed += 1
+            self._cond.notify_all()
+        self._dispatch()
+        return None
+    
+    def join(self, timeout=None):
+        """
+        Blocks until every submitted command is done.
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Maximum number of seconds to wait. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if all commands are done, False if timeout was reached first.
+        """
+        with self._cond:
+            if timeout is None:
+                while self.queued or self.in_flight: self._cond.wait()
+            else:
+                deadline = monotonic() + timeout
+                while (self.queued or self.in_flight) and monotonic() < deadline:
+                    self._cond.wait(deadline - monotonic())
+            return not (self.queued or self.in_flight)
+
+
+class FanOut:
+    """
+    Runs the same command on many hosts (ExternalCmd.run_remote()) with at most max_in_flight hosts at once, so the
+    total time is bound by the slowest hosts instead of the sum of all of them. Results are aggregated in this
+    instance's members as each host finishes, and can be consumed as they arrive with as_completed() or the on_result
+    callback.
+    
+    Hosts where the command ran but exited non-zero end up in failed, hosts where it couldn't run at all (unknown host,
+    connection refused, authentication) end up in ssh_errors. Other failures (ExternalCmd.error, e.g. run_remote()
+    raising an unexpected exception) end up in errors.
+    
+    Examples
+    --------
+    >>> fan = FanOut('rpm -q openssl', hosts, max_in_flight=64, timeout=30, user='root')
+    >>> fan.run()
+    >>> for host, cmd in fan.as_completed():
+    ...     if cmd.code == 0: print host, cmd.stdout.strip()
+    ... 
+    server1 openssl-1.0.0-25.el6_3.1.x86_64
+    server2 openssl-1.0.0-20.el6_2.5.x86_64
+    >>> fan.codes
+    {0: 498, 1: 1}
+    >>> fan.failed
+    {'server7': 1}
+    >>> fan.ssh_errors
+    {'server9': 'Server not found in known_hosts'}
+    >>> fan.slowest(2)
+    [('server3', 12.41), ('server1', 3.02)]
+    >>> 
+    """
+    
+    command = None # Command to run on every host.
+    hosts = None # List of hosts, duplicates removed.
+    results = None # Host: ExternalCmd instance.
+    codes = None # Exit code: number of hosts which exited with it.
+    failed = None # Host: exit code, for hosts where the command exited non-zero.
+    ssh_errors = None # Host: ssh_error string, for hosts where the command couldn't run.
+    errors = None # Host: error string, for hosts where the command failed for other reasons.
+    completed = 0 # Number of hosts done.
+    start_time = None
+    end_time = None # Set once every host is done.
+    on_result = None # Callback function, see __init__().
+    _finished = None # Hosts in the order they finished.
+    _pool = None # ExternalCmdPool instance doing the work.
+    _kwargs = None # Passed to run_remote().
+    _cond = None # threading.Condition guarding all of the above.
+    
+    def __init__(self, command, hosts, max_in_flight=32, timeout=0, on_result=None, **kwargs):
+        """
+        Prepares the fan-out, nothing runs until run() is called.
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to run on each host, see ExternalCmd.
+        hosts : list
+            Host names or IP addresses. Duplicates are removed.
+        max_in_flight : integer, default 32
+            Maximum number of hosts running the command at the same time.
+        timeout : integer, default 0
+            Per-host timeout in seconds, including connecting (see ExternalCmd). 0 means no timeout.
+        on_result : function, default None
+            Called as on_result(host, cmd) as soon as each host is done. Runs in a background thread, so it should
+            return quickly.
+        **kwargs : Passed on to ExternalCmd.run_remote() (user, key, port, pool).
+        """
+        self.command = command
+        self.hosts = []
+        for host in hosts:
+            if host not in self.hosts: self.hosts.append(host)
+        self.results = {}
+        self.codes = {}
+        self.failed = {}
+        self.ssh_errors = {}
+        self.errors = {}
+        self.on_result = on_result
+        self._finished = []
+        self._pool = ExternalCmdPool(max_in_flight, timeout)
+        self._kwargs = kwargs
+        self._cond = threading.Condition()
+        return None
+    
+    def run(self):
+        """Starts the command on the first max_in_flight hosts, the rest follow as hosts finish."""
+        self.start_time = time.time()
+        if not self.hosts: self.end_time = self.start_time
+        for host in self.hosts:
+            cmd = ExternalCmd(self.command, self._pool.timeout)
+            self.results[host] = cmd
+            cmd._done_callbacks.append(lambda cmd, host=host: self._collect(host, cmd))
+            self._pool.submit(cmd, host=host, **self._kwargs)
+        return None
+    
+    def _collect(self, host, cmd):
+        """Done callback of every host's ExternalCmd instance."""
+        with self._cond:
+            if cmd.ssh_error is not None: self.ssh_errors[host] = cmd.ssh_error
+            elif cmd.error is not None: self.errors[host] = cmd.error
+            else:
+                self.codes[cmd.code] = self.codes.get(cmd.code, 0) + 1
+                if cmd.code: self.failed[host] = cmd.code
+            self._finished.append(host)
+            self.completed += 1
+            if self.completed == len(self.hosts): self.end_time = time.time()
+            self._cond.notify_all()
+        if self.on_result:
+            try: self.on_result(host, cmd)
+            except Exception: traceback.print_exc() # Don't let a broken callback take down the background thread.
+        return None
+    
+    def as_completed(self, timeout=None):
+        """
+        Generator yielding (host, ExternalCmd instance) tuples in the order hosts finish, until all hosts are done.
+        Hosts which finished before this was called are yielded first.
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Stop yielding after this many seconds even if some hosts are still running. Waits forever if None.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        index = 0
+        while index < len(self.hosts):
+            with self._cond:
+                while len(self._finished) <= index:
+                    if deadline is None: self._cond.wait()
+                    elif monotonic() >= deadline: return
+                    else: self._cond.wait(deadline - monotonic())
+                hosts = self._finished[index:]
+            index += len(hosts)
+            for host in hosts: yield host, self.results[host]
+    
+    def join(self, timeout=None):
+        """
+        Blocks until every host is done.
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Maximum number of seconds to wait. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if all hosts are done, False if timeout was reached first.
+        """
+        with self._cond:
+            if timeout is None:
+                while self.completed < len(self.hosts): self._cond.wait()
+            else:
+                deadline = monotonic() + timeout
+                while self.completed < len(self.hosts) and monotonic() < deadline:
+                    self._cond.wait(deadline - monotonic())
+            return self.completed >= len(self.hosts)
+    
+    def slowest(self, count=10):
+        """
+        Returns the slowest hosts which ran the command, as a list of (host, seconds) tuples, slowest first.
+        
+        Parameters
+        ----------
+        count : integer, default 10
+            Maximum number of hosts to return.
+        """
+        with self._cond:
+            durations = [(h, self.results[h].end_time - self.results[h].start_time) for h in self._finished
+                         if self.results[h].end_time is not None]
+        return sorted(durations, key=lambda d: d[1], reverse=True)[:count]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Caches SSH host keys (known_hosts) and private keys for the whole process.
+
+paramiko's SSHClient.load_system_host_keys() parses all of ~/.ssh/known_hosts every time it's called, and looking a host
+up in the result scans every entry (computing an HMAC for each hashed one). On hosts whose known_hosts has tens of
+thousands of lines that dominates the cost of starting a remote command. KeyCache provides the KeyCache class which
+parses each known_hosts file once, keeps plain host names in a dict and remembers the result of every lookup, and only
+reads a file again when its modification time (or size, or inode) changed. Private key files are cached the same way.
+
+ExternalCmd.run_remote()'s known_hosts check and robutils.SSHPool use the module's default_cache instance.
+
+For more information:
+    * import robutils.KeyCache; help(robutils.KeyCache)
+    * import robutils.SSHPool; help(robutils.SSHPool)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['KeyCache', 'default_cache',]
+
+
+import os, hmac, base64, hashlib, binascii, threading
+import paramiko # https://github.com/paramiko/paramiko
+
+
+def host_key_name(host, port=22):
+    """Returns the name a host is listed under in known_hosts: the host itself on port 22, "[host]:port" otherwise."""
+    return host if port == 22 else '[{0}]:{1}'.format(host, port)
+
+
+class KnownHostsFile:
+    """
+    This class isn't designed to be used manually!
+    One parsed known_hosts file. Keys are kept as (key type, base64 string) until a host using them is looked up.
+    """
+    
+    signature = None # (mtime, size, inode) of the file when it was parsed, None if it doesn't exist.
+    plain = None # Host name: list of (key type, base64 key).
+    hashed = None # List of (salt, HMAC-SHA1 of the host name, key type, base64 key) for "|1|salt|hash" entries.
+    
+    def __init__(self, path, signature):
+        self.signature = signature
+        self.plain = {}
+        self.hashed = []
+        if signature is None: return None
+        with open(path, 'rb') as handle:
+            for line in handle:
+                fields = line.decode('utf-8', 'replace').split()
+                if len(fields) < 3 or fields[0].startswith('#') or fields[0].startswith('@'): continue # @cert-authority
+                for name in fields[0].split(','):
+                    if name.startswith('|1|'):
+                        try:
+                            salt, digest = [base64.b64decode(p.encode('ascii')) for p in name[3:].split('|', 1)]
+                        except (ValueError, TypeError, binascii.Error):
+                            continue
+                        self.hashed.append((salt, digest, fields[1], fields[2]))
+                    else:
+                        self.plain.setdefault(name, []).append((fields[1], fields[2]))
+        return None
+    
+    def lookup(self, name):
+        """Returns the list of (key type, base64 key) entries for a host name, checking the hashed ones one by one."""
+        entries = list(self.plain.get(name, []))
+        encoded = name.encode('utf-8')
+        for salt, digest, keytype, key in self.hashed:
+            if hmac.new(salt, encoded, hashlib.sha1).digest() == digest: entries.append((keytype, key))
+        return entries
+
+
+class KeyCache:
+    """
+    Process-wide cache of known_hosts files and private keys. Every call checks the files' modification time with one
+    stat() and re-reads a file only if it changed, so edits (ssh-keygen -R, ssh-keyscan >>) are picked up right away.
+    
+    Looking up a host name for the first time checks the dict of plain names and computes one HMAC per hashed entry
+    (their salts differ, so they can't be indexed). The result, even "not found", is remembered until a file changes:
+    later lookups of the same host are a dict lookup.
+    
+    Examples
+    --------
+    >>> from robutils.KeyCache import default_cache
+    >>> default_cache.known('server1')
+    True
+    >>> default_cache.host_keys('server1')
+    {'ssh-rsa': <paramiko.rsakey.RSAKey object at 0x1c0ffee>}
+    >>> default_cache.known('server1', port=2222) # Looks for "[server1]:2222".
+    False
+    >>> default_cache.private_key('/root/.ssh/deploy_key')
+    <paramiko.rsakey.RSAKey object at 0x2c0ffee>
+    >>>
+    """
+    
+    paths = None # known_hosts files, "~" is expanded on every lookup (so $HOME changes are picked up).
+    hits = 0 # Number of host lookups answered from memory.
+    misses = 0 # Number of host lookups which had to search the parsed files.
+    reloads = 0 # Number of times a file was (re)parsed.
+    _files = None # Expanded path: KnownHostsFile instance.
+    _hosts = None # Host name: {key type: paramiko.PKey}, empty dict if not found. Cleared when any file changes.
+    _keys = None # Private key path: ((mtime, size, inode), paramiko.PKey or None).
+    _lock = None # threading.Lock guarding all of the above.
+    
+    def __init__(self, paths=('~/.ssh/known_hosts',)):
+        """
+        Creates a new, empty cache.
+        
+        Parameters
+        ----------
+        paths : list, default ['~/.ssh/known_hosts']
+            known_hosts files to read, in order. Same as SSHClient.load_system_host_keys() by default. Add
+            '/etc/ssh/ssh_known_hosts' to use the system-wide file too.
+        """
+        self.paths = list(paths)
+        self._files = {}
+        self._hosts = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        return None
+    
+    @staticmethod
+    def _signature(path):
+        """Returns what tells whether a file changed, None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+    
+    def _refresh(self):
+        """Re-parses the known_hosts files which changed. Must be called with _lock acquired."""
+        paths = [os.path.expanduser(p) for p in self.paths]
+        changed = set(self._files) != set(paths)
+        for path in paths:
+            signature = self._signature(path)
+            if path in self._files and self._files[path].signature == signature: continue
+            self._files[path] = KnownHostsFile(path, signature)
+            self.reloads += 1
+            changed = True
+        for path in set(self._files) - set(paths): del self._files[path]
+        if changed: self._hosts.clear()
+        return [self._files[p] for p in paths]
+    
+    def host_keys(self, host, port=22):
+        """
+        Returns the known keys of a host.
+        
+        Parameters
+        ----------
+        host : string
+            Host name or IP address, as given to ExternalCmd.run_remote().
+        port : integer, default 22
+            SSH port. Hosts on other ports are listed as "[host]:port" in known_hosts.
+        
+        Returns
+        -------
+        dict : Key type (e.g. 'ssh-rsa'): paramiko.PKey instance. Empty if the host isn't known.
+        """
+        name = host_key_name(host, port)
+        with self._lock:
+            files = self._refresh()
+            if name in self._hosts:
+                self.hits += 1
+                return self._hosts[name]
+            self.misses += 1
+            keys = {}
+            for known_hosts in files:
+                for keytype, key in known_hosts.lookup(name):
+                    if keytype in keys: continue # First one wins, same as paramiko.
+                    try:
+                        entry = paramiko.hostkeys.HostKeyEntry.from_line('{0} {1} {2}'.format(name, keytype, key))
+                    except (paramiko.SSHException, ValueError, TypeError, binascii.Error):
+                        continue # Broken line, paramiko would've refused the whole file.
+                    if entry is not None: keys[keytype] = entry.key # None: key type paramiko doesn't support.
+            self._hosts[name] = keys
+            return keys
+    
+    def known(self, host, port=22):
+        """Returns True if known_hosts has a key for the host (on this port)."""
+        return bool(self.host_keys(host, port))
+    
+    def add_host_keys(self, client, host, port=22):
+        """
+        Gives a paramiko.SSHClient the known keys of the host it's about to connect to, instead of calling
+        load_system_host_keys(). paramiko then verifies the server's key as usual: an unknown host is rejected (with
+        the default RejectPolicy) and a different key raises BadHostKeyException.
+        
+        Parameters
+        ----------
+        client : paramiko.SSHClient
+            The client, before connect() is called.
+        host : string
+            The host client is going to connect to.
+        port : integer, default 22
+            The port client is going to connect to.
+        """
+        name = host_key_name(host, port)
+        for keytype, key in self.host_keys(host, port).items(): client.get_host_keys().add(name, keytype, key)
+        return None
+    
+    def private_key(self, path):
+        """
+        Returns a private key file loaded as a paramiko.PKey, parsed again only if the file changed.
+        
+        Parameters
+        ----------
+        path : string
+            The key file (RSA, ECDSA, Ed25519 or DSA), "~" is expanded.
+        
+        Returns
+        -------
+        paramiko.PKey : The key, None if the file doesn't exist, can't be parsed or is password protected.
+        """
+        path = os.path.expanduser(path)
+        signature = self._signature(path)
+        with self._lock:
+            cached = self._keys.get(path)
+            if cached is not None and cached[0] == signature: return cached[1]
+        key = None
+        if signature is not None:
+            for name in ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey'):
+                cls = getattr(paramiko, name, None) # Not every paramiko version has every key type.
+                if cls is None: continue
+                try:
+                    key = cls.from_private_key_file(path)
+                    break
+                except (paramiko.SSHException, EnvironmentError, ValueError, TypeError):
+                    continue # Wrong key type, or password protected.
+        with self._lock: self._keys[path] = (signature, key)
+        return key
+    
+    def clear(self):
+        """Drops everything cached, the next lookups read the files again."""
+        with self._lock:
+            self._files.clear()
+            self._hosts.clear()
+            self._keys.clear()
+        return None
+
+
+default_cache = KeyCache()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Resource limits, CPU/I/O priority and CPU affinity for local external commands (Linux).
+
+With hundreds of commands running at once, one runaway child (a memory leak, an infinite loop, a find over NFS) can
+starve the others and the Python process supervising them. Limits provides the Limits class which is given to
+robutils.ExternalCmd.ExternalCmd.run_local() and applied in the child after fork() and before exec(), so the command
+never runs a single instruction without them: rlimits (address space, CPU seconds, open files, ...), niceness, I/O
+scheduling class/priority (like ionice) and the CPUs it may run on (like taskset).
+
+Everything except negative niceness and the realtime I/O class works without privileges: limits are only ever lowered.
+
+For more information:
+    * import robutils.Limits; help(robutils.Limits)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd.ExternalCmd.run_local)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Limits',]
+
+
+import os, errno, platform, resource, ctypes, ctypes.util
+
+
+IOPRIO_CLASSES = {'realtime':1, 'best-effort':2, 'idle':3} # Same names as ionice -c.
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET = {'x86_64':251, 'i386':289, 'i686':289, 'aarch64':30, 'armv7l':314, 'ppc64':273, 'ppc64le':273}
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _check(result):
+    """Raises OSError from errno if a libc call returned -1."""
+    if result != -1: return None
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code))
+
+
+class Limits:
+    """
+    Limits applied to a local command before it executes, see robutils.ExternalCmd.ExternalCmd.run_local(). One
+    instance can be shared by any number of commands (and Pipeline stages), it isn't modified when applied.
+    
+    rlimits given as one number set both the soft and the hard limit, so the command can't raise them again. A value
+    above the current hard limit is lowered to it (only root may raise a hard limit). What happens when a limit is
+    reached is up to the kernel and the command: allocations fail past address_space, SIGXCPU then SIGKILL at
+    cpu_seconds (code -24 or -9), open() fails with EMFILE past open_files.
+    
+    Errors (e.g. a negative nice without privileges, a CPU which doesn't exist) happen in the child and are raised by
+    run_local() in this process like a missing executable (as subprocess.SubprocessError on Python 3, which doesn't
+    pass the child's exception on).
+    
+    Examples
+    --------
+    >>> limits = Limits(address_space=2 * 1024 ** 3, cpu_seconds=600, open_files=256, nice=10, ionice='idle',
+    ...                 affinity=[2, 3])
+    >>> cmds = [ExternalCmd(['./convert.sh', path]) for path in paths]
+    >>> for cmd in cmds: cmd.run_local(limits=limits)
+    >>> wait_all(cmds)
+    True
+    >>> cmd = ExternalCmd(['python', '-c', 'x = " " * 4 * 1024 ** 3'])
+    >>> cmd.run_local(limits=Limits(address_space=1024 ** 3))
+    >>> cmd.wait()
+    True
+    >>> (cmd.code, cmd.stderr.splitlines()[-1])
+    (1, 'MemoryError')
+    >>>
+    """
+    
+    rlimits = None # List of (resource.RLIMIT_* constant, (soft, hard)) tuples.
+    nice = 0 # Added to the command's niceness (inherited from this process).
+    ionice = None # I/O priority given to the ioprio_set() system call ((class << 13) | level), None to inherit it.
+    affinity = None # List of CPU numbers the command may run on, None to inherit this process' affinity.
+    _ioprio_set = None # Number of the ioprio_set() system call on this architecture, glibc has no wrapper.
+    _mask = None # ctypes cpu_set_t of affinity, for Pythons without os.sched_setaffinity() (before 3.3).
+    
+    def __init__(self, address_space=None, cpu_seconds=None, open_files=None, nice=0, ionice=None, affinity=None,
+                 rlimits=None):
+        """
+        Prepares the limits. Everything is computed here, so applying them in the child only makes system calls.
+        
+        Parameters
+        ----------
+        address_space : integer, default None
+            Maximum size of the command's virtual memory in bytes (RLIMIT_AS).
+        cpu_seconds : integer, default None
+            Maximum CPU time in seconds (RLIMIT_CPU). Unlike the ExternalCmd timeout, time spent waiting doesn't count.
+        open_files : integer, default None
+            Maximum number of open file descriptors (RLIMIT_NOFILE).
+        nice : integer, default 0
+            Added to the command's niceness, 1 to 19 lowers its CPU priority. Negative values need privileges.
+        ionice : string or tuple, default None
+            I/O scheduling class: 'idle', 'best-effort' or 'realtime' (needs privileges), or a (class, level) tuple
+            with the priority level within the class, 0 (highest) to 7 (lowest), e.g. ('best-effort', 7).
+        affinity : list, default None
+            CPU numbers the command (and its children) may run on, e.g. [0, 1].
+        rlimits : dict, default None
+            Any other limits: resource.RLIMIT_* constant: number or (soft, hard) tuple, e.g. {resource.RLIMIT_CORE: 0}.
+        """
+        limits = dict(rlimits or {})
+        for limit, value in ((resource.RLIMIT_AS, address_space), (resource.RLIMIT_CPU, cpu_seconds),
+                             (resource.RLIMIT_NOFILE, open_files)):
+            if value is not None: limits[limit] = value
+        self.rlimits = []
+        for limit, value in sorted(limits.items()):
+            soft, hard = value if isinstance(value, tuple) else (value, value)
+            current = resource.getrlimit(limit)[1]
+            if current != resource.RLIM_INFINITY:
+                if hard == resource.RLIM_INFINITY or hard > current: hard = current
+                if soft == resource.RLIM_INFINITY or soft > hard: soft = hard
+            self.rlimits.append((limit, (soft, hard)))
+        self.nice = nice
+        if ionice is not None:
+            name, level = (ionice, 0) if not isinstance(ionice, tuple) else ionice
+            if name not in IOPRIO_CLASSES: raise ValueError('Unknown I/O class: {0}'.format(name))
+            if not 0 <= level <= 7: raise ValueError('I/O priority level must be between 0 and 7.')
+            if _libc is None or platform.machine() not in SYS_IOPRIO_SET:
+                raise OSError(errno.ENOSYS, 'ionice is not supported on {0}'.format(platform.machine()))
+            self.ionice = IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | level
+            self._ioprio_set = SYS_IOPRIO_SET[platform.machine()]
+        if affinity is not None:
+            self.affinity = sorted(set(int(cpu) for cpu in affinity))
+            if not hasattr(os, 'sched_setaffinity'):
+                if _libc is None: raise OSError(errno.ENOSYS, 'CPU affinity is not supported')
+                bits = ctypes.sizeof(ctypes.c_ulong) * 8
+                self._mask = (ctypes.c_ulong * 16)() # cpu_set_t, 1024 CPUs.
+                for cpu in self.affinity: self._mask[cpu // bits] |= 1 << (cpu % bits)
+        return None
+    
+    def apply(self):
+        """
+        Applies the limits to the calling process. Called in the child by robutils.ExternalCmd before the command is
+        executed, calling it in this process would limit it for good.
+        """
+        if self.nice: os.nice(self.nice)
+        if self.ionice is not None:
+            _check(_libc.syscall(self._ioprio_set, IOPRIO_WHO_PROCESS, 0, self.ionice))
+        if self._mask is not None: _check(_libc.sched_setaffinity(0, ctypes.sizeof(self._mask), self._mask))
+        elif self.affinity is not None: os.sched_setaffinity(0, self.affinity)
+        # Last: a low address space limit could make anything allocating memory after it fail.
+        for limit, value in self.rlimits: resource.setrlimit(limit, value)
+        return None
@@ -0,0 +1,221 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Looks for patterns in the output of external commands while it streams, and optionally stops the command once found.
+
+Many commands are only run for one answer: "start the server and wait until its log says READY", "grep a 50GB remote
+log for the first occurrence of an error". Matcher provides the Matcher class which is given to robutils.ExternalCmd
+(matchers parameter) and searches every chunk of output as soon as the background thread reads it, with a regular
+expression or any predicate function. It records where each match is and can terminate the command (SIGTERM to its
+process group, or closing the SSH channel of a remote command) once it found what it was looking for, instead of
+waiting for the command to exit or time out.
+
+For more information:
+    * import robutils.Matcher; help(robutils.Matcher)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Matcher',]
+
+
+import re, threading
+from robutils.ExternalCmd import Supervisor, monotonic
+
+
+class Matcher:
+    """
+    Incremental matcher for the output of one ExternalCmd instance. Output is searched line by line: a regular
+    expression is run over every complete line read so far in one pass (re.finditer() on the whole chunk, so lines
+    aren't split in Python), a predicate function is called with each line. A line is complete once its newline was
+    read, the last line of the output once the command is done. Patterns shouldn't match newlines: several lines are
+    searched at once, but what a pattern would match across a chunk boundary isn't found.
+    
+    Each match is recorded in matches as a (stream, line number, offset, text) tuple: the line number starts at 1, the
+    offset is the byte offset of the match in the stream, text is what the regular expression matched or the whole line
+    (without its newline) for predicates.
+    
+    Once count matches were found the matcher is done: it stops searching, wakes up wait(), and if terminate is True
+    terminates the command like its timeout would (local commands get SIGTERM, then SIGKILL after
+    robutils.ExternalCmd.Supervisor.leniency seconds; remote ones have their channel closed). The command's
+    stopped_by is then set to this matcher, and its code is the signal's (e.g. -15) or -1 for remote commands.
+    
+    Matchers keep state and belong to a single command, create a new one for every command.
+    
+    Examples
+    --------
+    >>> ready = Matcher(r'Listening on port (\\d+)', stream='stderr')
+    >>> server = ExternalCmd(['./server', '--config', 'test.cfg'], matchers=[ready])
+    >>> server.run_local()
+    >>> ready.wait(timeout=30)
+    True
+    >>> ready.matches
+    [('stderr', 12, 733, 'Listening on port 8080')]
+    >>> ready.match.group(1)
+    '8080'
+    >>>
+    
+    >>> first = Matcher(r'OutOfMemoryError', terminate=True)
+    >>> cmd = ExternalCmd('zcat /var/log/app/*.gz', matchers=[first])
+    >>> cmd.run_remote('server1')
+    >>> cmd.wait()
+    True
+    >>> (cmd.stopped_by is first, first.matches, cmd.stdout_size)
+    (True, [('stdout', 1841206, 201326592, 'OutOfMemoryError')], 201457664)
+    >>>
+    
+    >>> errors = Matcher(lambda line: line.startswith(b'E'), count=0) # Record every match, never done.
+    >>> cmd = ExternalCmd(['make', 'world'], matchers=[errors], tail_lines=10)
+    >>> cmd.run_local()
+    >>> cmd.wait()
+    True
+    >>> len(errors.matches)
+    3
+    >>>
+    """
+    
+    pattern = None # Compiled regular expression (bytes), None if predicate is used.
+    predicate = None # Function called with each line (bytes, without newline), None if pattern is used.
+    stream = None # 'stdout', 'stderr' or None for both.
+    count = 1 # Done after this many matches, 0 never is.
+    terminate = False # Terminate the command once done.
+    max_line = 1048576 # Lines longer than this many bytes are searched in pieces (a match may be cut in two).
+    matches = None # List of (stream, line number, offset, text) tuples.
+    match = None # re match object of the latest match (regular expressions only).
+    done = False # True once count matches were found.
+    finished = False # True once the command is done, whether or not anything matched.
+    _state = None # Stream: [unsearched partial line, its offset in the stream, its line number].
+    _cmd = None # The ExternalCmd instance, set by _attach().
+    _ending = False # True once the command is done, matches found by _finish() can't terminate it anymore.
+    _cond = None # threading.Condition notified when done or finished.
+    
+    def __init__(self, pattern, stream='stdout', count=1, terminate=False, flags=0):
+        """
+        Creates a new matcher, pass it to ExternalCmd (matchers parameter) before the command is started.
+        
+        Parameters
+        ----------
+        pattern : string, compiled regular expression or function
+            Regular expression searched in each line, or function called with each line (bytes, without the newline)
+            returning True for lines that match. Unicode patterns are encoded as UTF-8 (output is bytes).
+        stream : string, default 'stdout'
+            Which output to search: 'stdout', 'stderr' or None for both.
+        count : integer, default 1
+            Number of matches to find. Once found the matcher is done. 0 searches the whole output.
+        terminate : bool, default False
+            Terminate the command as soon as the matcher is done.
+        flags : integer, default 0
+            re flags used to compile pattern if it's a string (e.g. re.IGNORECASE). re.MULTILINE is always added.
+        """
+        if callable(pattern) and not hasattr(pattern, 'finditer'):
+            self.predicate = pattern
+        elif hasattr(pattern, 'finditer'):
+            self.pattern = pattern
+        else:
+            pattern = pattern if isinstance(pattern, bytes) else pattern.encode('utf-8')
+            self.pattern = re.compile(pattern, flags | re.MULTILINE) # ^ and $ match at the start/end of each line.
+        if stream not in ('stdout', 'stderr', None): raise ValueError('stream must be stdout, stderr or None.')
+        self.stream = stream
+        self.count = count
+        self.terminate = terminate
+        self.matches = []
+        self._state = {'stdout':[b'', 0, 1], 'stderr':[b'', 0, 1]}
+        self._cond = threading.Condition()
+        return None
+    
+    def _attach(self, cmd):
+        """Called by ExternalCmd.__init__() with the command this matcher belongs to."""
+        if self._cmd is not None and self._cmd is not cmd: raise ValueError('Matcher already used by another command.')
+        self._cmd = cmd
+        return None
+    
+    def _record(self, stream, line_number, offset, text, match=None):
+        """Records one match. Returns True if the matcher is done now."""
+        with self._cond:
+            self.matches.append((stream, line_number, offset, text))
+            if match is not None: self.match = match
+            if not self.count or len(self.matches) < self.count: return False
+            self.done = True
+            self._cond.notify_all()
+        if self.terminate and not self._ending:
+            if self._cmd.stopped_by is None: self._cmd.stopped_by = self
+            Supervisor.terminate(self._cmd)
+        return True
+    
+    def _search(self, stream, data, offset, line_number):
+        """Searches complete lines (data ends with a newline, or is the last line). Returns True once done."""
+        if self.pattern is not None:
+            position = 0 # Line number is counted incrementally, from the previous match on.
+            for match in self.pattern.finditer(data):
+                line_number += data.count(b'\n', position, match.start())
+                position = match.start()
+                if self._record(stream, line_number, offset + match.start(), match.group(0), match): return True
+            return False
+        start = 0
+        while start < len(data):
+            end = data.find(b'\n', start)
+            if end == -1: end = len(data)
+            if self.predicate(data[start:end]):
+                if self._record(stream, line_number, offset + start, data[start:end]): return True
+            start = end + 1
+            line_number += 1
+        return False
+    
+    def _feed(self, cmd, stream, data):
+        """Called by ExternalCmd with every chunk of output, from the background thread."""
+        if self.done or (self.stream is not None and stream != self.stream): return None
+        state = self._state[stream]
+        data = state[0] + data
+        end = data.rfind(b'\n') + 1 # Everything before end is complete lines.
+        if not end and len(data) > self.max_line: end = len(data) # Search it now rather than buffer without limit.
+        state[0] = data[end:]
+        if end:
+            self._search(stream, data[:end], state[1], state[2])
+            state[1] += end
+            state[2] += data.count(b'\n', 0, end)
+        return None
+    
+    def _finish(self, cmd):
+        """
+        Called by ExternalCmd once the command is done, before whoever waits for the command wakes up: searches the
+        last lines if they had no newline, then wakes up wait().
+        """
+        self._ending = True
+        for stream, state in sorted(self._state.items()):
+            if state[0] and not self.done and self.stream in (stream, None): self._search(stream, state[0], *state[1:])
+            state[0] = b''
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+        return None
+    
+    def wait(self, timeout=None):
+        """
+        Blocks until the matcher is done (count matches found) or the command is done, whichever comes first. The
+        command keeps running after this returns unless terminate is True.
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Maximum number of seconds to wait. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if the matcher is done, False if the command ended (or timeout was reached) without enough
+            matches.
+        """
+        with self._cond:
+            if timeout is None:
+                while not self.done and not self.finished: self._cond.wait()
+            else:
+                deadline = monotonic() + timeout
+                while not self.done and not self.finished and monotonic() < deadline:
+                    self._cond.wait(deadline - monotonic())
+            return self.done
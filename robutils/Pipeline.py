@@ -0,0 +1,208 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Connects local external commands with OS pipes, like "cmd1 | cmd2 | cmd3" in a shell but without one.
+
+Pipeline provides the Pipeline class which starts several robutils.ExternalCmd instances at once, with the stdout of
+each one connected to the stdin of the next by a pipe created with os.pipe(). Data flows from process to process
+through the kernel: Python never reads it, copies it or buffers it. Only the last command's stdout and every command's
+stderr are captured, by the same background thread (robutils.ExternalCmd.Supervisor) as any other command.
+
+For more information:
+    * import robutils.Pipeline; help(robutils.Pipeline)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Pipeline',]
+
+
+import os, time, fcntl, threading
+from robutils.ExternalCmd import ExternalCmd, Supervisor, monotonic
+
+
+def _pipe():
+    """Returns (read fd, write fd) of a new pipe, both close-on-exec so only the stages they are handed to get them."""
+    fds = os.pipe()
+    for fd in fds: fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fds
+
+
+class Pipeline:
+    """
+    Runs external commands locally with the stdout of each one piped into the stdin of the next. Each stage is an
+    ExternalCmd instance in its own process group, with its own exit code, start_time/end_time, stderr and resources.
+    The pipeline's stdout is the last stage's, the stdout of the other stages is always empty.
+    
+    The timeout applies to the pipeline as a whole: every stage still running when it is reached is terminated (then
+    killed after robutils.ExternalCmd.Supervisor.leniency seconds). A stage ending early (e.g. "head") closes its end
+    of the pipe, so the stages before it are killed by SIGPIPE once they write again, like in a shell.
+    
+    Stages should be given as lists, so no shell is started. Strings still work but are run by /bin/sh.
+    
+    Examples
+    --------
+    >>> pipeline = Pipeline([['zcat', '/var/log/messages.1.gz'], ['grep', 'error'], ['sort'], ['uniq', '-c']],
+    ...                     timeout=60)
+    >>> pipeline.run_local()
+    >>> pipeline.wait()
+    True
+    >>> pipeline.codes
+    [0, 0, 0, 0]
+    >>> pipeline.durations
+    [1.841, 1.843, 1.852, 1.853]
+    >>> print pipeline.stdout,
+          3 kernel: ata1.00: error: { UNC }
+    >>>
+    
+    >>> pipeline = Pipeline([['yes'], ['head', '-1']])
+    >>> pipeline.run_local()
+    >>> pipeline.wait()
+    True
+    >>> (pipeline.codes, pipeline.code)
+    ([-13, 0], 0)
+    >>>
+    """
+    
+    stages = None # ExternalCmd instances, in pipeline order.
+    timeout = None # Terminate every stage still running this many seconds after the pipeline started.
+    pipefail = False # If True, code is the last non-zero exit code of any stage, like bash's "set -o pipefail".
+    code = None # Exit code of the last stage (see pipefail), set when every stage is done.
+    codes = None # List of every stage's exit code, set when every stage is done.
+    durations = None # List of every stage's run time in seconds, set when every stage is done.
+    stdout = None # The last stage's stdout, set when every stage is done.
+    start_time = None
+    end_time = None
+    _started = None # monotonic() at start_time, the timeout counts from it.
+    error = None # Error string if a stage couldn't be started (the stages before it are terminated).
+    _cond = None # threading.Condition notified once every stage is done.
+    
+    def __init__(self, commands, timeout=0, pipefail=False, stdin=None):
+        """
+        Creates the stages of the pipeline. Nothing runs until run_local() is called.
+        
+        Parameters
+        ----------
+        commands : list
+            The stages of the pipeline, at least one. Each one is either a list (or string) which is wrapped in a new
+            ExternalCmd instance, or an ExternalCmd instance which hasn't run yet, to use its options (e.g.
+            tail_lines, on_output). The timeout of ExternalCmd instances is ignored, the pipeline's applies.
+        timeout : integer, default 0
+            If > 0, every stage still running this many seconds after run_local() is terminated or killed.
+        pipefail : bool, default False
+            Sets code to the exit code of the last stage which failed instead of the exit code of the last stage.
+        stdin : string, file object or iterable, default None
+            Data streamed to the first stage's stdin, see ExternalCmd.__init__().
+        """
+        if not commands: raise ValueError('A pipeline needs at least one command.')
+        self.stages = [c if isinstance(c, ExternalCmd) else ExternalCmd(c) for c in commands]
+        self.timeout = timeout
+        self.pipefail = pipefail
+        if stdin is not None: self.stages[0]._stdin = stdin
+        self._cond = threading.Condition()
+        return None
+    
+    def _done(self):
+        return self.end_time is not None or self.error is not None
+    
+    def _stage_done(self, cmd):
+        """Done callback of every stage, finishes the pipeline once they are all done."""
+        with self._cond:
+            if self._done() or not all(stage._done() for stage in self.stages): return None
+            self.codes = [stage.code for stage in self.stages]
+            self.durations = [stage.end_time - stage.start_time if stage.end_time else None for stage in self.stages]
+            self.code = self.codes[-1]
+            if self.pipefail: self.code = ([c for c in self.codes if c] or [self.code])[-1]
+            self.stdout = self.stages[-1].stdout
+            self.end_time = time.time()
+            self._cond.notify_all()
+        return None
+    
+    def run_local(self, cwd=None, env=None, limits=None):
+        """
+        Starts every stage locally. The pipeline runs in the background, use wait() to block until every stage ended.
+        The first stage's stdin is this process' stdin unless the pipeline (or the first stage) was given stdin.
+        
+        Parameters
+        ----------
+        cwd : string, default None
+            Use this as the current working directory of every stage if set.
+        env : dict, default None
+            Environment variables of every stage, see ExternalCmd.run_local().
+        limits : robutils.Limits.Limits, default None
+            Resource limits applied to every stage, see ExternalCmd.run_local().
+        """
+        if cwd: os.listdir(cwd) # Check if directory exists.
+        self.start_time, self._started = time.time(), monotonic()
+        for stage in self.stages: stage._done_callbacks.append(self._stage_done)
+        stdin = None
+        try:
+            for i, stage in enumerate(self.stages):
+                stdout = None if i == len(self.stages) - 1 else _pipe()
+                stage.timeout = max(self._started + self.timeout - monotonic(), 0.001) if self.timeout else None
+                try:
+                    if stdout is None: stage._spawn(cwd, env, 0, stdin=stdin, limits=limits)
+                    else: stage._spawn(cwd, env, 0, stdin=stdin, stdout=stdout[1], limits=limits)
+                finally:
+                    # The children have their own copies now. Once the writer exits the reader gets EOF, and once the
+                    # reader exits the writer gets SIGPIPE.
+                    if stdin is not None: os.close(stdin)
+                    if stdout is not None: os.close(stdout[1])
+                    stdin = None if stdout is None else stdout[0]
+        except Exception as err:
+            if stdin is not None: os.close(stdin)
+            for stage in self.stages:
+                if stage._process is not None: Supervisor.terminate(stage)
+                else: stage._abort(str(err) or err.__class__.__name__)
+            with self._cond:
+                self.error = str(err) or err.__class__.__name__
+                self._cond.notify_all()
+            raise
+        return None
+    
+    def wait(self, timeout=None):
+        """
+        Blocks until every stage is done, see ExternalCmd.wait().
+        
+        Parameters
+        ----------
+        timeout : float, default None
+            Maximum number of seconds to wait. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if the pipeline is done (or couldn't be started), False if timeout was reached first.
+        """
+        with self._cond:
+            if timeout is None:
+                while not self._done(): self._cond.wait()
+            else:
+                deadline = monotonic() + timeout
+                while not self._done() and monotonic() < deadline: self._cond.wait(deadline - monotonic())
+            return self._done()
+    
+    def set_timeout(self, timeout):
+        """
+        Changes or cancels the pipeline's timeout while it runs, see ExternalCmd.set_timeout().
+        
+        Parameters
+        ----------
+        timeout : float
+            The new timeout in seconds, counted from when the pipeline started. 0 or None cancels it.
+        """
+        self.timeout = timeout or None
+        for stage in self.stages:
+            if stage._started is None: continue
+            stage.set_timeout(max(self._started + timeout - stage._started, 0.001) if timeout else None)
+        return None
+    
+    def iter_lines(self):
+        """Generator yielding the last stage's stdout line by line as it is produced, see ExternalCmd.iter_lines()."""
+        return self.stages[-1].iter_lines()
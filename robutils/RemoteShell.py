@@ -0,0 +1,222 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Runs many commands in a row on a remote host through one persistent shell (paramiko).
+
+RemoteShell provides the RemoteShell class, which starts /bin/sh once on a pooled SSH connection (see robutils.SSHPool)
+and sends it one command after another over the same channel. Each command is followed by unique sentinels on
+stdout and stderr, which tell where its output ends and carry its exit code. So a command costs one round trip instead
+of opening a session and calling exec_command(), and shell state (current directory, variables) carries over from one
+command to the next.
+
+For more information:
+    * import robutils.RemoteShell; help(robutils.RemoteShell)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd.ExternalCmd.run_remote)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['RemoteShell',]
+
+
+import os, time, uuid, select, threading
+import psutil # http://code.google.com/p/psutil/
+from robutils.ExternalCmd import ExternalCmd, monotonic
+from robutils.SSHPool import default_pool
+
+
+class RemoteShell:
+    """
+    Persistent shell on a remote host. run() sends a command to the shell and blocks until it is done, returning an
+    ExternalCmd instance with code, stdout, stderr, start_time and end_time set exactly as run_remote() would have.
+    Commands run one at a time, in the order run() is called. Output is fed to the instance as it arrives, so on_output,
+    iter_lines() (from another thread), matchers (terminate=True closes the shell, like a timeout) and tail_bytes or
+    tail_lines work while the command runs.
+    
+    Commands are run with eval and stdin redirected from /dev/null, so they can't swallow the commands which follow.
+    If a command ends the shell (exit, or a syntax error, which ends non-interactive shells) its code is the shell's
+    exit status and the next run() starts a new shell, losing the state of the old one. The same happens on timeout:
+    the channel is closed (the command's code is -1, as with run_remote()) because a shell without a terminal can't be
+    interrupted.
+    
+    Examples
+    --------
+    >>> with RemoteShell('server1', user='root') as shell:
+    ...     shell.run('cd /var/log').code
+    ...     shell.run('ls | wc -l').stdout
+    ...     shell.run('grep -c error messages', timeout=10).code
+    ...
+    0
+    '42\\n'
+    1
+    >>>
+    """
+    
+    host = None # SSH remote hostname/IP.
+    user = None # SSH username.
+    key = None # SSH private key.
+    port = None # SSH port on the remote host.
+    pool = None # robutils.SSHPool.SSHPool instance the channel is borrowed from.
+    shell = '/bin/sh' # Command starting the shell on the remote host.
+    commands = 0 # Number of commands run.
+    _channel = None # paramiko channel running the shell, None until the first run() or after the shell ended.
+    _lock = None # threading.Lock, one command at a time.
+    
+    def __init__(self, host, user='', key=None, port=22, pool=None, shell='/bin/sh'):
+        """
+        Prepares the shell, the connection is opened by the first run().
+        
+        Parameters
+        ----------
+        host : string
+            The IP address or host name of the remote host.
+        user : string, default ''
+            The SSH user name to use. Uses the user name which owns this running python process by default.
+        key : string, default None
+            The SSH key to use, see ExternalCmd.run_remote().
+        port : integer, default 22
+            The SSH port to use.
+        pool : robutils.SSHPool.SSHPool, default None
+            Pool of authenticated connections to open the shell on. Uses robutils.SSHPool.default_pool if not set.
+        shell : string, default '/bin/sh'
+            Command starting a POSIX shell reading commands from stdin on the remote host.
+        """
+        if not user:
+            user = psutil.Process(os.getpid()).username # If user not specified, use current user.
+            if callable(user): user = user() # psutil >= 2.0
+        self.host = host
+        self.user = user
+        self.key = key
+        self.port = port
+        self.pool = pool or default_pool
+        self.shell = shell
+        self._lock = threading.Lock()
+        return None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+    
+    def _open(self, timeout):
+        channel = self.pool.open_session(self.host, self.port, self.user, self.key, timeout=timeout or None)
+        try:
+            channel.exec_command(self.shell)
+        except:
+            self.pool.release(channel)
+            raise
+        self._channel = channel
+        return None
+    
+    def _close(self):
+        if self._channel is not None: self.pool.release(self._channel)
+        self._channel = None
+        return None
+    
+    def run(self, command, timeout=0):
+        """
+        Runs a command in the shell, opening it first if needed, and blocks until it is done.
+        
+        Parameters
+        ----------
+        command : robutils.ExternalCmd.ExternalCmd, list or string
+            The command to run. Lists and strings are wrapped in a new ExternalCmd instance. Pass an instance to use
+            its options (e.g. tail_lines, on_output), its timeout is used if the timeout parameter is 0.
+        timeout : integer, default 0
+            If > 0, give up on the command after this many seconds, closing the shell. 0 means no timeout.
+        
+        Returns
+        -------
+        robutils.ExternalCmd.ExternalCmd : The finished instance, with ssh_error set if the shell couldn't be opened.
+        """
+        cmd = command if isinstance(command, ExternalCmd) else ExternalCmd(command, timeout)
+        if isinstance(cmd.command, list): cmd.command = ' '.join(cmd.command)
+        timeout = timeout or cmd.timeout
+        marker = 'robutils-{0}'.format(uuid.uuid4().hex)
+        script = "eval '{0}' </dev/null; _robutils_rc=$?; printf '\\000%s %d\\n' {1} $_robutils_rc; " \
+                 "printf '\\000%s\\n' {1} >&2\n".format(cmd.command.replace("'", "'\\''"), marker)
+        with self._lock:
+            self.commands += 1
+            cmd.start_time, cmd._started = time.time(), monotonic()
+            deadline = cmd._started + timeout if timeout else None
+            # Any exception is reported in ssh_error, the shell is in an unknown state afterwards so it's closed.
+            try:
+                if self._channel is None: self._open(timeout)
+                self._channel.sendall(script.encode('utf-8') if not isinstance(script, bytes) else script)
+                code = self._collect(cmd, marker.encode('ascii'), deadline)
+            except Exception as err:
+                self._close()
+                cmd._abort(str(err) or err.__class__.__name__, ssh=True)
+                return cmd
+        cmd._finish(code)
+        return cmd
+    
+    def _collect(self, cmd, marker, deadline):
+        """
+        Reads the channel until both sentinels arrived, feeding the output to cmd as it arrives. Returns the exit code.
+        Sentinels start with a NUL byte, so output ending with one is held back until more arrives (it may be the
+        start of a sentinel split across two reads) but output ending with a newline is fed right away.
+        """
+        channel = self._channel
+        pending = {'stdout':bytearray(), 'stderr':bytearray()} # Output read but not fed to cmd yet.
+        sentinels = {'stdout':b'\0' + marker + b' ', 'stderr':b'\0' + marker + b'\n'}
+        ended = set() # Streams whose sentinel was seen.
+        code = -1
+        poller = select.poll() # select() can't handle fds >= FD_SETSIZE, see Supervisor.
+        poller.register(channel.fileno(), select.POLLIN)
+        while True:
+            for stream in ('stdout', 'stderr'):
+                buf, sentinel = pending[stream], sentinels[stream]
+                if stream in ended or not buf: continue
+                start = end = buf.find(sentinel)
+                if start == -1:
+                    end = buf.find(b'\0', max(len(buf) - len(sentinel) + 1, 0))
+                    while end != -1 and not sentinel.startswith(bytes(buf[end:])): end = buf.find(b'\0', end + 1)
+                    if end == -1: end = len(buf) # Nothing looks like the start of a sentinel.
+                if start != -1 and stream == 'stdout':
+                    newline = buf.find(b'\n', start + len(sentinel))
+                    if newline == -1: start = -1 # Exit code not complete yet, search again next time.
+                    else: code = int(buf[start + len(sentinel):newline])
+                if end > 0:
+                    cmd._feed(stream, bytes(buf[:end]))
+                    del buf[:end]
+                if start != -1:
+                    del buf[:]
+                    ended.add(stream)
+            if len(ended) == 2: return code
+            if cmd.stopped_by is not None:
+                code = -1 # A Matcher terminated it, same as a timeout.
+                self._close()
+                break
+            if channel.recv_ready() or channel.recv_stderr_ready():
+                while channel.recv_ready(): pending['stdout'].extend(channel.recv(max(len(channel.in_buffer), 1)))
+                while channel.recv_stderr_ready():
+                    pending['stderr'].extend(channel.recv_stderr(max(len(channel.in_stderr_buffer), 1)))
+                continue
+            wait = None if deadline is None else deadline - monotonic()
+            if channel.eof_received or channel.closed:
+                # The shell ended (exit, syntax error) before printing the sentinels.
+                code = channel.recv_exit_status() if channel.exit_status_ready() else -1
+                self._close()
+                break
+            if wait is not None and wait <= 0:
+                code = -1 # Timed out, same as ExternalCmd.run_remote().
+                self._close()
+                break
+            poller.poll(None if wait is None else wait * 1000)
+        for stream in ('stdout', 'stderr'):
+            if stream not in ended and pending[stream]: cmd._feed(stream, bytes(pending[stream])) # No sentinel coming.
+        return code
+    
+    def close(self):
+        """Ends the shell and gives the channel back to the pool. The next run() would start a new shell."""
+        with self._lock: self._close()
+        return None
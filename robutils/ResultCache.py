@@ -0,0 +1,175 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Caches the results of idempotent external commands (health checks, inventory probes) for a while.
+
+ResultCache provides the ResultCache class which runs commands through robutils.ExternalCmd only if the same command
+(same host, cwd and environment) didn't run within the last ttl seconds. Otherwise the previous ExternalCmd instance is
+returned as is, without spawning a process or opening an SSH session. Identical requests made while the command is
+still running share that one run.
+
+For more information:
+    * import robutils.ResultCache; help(robutils.ResultCache)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['ResultCache',]
+
+
+import threading, collections
+from robutils.ExternalCmd import ExternalCmd, monotonic
+
+
+class ResultCache:
+    """
+    Time-limited, size-limited cache of ExternalCmd results. run_local() and run_remote() return an ExternalCmd
+    instance right away, like ExternalCmd's own methods they don't block: call wait() on it. The instance is either
+    a cached one which is already done, one started by another caller which is still running (single-flight), or a new
+    one. Since they are shared, returned instances must be treated as read-only.
+    
+    Entries expire ttl seconds after their command finished. Once more than max_entries are cached, the least recently
+    used finished entries are dropped. Commands which couldn't run at all (ssh_error or error set) aren't cached, the
+    next request tries again. Non-zero exit codes are cached like any other result (e.g. "rpm -q" of a package which
+    isn't installed).
+    
+    Examples
+    --------
+    >>> cache = ResultCache(ttl=60)
+    >>> cmd = cache.run_remote('uname -r', 'server1', user='root')
+    >>> cmd.wait()
+    True
+    >>> cmd.stdout
+    '2.6.32-279.14.1.el6.x86_64\\n'
+    >>> cache.run_remote('uname -r', 'server1', user='root') is cmd # No new SSH session for 60 seconds.
+    True
+    >>> cache.run_local(['df', '-P'], ttl=5).wait()
+    True
+    >>> cache.hits, cache.misses
+    (1, 2)
+    >>>
+    """
+    
+    ttl = 60 # Default number of seconds results stay cached, counted from when the command finished.
+    max_entries = 1024 # Maximum number of finished results kept.
+    timeout = 0 # Timeout of the ExternalCmd instances created by the cache.
+    hits = 0 # Number of requests answered from the cache, including ones joining a running command.
+    misses = 0 # Number of requests which started a command.
+    _entries = None # collections.OrderedDict of key: [ExternalCmd instance, monotonic() expiry or None while running].
+    _lock = None # threading.Lock guarding all of the above.
+    
+    def __init__(self, ttl=60, max_entries=1024, timeout=0):
+        """
+        Creates a new, empty cache.
+        
+        Parameters
+        ----------
+        ttl : float, default 60
+            Default number of seconds a result stays cached after its command finished. Can be overridden per request.
+        max_entries : integer, default 1024
+            Maximum number of finished results kept, least recently used ones are dropped first.
+        timeout : integer, default 0
+            Timeout in seconds of the commands run by the cache, see ExternalCmd.
+        """
+        self.ttl = ttl
+        self.max_entries = max(int(max_entries), 1)
+        self.timeout = timeout
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        return None
+    
+    def _get(self, key, command, ttl, start):
+        """Returns the cached or running instance for key, or a new one started with start(cmd)."""
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and (entry[1] is None or entry[1] > now):
+                self._entries[key] = entry # Most recently used, back to the end.
+                self.hits += 1
+                return entry[0]
+            cmd = ExternalCmd(command, self.timeout)
+            self._entries[key] = [cmd, None]
+            self.misses += 1
+        cmd._done_callbacks.append(lambda cmd: self._store(key, cmd, ttl))
+        try:
+            start(cmd)
+        except Exception as err:
+            cmd._abort(str(err) or err.__class__.__name__) # Removes the entry, see _store().
+            raise
+        return cmd
+    
+    def _store(self, key, cmd, ttl):
+        """Done callback of every instance created by the cache."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not cmd: return None # Cleared while running.
+            if cmd.ssh_error is not None or cmd.error is not None:
+                del self._entries[key]
+                return None
+            entry[1] = monotonic() + (self.ttl if ttl is None else ttl)
+            finished = [k for k, e in self._entries.items() if e[1] is not None]
+            for k in finished[:max(len(finished) - self.max_entries, 0)]: del self._entries[k] # Oldest first.
+        return None
+    
+    def run_local(self, command, cwd=None, env=None, ttl=None):
+        """
+        Returns the result of running command locally, see ExternalCmd.run_local().
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to execute, see ExternalCmd.
+        cwd : string, default None
+            Working directory, part of the cache key.
+        env : dict, default None
+            Environment variables of the command, part of the cache key.
+        ttl : float, default None
+            Seconds the result stays cached if the command runs now. Uses the cache's ttl if None.
+        
+        Returns
+        -------
+        robutils.ExternalCmd.ExternalCmd : Shared instance, call wait() before reading its results.
+        """
+        key = (None, tuple(command) if isinstance(command, list) else command, cwd,
+               None if env is None else frozenset(env.items()))
+        return self._get(key, command, ttl, lambda cmd: cmd.run_local(cwd, env=env))
+    
+    def run_remote(self, command, host, user='', key=None, port=22, ttl=None, pool=None):
+        """
+        Returns the result of running command on host, see ExternalCmd.run_remote().
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to execute, see ExternalCmd.
+        host : string
+            The remote host, part of the cache key along with user and port.
+        user : string, default ''
+            The SSH user name to use.
+        key : string, default None
+            The SSH key to use.
+        port : integer, default 22
+            The SSH port to use.
+        ttl : float, default None
+            Seconds the result stays cached if the command runs now. Uses the cache's ttl if None.
+        pool : robutils.SSHPool.SSHPool, default None
+            Pool of connections to run the command on, see ExternalCmd.run_remote().
+        
+        Returns
+        -------
+        robutils.ExternalCmd.ExternalCmd : Shared instance, call wait() before reading its results.
+        """
+        cache_key = ((host, port, user), ' '.join(command) if isinstance(command, list) else command, None, None)
+        return self._get(cache_key, command, ttl, lambda cmd: cmd.run_remote(host, user, key, port, pool))
+    
+    def clear(self):
+        """Drops every cached result. Running commands still finish, but their results aren't cached."""
+        with self._lock: self._entries.clear()
+        return None
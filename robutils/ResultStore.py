@@ -0,0 +1,295 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Stores the results of large batches of external commands compactly, for analysis with pandas.
+
+Every robutils.ExternalCmd instance carries an instance dict, a Resources instance, locks and its full outputs: keeping
+100,000 of them around after a batch costs gigabytes. ResultStore provides the ResultStore class which copies what's
+worth keeping out of each finished instance into one typed array per field (exit code, times, pid, byte counts, ...),
+so a row costs about a hundred bytes and the instance can be garbage collected. Hosts, commands and errors are
+interned, and outputs are de-duplicated by their SHA-1: 100,000 hosts printing the same "OK\\n" store it once.
+
+The store is exported with to_dataframe() (one pandas.DataFrame, strings as categoricals) or streamed row by row to a
+JSON-lines file with to_jsonl().
+
+For more information:
+    * import robutils.ResultStore; help(robutils.ResultStore)
+    * import robutils.ExternalCmdPool; help(robutils.ExternalCmdPool)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['ResultStore',]
+
+
+import json, array, hashlib, threading
+import numpy # http://www.numpy.org/
+import pandas # http://pandas.pydata.org/
+try:
+    from shlex import quote # Python 3.3+.
+except ImportError:
+    from pipes import quote
+
+
+NUMBERS = [ # Column name, array type code, ExternalCmd attribute (or function of the instance).
+    ('code', 'd', 'code'), # Float so a missing exit code (command never ran) can be NaN.
+    ('pid', 'l', 'pid'),
+    ('start_time', 'd', 'start_time'),
+    ('end_time', 'd', 'end_time'),
+    ('stdout_size', 'l', 'stdout_size'),
+    ('stderr_size', 'l', 'stderr_size'),
+    ('stdout_lines', 'l', 'stdout_lines'),
+    ('stderr_lines', 'l', 'stderr_lines'),
+    ('cpu_time', 'd', lambda cmd: cmd.resources.cpu_time if cmd.resources else None),
+    ('max_rss', 'l', lambda cmd: cmd.resources.max_rss if cmd.resources else None),
+]
+STRINGS = ['host', 'command', 'error', 'stdout', 'stderr'] # Columns holding indexes into an InternTable.
+
+
+def _numpy(column):
+    """Returns a copy of an array.array as a numpy array of the same type, without going through Python objects."""
+    dtype = numpy.float64 if column.typecode == 'd' else numpy.dtype('i{0}'.format(column.itemsize))
+    if not len(column): return numpy.array([], dtype=dtype)
+    return numpy.frombuffer(column, dtype=dtype).copy()
+
+
+class InternTable:
+    """
+    This class isn't designed to be used manually!
+    Keeps one copy of each distinct value, values are referred to by their index. Outputs are looked up by their SHA-1
+    instead of the value itself, so the dict doesn't hold a second reference to megabytes of data.
+    """
+    
+    values = None # Distinct values, in the order they were first seen.
+    _index = None # Value (or its digest): index in values.
+    _digest = False # If True, values are looked up by their SHA-1.
+    
+    def __init__(self, digest=False):
+        self.values = []
+        self._index = {}
+        self._digest = digest
+        return None
+    
+    def add(self, value):
+        """Returns the index of value, adding it if it's new. None is always -1."""
+        if value is None: return -1
+        if self._digest: key = hashlib.sha1(value if isinstance(value, bytes) else value.encode('utf-8')).digest()
+        else: key = value
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = len(self.values)
+            self.values.append(value)
+        return index
+    
+    def get(self, index):
+        return None if index < 0 else self.values[index]
+
+
+class ResultStore:
+    """
+    Columnar store of finished ExternalCmd results. Each add() appends one row; numeric fields go in array.array
+    columns, string fields (host, command, error, stdout, stderr) in interned tables referenced by index. Missing
+    numbers (e.g. the pid of a remote command, the code of one which never ran) are NaN in float columns and 0 in
+    integer ones.
+    
+    collect() adds a command automatically once it's done, so batches don't have to keep their ExternalCmd instances:
+    ExternalCmdPool drops its reference when a command finishes, and the store keeps only the row.
+    
+    Outputs longer than max_output bytes (and outputs spilled to disk, see ExternalCmd's spill_threshold) are not
+    stored, their sizes still are. Set keep_output to False to store no output at all.
+    
+    Examples
+    --------
+    >>> store = ResultStore()
+    >>> pool = ExternalCmdPool(max_in_flight=64, timeout=30)
+    >>> for host in hosts:
+    ...     cmd = ExternalCmd('rpm -q openssl')
+    ...     store.collect(cmd, host=host)
+    ...     pool.submit(cmd, host=host, user='root')
+    ...
+    >>> pool.join()
+    True
+    >>> len(store), len(store.stdouts.values)
+    (100000, 3)
+    >>> store[0]
+    {'host': 'server1', 'command': 'rpm -q openssl', 'code': 0, 'pid': None, 'start_time': 1353398123.5, ...}
+    >>> df = store.to_dataframe()
+    >>> df.groupby('stdout').size()
+    stdout
+    openssl-1.0.0-20.el6_2.5.x86_64\\n    41877
+    openssl-1.0.0-25.el6_3.1.x86_64\\n    58122
+    package openssl is not installed\\n       1
+    >>> store.to_jsonl('/tmp/results.jsonl')
+    >>>
+    """
+    
+    keep_output = True # Store stdout and stderr.
+    max_output = 1048576 # Outputs longer than this many bytes aren't stored, only their sizes.
+    columns = None # Column name: array.array, one item per row.
+    hosts = None # InternTable of host names, the host column indexes it.
+    commands = None # InternTable of commands (lists are joined with shell quoting).
+    errors = None # InternTable of ssh_error/error strings.
+    stdouts = None # InternTable of stdout contents, de-duplicated by SHA-1.
+    stderrs = None # Same for stderr.
+    _lock = None # threading.Lock guarding all of the above, collect() adds rows from background threads.
+    
+    def __init__(self, keep_output=True, max_output=1048576):
+        """
+        Creates a new, empty store.
+        
+        Parameters
+        ----------
+        keep_output : bool, default True
+            Store stdout and stderr (de-duplicated). If False only their sizes and line counts are stored.
+        max_output : integer, default 1048576
+            Outputs longer than this many bytes aren't stored.
+        """
+        self.keep_output = keep_output
+        self.max_output = max_output
+        self.columns = dict([(name, array.array(code)) for name, code, attr in NUMBERS] +
+                            [(name, array.array('l')) for name in STRINGS])
+        self.hosts = InternTable()
+        self.commands = InternTable()
+        self.errors = InternTable()
+        self.stdouts = InternTable(digest=True)
+        self.stderrs = InternTable(digest=True)
+        self._lock = threading.Lock()
+        return None
+    
+    def __len__(self):
+        return len(self.columns['code'])
+    
+    def __getitem__(self, index):
+        """Returns one row as a dict, see row()."""
+        return self.row(index)
+    
+    def __iter__(self):
+        for index in range(len(self)): yield self.row(index)
+    
+    def _output(self, value):
+        if not self.keep_output or value is None or not isinstance(value, (bytes, str)): return None # MappedOutput.
+        return value if len(value) <= self.max_output else None
+    
+    def add(self, cmd, host=None):
+        """
+        Appends the results of a command. The instance isn't referenced afterwards.
+        
+        Parameters
+        ----------
+        cmd : robutils.ExternalCmd.ExternalCmd
+            The command, usually done. Fields which aren't set yet are stored as missing.
+        host : string, default None
+            Host the command ran on, None for local commands.
+        """
+        command = cmd.command if not isinstance(cmd.command, list) else ' '.join(quote(a) for a in cmd.command)
+        error = cmd.ssh_error if cmd.ssh_error is not None else cmd.error
+        with self._lock:
+            for name, code, attr in NUMBERS:
+                value = attr(cmd) if callable(attr) else getattr(cmd, attr)
+                if value is None: value = float('nan') if code == 'd' else 0
+                self.columns[name].append(value)
+            self.columns['host'].append(self.hosts.add(host))
+            self.columns['command'].append(self.commands.add(command))
+            self.columns['error'].append(self.errors.add(error))
+            self.columns['stdout'].append(self.stdouts.add(self._output(cmd.stdout)))
+            self.columns['stderr'].append(self.stderrs.add(self._output(cmd.stderr)))
+        return None
+    
+    def collect(self, cmd, host=None):
+        """
+        Adds a command to the store once it's done (from the background thread which finished it). Call it before the
+        command is started.
+        
+        Parameters
+        ----------
+        cmd : robutils.ExternalCmd.ExternalCmd
+            The command, not started yet.
+        host : string, default None
+            Host the command will run on, None for local commands.
+        """
+        cmd._done_callbacks.append(lambda cmd: self.add(cmd, host))
+        return None
+    
+    def row(self, index):
+        """
+        Returns one row.
+        
+        Parameters
+        ----------
+        index : integer
+            Row number, in the order commands were added. Negative numbers count from the end.
+        
+        Returns
+        -------
+        dict : Column name: value, missing values are None.
+        """
+        with self._lock:
+            row = {}
+            for name, code, attr in NUMBERS:
+                value = self.columns[name][index]
+                row[name] = None if value != value else value # NaN.
+            if row['code'] is not None: row['code'] = int(row['code'])
+            if not row['pid']: row['pid'] = None
+            row['host'] = self.hosts.get(self.columns['host'][index])
+            row['command'] = self.commands.get(self.columns['command'][index])
+            row['error'] = self.errors.get(self.columns['error'][index])
+            row['stdout'] = self.stdouts.get(self.columns['stdout'][index])
+            row['stderr'] = self.stderrs.get(self.columns['stderr'][index])
+        return row
+    
+    def to_dataframe(self, outputs=True):
+        """
+        Returns every row as a pandas.DataFrame. Numeric columns are copied from the arrays into numpy arrays, string
+        columns become pandas.Categorical columns so each distinct string is held once (object columns before pandas
+        0.15). A duration column (end_time - start_time) is added.
+        
+        Parameters
+        ----------
+        outputs : bool, default True
+            Include the stdout and stderr columns.
+        """
+        with self._lock:
+            data = {}
+            for name, code, attr in NUMBERS: data[name] = _numpy(self.columns[name])
+            tables = [('host', self.hosts), ('command', self.commands), ('error', self.errors)]
+            if outputs: tables += [('stdout', self.stdouts), ('stderr', self.stderrs)]
+            for name, table in tables:
+                codes = _numpy(self.columns[name])
+                if hasattr(pandas.Categorical, 'from_codes'): # pandas >= 0.15.
+                    data[name] = pandas.Categorical.from_codes(codes, categories=list(table.values))
+                else:
+                    values = numpy.empty(len(table.values) + 1, dtype=object) # Last one stays None, for code -1.
+                    values[:-1] = table.values
+                    data[name] = values[codes]
+        df = pandas.DataFrame(data, columns=['host', 'command'] + [n for n, c, a in NUMBERS] +
+                              ['error'] + (['stdout', 'stderr'] if outputs else []))
+        df['duration'] = df['end_time'] - df['start_time']
+        return df
+    
+    def to_jsonl(self, destination, outputs=True):
+        """
+        Writes every row as one JSON object per line, one row at a time. Outputs are decoded as UTF-8 (invalid bytes
+        replaced).
+        
+        Parameters
+        ----------
+        destination : string or file object
+            File name to write to (overwritten), or an open file object.
+        outputs : bool, default True
+            Include stdout and stderr.
+        """
+        if not hasattr(destination, 'write'):
+            with open(destination, 'w') as handle: return self.to_jsonl(handle, outputs)
+        for index in range(len(self)):
+            row = self.row(index)
+            for name in ('stdout', 'stderr'):
+                if not outputs: del row[name]
+                elif isinstance(row[name], bytes): row[name] = row[name].decode('utf-8', 'replace')
+            destination.write(json.dumps(row, sort_keys=True) + '\n')
+        return None
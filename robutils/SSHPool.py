@@ -0,0 +1,275 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Keeps authenticated SSH connections (paramiko) open so many commands can share one handshake.
+
+SSHPool provides the SSHPool class which hands out session channels on already authenticated paramiko Transports,
+grouped by (host, port, user, key). ExternalCmd.run_remote() uses the module's default_pool instance, so running dozens
+of commands on the same host costs one TCP connection and key exchange instead of one per command.
+
+As with ExternalCmd, when this module is imported the function close_pool_on_exit() is registered with atexit so pooled
+connections are closed cleanly when the main Python thread exits.
+
+For more information:
+    * import robutils.SSHPool; help(robutils.SSHPool)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd.ExternalCmd.run_remote)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['SSHPool', 'default_pool',]
+
+
+import socket, threading, atexit
+import paramiko # https://github.com/paramiko/paramiko
+from robutils.Clock import monotonic
+from robutils.KeyCache import default_cache
+
+
+class PooledConnection:
+    """
+    This class isn't designed to be used manually!
+    One authenticated SSH connection owned by SSHPool, along with its bookkeeping.
+    """
+    
+    client = None # paramiko.SSHClient instance, client.get_transport() is the shared Transport.
+    channels = 0 # Number of session channels currently open on this connection.
+    max_channels = 0 # Lowered if the server refuses to open more sessions (sshd's MaxSessions).
+    last_used = 0 # monotonic() when the last channel was released (or the connection was opened).
+    
+    def __init__(self, client, max_channels):
+        self.client = client
+        self.max_channels = max_channels
+        self.last_used = monotonic()
+        return None
+    
+    def usable(self):
+        """True if the connection is alive and has room for another channel."""
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active() and self.channels < self.max_channels
+
+
+class SSHPool:
+    """
+    Pool of authenticated SSH connections keyed by (host, port, user, key). open_session() returns a new session
+    channel on an existing connection if one has room, otherwise it connects (once, even if many threads ask for the
+    same host at the same time). release() must be called with every channel once it is done.
+    
+    Idle connections are closed lazily (the next time the pool is used) after idle_timeout seconds, and dead ones are
+    dropped. Keepalives are sent every keepalive seconds so firewalls don't silently drop idle connections.
+    
+    Examples
+    --------
+    >>> pool = SSHPool(max_channels=4, idle_timeout=30)
+    >>> channel = pool.open_session('server1', user='root')
+    >>> channel.exec_command('uname -r')
+    >>> channel.recv_exit_status()
+    0
+    >>> pool.release(channel)
+    >>> cmd = ExternalCmd('uname -r')
+    >>> cmd.run_remote('server1', user='root', pool=pool) # Reuses the connection above.
+    >>>
+    """
+    
+    max_channels = 8 # Session channels per connection. OpenSSH allows 10 by default (MaxSessions).
+    idle_timeout = 60 # Close connections without open channels after this many seconds.
+    keepalive = 30 # Seconds between keepalive packets, 0 disables them.
+    default_keys = ('~/.ssh/id_rsa', '~/.ssh/id_ecdsa', '~/.ssh/id_ed25519', '~/.ssh/id_dsa') # Used if key is None.
+    _pool = None # (host, port, user, key): list of PooledConnection instances.
+    _connecting = None # Set of keys with a connection being established.
+    _channels = None # Channel: PooledConnection instance it was opened on.
+    _cond = None # threading.Condition guarding all of the above.
+    
+    def __init__(self, max_channels=8, idle_timeout=60, keepalive=30):
+        """
+        Creates a new, empty pool.
+        
+        Parameters
+        ----------
+        max_channels : integer, default 8
+            Maximum number of session channels open at the same time on one connection. More connections to the same
+            host are opened when all existing ones are full.
+        idle_timeout : integer, default 60
+            Connections without open channels are closed after this many seconds.
+        keepalive : integer, default 30
+            Seconds between SSH keepalive packets on each connection. 0 disables keepalives.
+        """
+        self.max_channels = max(int(max_channels), 1)
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._pool = {}
+        self._connecting = set()
+        self._channels = {}
+        self._cond = threading.Condition()
+        return None
+    
+    def _evict(self):
+        """Removes dead and idle connections from the pool and returns them. Must be called with _cond acquired."""
+        stale = []
+        now = monotonic()
+        for key, conns in list(self._pool.items()): # Keys are deleted in the loop.
+            for conn in list(conns):
+                transport = conn.client.get_transport()
+                if conn.channels: continue
+                if transport is None or not transport.is_active() or not conn.max_channels or \
+                        now - conn.last_used >= self.idle_timeout:
+                    conns.remove(conn)
+                    stale.append(conn)
+            if not conns: del self._pool[key]
+        return stale
+    
+    def _connect(self, host, port, user, key, timeout):
+        client = paramiko.SSHClient()
+        default_cache.add_host_keys(client, host, port) # Instead of load_system_host_keys(), see robutils.KeyCache.
+        # Try the first key from the cache (paramiko parses key files on every connect), the others as usual.
+        paths = list(key) if isinstance(key, (list, tuple)) else [key] if key else []
+        pkey = None
+        for path in paths or self.default_keys:
+            pkey = default_cache.private_key(path)
+            if pkey is not None: break
+        if pkey is not None and paths: paths.remove(path)
+        try:
+            client.connect(host, port, user, pkey=pkey, key_filename=paths or None, timeout=timeout) # Authenticate.
+        except:
+            client.close()
+            raise
+        if self.keepalive: client.get_transport().set_keepalive(self.keepalive)
+        try:
+            # Commands are small request/reply exchanges, don't let Nagle hold them back (OpenSSH does the same).
+            client.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, EnvironmentError):
+            pass # Not a TCP socket (e.g. a ProxyCommand).
+        return PooledConnection(client, self.max_channels)
+    
+    def open_session(self, host, port=22, user='', key=None, timeout=None):
+        """
+        Opens a new session channel to host, connecting first if no pooled connection has room for it.
+        
+        Parameters
+        ----------
+        host : string
+            The IP address or host name of the remote host.
+        port : integer, default 22
+            The SSH port to use.
+        user : string, default ''
+            The SSH user name to use.
+        key : string or list, default None
+            Private key file(s) to authenticate with, see paramiko.SSHClient.connect(key_filename).
+        timeout : float, default None
+            TCP connect timeout in seconds when a new connection has to be opened.
+        
+        Returns
+        -------
+        paramiko.Channel : A new session channel. Pass it to release() when done.
+        
+        Raises
+        ------
+        paramiko.SSHException, EnvironmentError : If connecting, authenticating or opening the channel fails.
+        """
+        pool_key = (host, port, user, tuple(key) if isinstance(key, list) else key)
+        for attempt in range(2):
+            conn = None
+            stale = []
+            with self._cond:
+                while True:
+                    stale.extend(self._evict())
+                    conn = ([c for c in self._pool.get(pool_key, []) if c.usable()] or [None])[0]
+                    if conn or pool_key not in self._connecting: break
+                    self._cond.wait() # Another thread is connecting to the same host, it may have room for us.
+                if conn: conn.channels += 1
+                else: self._connecting.add(pool_key)
+            for old in stale: old.client.close()
+            if not conn:
+                try:
+                    conn = self._connect(host, port, user, key, timeout)
+                    conn.channels += 1
+                finally:
+                    with self._cond:
+                        self._connecting.discard(pool_key)
+                        if conn: self._pool.setdefault(pool_key, []).append(conn)
+                        self._cond.notify_all()
+            try:
+                channel = conn.client.get_transport().open_session()
+            except paramiko.ChannelException:
+                # The server refuses more sessions on this connection (MaxSessions), open another one next time.
+                with self._cond:
+                    conn.channels -= 1
+                    conn.max_channels = conn.channels
+                    self._cond.notify_all()
+                if attempt: raise
+                continue
+            except:
+                with self._cond:
+                    conn.channels -= 1
+                    self._cond.notify_all()
+                raise
+            with self._cond: self._channels[channel] = conn
+            return channel
+    
+    def open_sftp(self, host, port=22, user='', key=None, timeout=None):
+        """
+        Opens an SFTP session on a pooled connection, see open_session() for the parameters.
+        
+        Returns
+        -------
+        paramiko.SFTPClient : A new SFTP client. Pass sftp.get_channel() to release() when done.
+        
+        Raises
+        ------
+        paramiko.SSHException, EnvironmentError : If connecting, authenticating or starting the subsystem fails.
+        """
+        channel = self.open_session(host, port, user, key, timeout)
+        try:
+            channel.invoke_subsystem('sftp')
+            return paramiko.SFTPClient(channel)
+        except:
+            self.release(channel)
+            raise
+    
+    def release(self, channel):
+        """
+        Closes a channel returned by open_session() and gives its slot back to the pool.
+        
+        Parameters
+        ----------
+        channel : paramiko.Channel
+        """
+        channel.close()
+        with self._cond:
+            conn = self._channels.pop(channel, None)
+            if conn:
+                conn.channels -= 1
+                conn.last_used = monotonic()
+            stale = self._evict()
+            self._cond.notify_all()
+        for old in stale: old.client.close()
+        return None
+    
+    def close(self):
+        """Closes every pooled connection, including ones with open channels."""
+        with self._cond:
+            conns = [c for conns in self._pool.values() for c in conns]
+            self._pool.clear()
+            self._channels.clear()
+        for conn in conns: conn.client.close()
+        return None
+
+
+default_pool = SSHPool() # Used by ExternalCmd.run_remote() unless another pool is given.
+
+
+@atexit.register
+def close_pool_on_exit():
+    """
+    This function isn't designed to be run manually!
+    When SSHPool is imported, this function will automatically be added to atexit. It closes all connections held by
+    default_pool so the remote sshd sees a clean disconnect.
+    """
+    default_pool.close()
+    return None
@@ -0,0 +1,293 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Runs external commands periodically, locally or on many hosts, and reports only the runs whose output changed.
+
+Polling loops ("while True: run it on every host; sleep 60") drift by however long each round took, start a new round
+while the slowest hosts are still busy with the previous one, and hand identical output downstream over and over.
+Scheduler provides the Scheduler class: every command/host pair runs on a fixed grid (start + n * interval, so run
+time never accumulates), with a random offset to spread hosts out, never more than once at a time, and with at most
+max_in_flight commands running overall (robutils.ExternalCmdPool). Each result is reduced to a SHA-1 of its exit code
+and stdout, and the on_change callback is only called when that changes: a fleet in steady state costs one hash
+comparison per run.
+
+For more information:
+    * import robutils.Scheduler; help(robutils.Scheduler)
+    * import robutils.ExternalCmdPool; help(robutils.ExternalCmdPool)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Scheduler', 'digest',]
+
+
+import heapq, random, hashlib, threading, traceback
+from robutils.ExternalCmd import ExternalCmd, Supervisor, monotonic
+from robutils.ExternalCmdPool import ExternalCmdPool
+
+
+def digest(cmd):
+    """
+    Returns the SHA-1 digest of what a run produced: its exit code, stdout and ssh_error/error. stderr is left out, it
+    tends to hold warnings and timestamps. This is the default compare function of Scheduler.add().
+    
+    Parameters
+    ----------
+    cmd : robutils.ExternalCmd.ExternalCmd
+        A command which is done.
+    """
+    sha = hashlib.sha1(repr((cmd.code, cmd.ssh_error, cmd.error)).encode('utf-8'))
+    if cmd.stdout is not None: sha.update(cmd.stdout.view() if hasattr(cmd.stdout, 'view') else cmd.stdout)
+    return sha.digest()
+
+
+class Job:
+    """
+    This class isn't designed to be used manually!
+    One periodic command, returned by Scheduler.add(). Its members hold the latest state of every host.
+    """
+    
+    command = None # Command to run, see robutils.ExternalCmd.ExternalCmd.
+    interval = None # Seconds between two runs on the same host.
+    hosts = None # List of hosts, [None] for a local command.
+    jitter = 0 # Each run starts up to this many seconds after its slot on the grid.
+    timeout = 0 # Timeout of each run.
+    compare = None # Function returning what is compared to detect changes, digest() by default.
+    on_change = None # Callback function, see Scheduler.add().
+    kwargs = None # Passed to run_local()/run_remote().
+    results = None # Host: ExternalCmd instance of its latest finished run.
+    keys = None # Host: what compare() returned for its latest finished run.
+    runs = 0 # Number of runs started.
+    changes = 0 # Number of runs whose compare() value differed from the host's previous one (first runs count).
+    skipped = 0 # Number of slots skipped because the host's previous run wasn't done yet.
+    removed = False # True once Scheduler.remove() was called.
+    _running = None # Host: ExternalCmd instance of the run in flight.
+    _anchor = None # Host: monotonic() time of slot 0.
+    
+    def __init__(self, command, interval, hosts, jitter, timeout, compare, on_change, kwargs):
+        self.command = command
+        self.interval = interval
+        self.hosts = []
+        for host in hosts or [None]:
+            if host not in self.hosts: self.hosts.append(host)
+        self.jitter = min(jitter, interval)
+        self.timeout = timeout
+        self.compare = compare or digest
+        self.on_change = on_change
+        self.kwargs = kwargs
+        self.results = {}
+        self.keys = {}
+        self._running = {}
+        self._anchor = {}
+        return None
+
+
+class Scheduler(threading.Thread):
+    """
+    Runs commands periodically in a background thread until stop() is called. Each host of each job has its own
+    schedule: slot n is at start + n * interval, and the run of slot n starts at a random time between the slot and
+    jitter seconds after it (the same random offset for every slot of a host, so the interval between two runs of a host
+    stays interval, and hosts are spread over the jitter window). A slot whose time has come while the host's previous
+    run is still queued or running is skipped (counted in Job.skipped), runs of one host never overlap.
+    
+    When a run is done, job.compare(cmd) is compared with the host's previous one. If it differs (or it's the host's
+    first run) Job.results/Job.keys are updated and on_change(host, cmd) is called. Otherwise only Job.results is
+    updated.
+    Callbacks run in the background thread which finished the command, so they should return quickly.
+    
+    Examples
+    --------
+    >>> def changed(host, cmd):
+    ...     print host, cmd.code, cmd.stdout.strip()
+    ...
+    >>> scheduler = Scheduler(max_in_flight=64)
+    >>> job = scheduler.add('cat /proc/loadavg | cut -d" " -f1', 60, hosts=hosts, jitter=30, timeout=20, user='root',
+    ...                     on_change=changed)
+    >>> scheduler.start()
+    server1 0 0.08
+    server2 0 1.52
+    >>> time.sleep(600)
+    server2 0 1.49
+    >>> scheduler.stop()
+    True
+    >>> (job.runs, job.changes, job.skipped)
+    (22, 3, 0)
+    >>>
+    """
+    
+    _interrupt = False # See robutils/__init__.py: signal_threads_shutdown_imminent
+    max_in_flight = 32 # Maximum number of commands running at the same time, all jobs included.
+    jobs = None # Job instances, in the order they were added.
+    _pool = None # ExternalCmdPool instance running the commands.
+    _timers = None # Heap of (time, sequence, Job instance, host, slot number).
+    _sequence = 0 # Tie breaker for the heap.
+    _stopped = False # True once stop() was called.
+    _cond = None # threading.Condition guarding all of the above, notified when a timer is added or on stop().
+    
+    def __init__(self, max_in_flight=32):
+        """
+        Creates a new scheduler without any jobs. Nothing runs until start() is called.
+        
+        Parameters
+        ----------
+        max_in_flight : integer, default 32
+            Maximum number of commands running at the same time, across all jobs and hosts. Runs waiting for a free
+            slot count as running for their host (its next slot is skipped if they're still waiting by then).
+        """
+        super(Scheduler, self).__init__()
+        self.name = 'robutils.Scheduler.Scheduler' # Used by signal_threads_shutdown_imminent.
+        self.daemon = True
+        self.max_in_flight = max_in_flight
+        self.jobs = []
+        self._pool = ExternalCmdPool(max_in_flight)
+        self._timers = []
+        self._cond = threading.Condition()
+        return None
+    
+    def _schedule(self, job, host, slot):
+        """Adds the timer of a host's slot. Must be called with _cond acquired."""
+        self._sequence += 1
+        heapq.heappush(self._timers, (job._anchor[host] + slot * job.interval, self._sequence, job, host, slot))
+        self._cond.notify_all()
+        return None
+    
+    def add(self, command, interval, hosts=None, jitter=0, timeout=0, compare=None, on_change=None, **kwargs):
+        """
+        Adds a periodic command. Can be called before or after start(), the first runs are due right away (within
+        jitter seconds).
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to run, see robutils.ExternalCmd.ExternalCmd.
+        interval : float
+            Seconds between the starts of two runs on the same host.
+        hosts : list, default None
+            Hosts to run the command on with run_remote(). The command runs locally (once per interval) if None.
+        jitter : float, default 0
+            Each host's runs start at a random offset of up to this many seconds (at most interval) into their slots.
+        timeout : integer, default 0
+            Timeout of each run in seconds, see ExternalCmd. Keep it below interval or slots will be skipped.
+        compare : function, default None
+            Called with each finished ExternalCmd instance, returns what is compared to detect a change. digest() if
+            None. E.g. lambda cmd: cmd.code to only report hosts whose exit code changed.
+        on_change : function, default None
+            Called as on_change(host, cmd) after a run whose compare() value differs from the previous run on the
+            same host. host is None for local commands.
+        **kwargs : Passed on to ExternalCmd.run_remote() (user, key, port, pool) or run_local() (cwd, env, limits).
+        
+        Returns
+        -------
+        Job : The job, holding the latest results of each host.
+        
+        Raises
+        ------
+        ValueError : If interval isn't greater than 0.
+        """
+        if not interval > 0: raise ValueError('interval must be greater than 0.') # 0 would run it in a busy loop.
+        job = Job(command, interval, hosts, jitter, timeout, compare, on_change, kwargs)
+        now = monotonic()
+        with self._cond:
+            self.jobs.append(job)
+            for host in job.hosts:
+                job._anchor[host] = now + random.uniform(0, job.jitter)
+                self._schedule(job, host, 0)
+        return job
+    
+    def remove(self, job, terminate=False):
+        """
+        Stops running a job. Its runs in flight are left alone (their results still update the job, without calling
+        on_change) unless terminate is True.
+        
+        Parameters
+        ----------
+        job : Job
+            The job returned by add().
+        terminate : bool, default False
+            Terminate the job's runs in flight, like their timeout would.
+        """
+        with self._cond:
+            job.removed = True
+            if job in self.jobs: self.jobs.remove(job)
+            running = list(job._running.values())
+        if terminate:
+            for cmd in running: Supervisor.terminate(cmd)
+        return None
+    
+    def _run(self, job, host, slot):
+        """Starts the run of a host's slot unless the previous one is still in flight, then schedules the next slot."""
+        now = monotonic()
+        with self._cond:
+            # Catch up without running a slot twice if this thread was late, e.g. the machine was suspended.
+            next_slot = max(slot + 1, int((now - job._anchor[host]) // job.interval) + 1)
+            self._schedule(job, host, next_slot)
+            if host in job._running:
+                job.skipped += 1
+                return None
+            cmd = ExternalCmd(job.command, job.timeout)
+            job._running[host] = cmd
+            job.runs += 1
+        cmd._done_callbacks.append(lambda cmd: self._collect(job, host, cmd))
+        self._pool.submit(cmd, host=host, **job.kwargs)
+        return None
+    
+    def _collect(self, job, host, cmd):
+        """Done callback of every run."""
+        try:
+            key = job.compare(cmd)
+        except Exception:
+            traceback.print_exc() # Broken compare function, report the run as a change.
+            key = object()
+        with self._cond:
+            del job._running[host]
+            changed = host not in job.keys or job.keys[host] != key
+            job.results[host] = cmd
+            if changed:
+                job.keys[host] = key
+                job.changes += 1
+        if changed and job.on_change and not job.removed and not self._stopped:
+            try: job.on_change(host, cmd)
+            except Exception: traceback.print_exc() # Don't let a broken callback take down the background thread.
+        return None
+    
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._interrupt:
+                    delay = self._timers[0][0] - monotonic() if self._timers else None
+                    if delay is not None and delay <= 0: break
+                    self._cond.wait(1 if delay is None else min(delay, 1)) # Wake up every second to check _interrupt.
+                if self._stopped or self._interrupt: return None
+                when, sequence, job, host, slot = heapq.heappop(self._timers)
+            if not job.removed: self._run(job, host, slot)
+        return None
+    
+    def stop(self, terminate=False, timeout=None):
+        """
+        Stops scheduling runs and waits for the runs in flight to finish.
+        
+        Parameters
+        ----------
+        terminate : bool, default False
+            Terminate the runs in flight instead of letting them finish.
+        timeout : float, default None
+            Maximum number of seconds to wait for the runs in flight. Waits forever if None.
+        
+        Returns
+        -------
+        boolean : True if no run is in flight anymore, False if timeout was reached first.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self: self.join() # No new runs after this.
+        if terminate:
+            with self._cond: running = [cmd for job in self.jobs for cmd in job._running.values()]
+            for cmd in running: Supervisor.terminate(cmd)
+        return self._pool.join(timeout)
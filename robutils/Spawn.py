@@ -0,0 +1,182 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Starts local processes with posix_spawn() instead of fork() + exec() (Linux/glibc, through ctypes).
+
+subprocess.Popen forks the Python process before executing the command. fork() copies the page tables of the whole
+address space, so a process holding gigabytes of data (e.g. pandas DataFrames) takes milliseconds to start each
+command, and the copy grows with its memory. glibc's posix_spawn() uses clone(CLONE_VM | CLONE_VFORK) since 2.24: the
+child shares the parent's memory until it calls exec(), so starting a command costs the same no matter how large the
+parent is.
+
+Spawn provides the SpawnedProcess class, a minimal stand-in for subprocess.Popen used by robutils.ExternalCmd when
+ExternalCmd.fast_spawn is True. Python 2.7 has no os.posix_spawn(), the C library is called directly with ctypes.
+
+For more information:
+    * import robutils.Spawn; help(robutils.Spawn)
+    * import robutils.ExternalCmd; help(robutils.ExternalCmd.ExternalCmd.fast_spawn)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['SpawnedProcess', 'supported',]
+
+
+import os, sys, errno, fcntl, signal, subprocess, ctypes, ctypes.util
+
+
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSID = 0x80 # glibc >= 2.26.
+DEFAULT_SIGNALS = ('SIGPIPE', 'SIGXFSZ') # Ignored by Python, restored in the child like Python 3's subprocess does.
+
+
+def _load():
+    """Returns the C library if it has everything needed, None otherwise (not Linux/glibc, too old)."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for name in ('posix_spawn', 'posix_spawn_file_actions_init', 'posix_spawn_file_actions_destroy',
+                     'posix_spawn_file_actions_adddup2', 'posix_spawnattr_init', 'posix_spawnattr_destroy',
+                     'posix_spawnattr_setflags', 'posix_spawnattr_setsigdefault', 'sigemptyset', 'sigaddset'):
+            getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    libc.posix_spawn.argtypes = [ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p,
+                                 ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_char_p)]
+    attr = ctypes.create_string_buffer(1024) # Opaque posix_spawnattr_t, 336 bytes on x86_64.
+    libc.posix_spawnattr_init(attr)
+    try:
+        if libc.posix_spawnattr_setflags(attr, ctypes.c_short(POSIX_SPAWN_SETSID)): return None # glibc < 2.26.
+    finally:
+        libc.posix_spawnattr_destroy(attr)
+    return libc
+
+
+_libc = _load()
+
+
+def _encode(value):
+    if isinstance(value, bytes): return value
+    return value.encode(sys.getfilesystemencoding() or 'utf-8', 'surrogateescape' if sys.version_info[0] > 2 else
+                        'strict')
+
+
+def _which(name, env):
+    """Returns the path of the executable like execvpe() would find it, using the PATH of the command's environment."""
+    if os.sep in name: return name
+    for directory in (env if env is not None else os.environ).get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory or os.curdir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK): return path
+    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+
+def _pipe():
+    """Returns (read fd, write fd) of a new close-on-exec pipe. dup2() clears the flag on the child's copy."""
+    fds = os.pipe()
+    for fd in fds: fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fds
+
+
+def supported(cwd=None):
+    """
+    Returns True if SpawnedProcess can be used on this system, for a command running in cwd.
+    
+    Parameters
+    ----------
+    cwd : string, default None
+        The working directory the command needs, changing it requires glibc >= 2.29.
+    """
+    if _libc is None: return False
+    return not cwd or hasattr(_libc, 'posix_spawn_file_actions_addchdir_np')
+
+
+class SpawnedProcess:
+    """
+    This class isn't designed to be used manually!
+    Local process started with posix_spawn(). Has the subset of subprocess.Popen's interface robutils.ExternalCmd
+    uses: pid, stdout, stderr, returncode and poll(). command, cwd and env have the same meaning as for Popen (a string
+    runs in /bin/sh, a list doesn't). The child starts in a new session (like Popen with preexec_fn=os.setsid) with
+    SIGPIPE and SIGXFSZ set back to their default actions.
+    """
+    
+    pid = None
+    stdin = None # File object of the write end of the stdin pipe, None unless stdin was subprocess.PIPE.
+    stdout = None # File object of the read end of the stdout pipe, None unless stdout was subprocess.PIPE.
+    stderr = None # Same for stderr.
+    returncode = None # Set by poll() or by whoever reaped the process (e.g. robutils.ExternalCmd.Supervisor).
+    
+    def __init__(self, command, cwd=None, env=None, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+        """
+        Starts the process.
+        
+        Parameters
+        ----------
+        command : list or string
+            The command to execute, see robutils.ExternalCmd.ExternalCmd.
+        cwd : string, default None
+            Working directory of the process, see supported().
+        env : dict, default None
+            Environment of the process, this process' environment if None.
+        stdin : integer, default None
+            File descriptor to use as stdin, subprocess.PIPE to write to it through a new pipe, or None for this
+            process' stdin.
+        stdout : integer, default subprocess.PIPE
+            subprocess.PIPE to read stdout through a new pipe, a file descriptor, or None for this process' stdout.
+        stderr : integer, default subprocess.PIPE
+            Same as stdout.
+        """
+        args = list(command) if isinstance(command, list) else ['/bin/sh', '-c', command]
+        path = _encode(_which(args[0], env))
+        argv = (ctypes.c_char_p * (len(args) + 1))(*([_encode(a) for a in args] + [None]))
+        environ = os.environ if env is None else env
+        envp = (ctypes.c_char_p * (len(environ) + 1))(*([_encode(k) + b'=' + _encode(v) for k, v in environ.items()] +
+                                                       [None]))
+        actions = ctypes.create_string_buffer(1024) # Opaque posix_spawn_file_actions_t, 80 bytes on x86_64.
+        attr = ctypes.create_string_buffer(1024)
+        sigset = ctypes.create_string_buffer(1024) # sigset_t, 128 bytes.
+        pipes = {} # Stream: (read fd, write fd) of the pipes created here.
+        _libc.posix_spawn_file_actions_init(actions)
+        _libc.posix_spawnattr_init(attr)
+        try:
+            for target, stream, value in ((0, 'stdin', stdin), (1, 'stdout', stdout), (2, 'stderr', stderr)):
+                if value == subprocess.PIPE:
+                    pipes[stream] = _pipe()
+                    value = pipes[stream][0 if stream == 'stdin' else 1] # The child's end.
+                if value is not None and value != target: _libc.posix_spawn_file_actions_adddup2(actions, value, target)
+            if cwd: _libc.posix_spawn_file_actions_addchdir_np(actions, _encode(cwd))
+            _libc.sigemptyset(sigset)
+            for name in DEFAULT_SIGNALS: _libc.sigaddset(sigset, getattr(signal, name))
+            _libc.posix_spawnattr_setsigdefault(attr, sigset)
+            _libc.posix_spawnattr_setflags(attr, ctypes.c_short(POSIX_SPAWN_SETSID | POSIX_SPAWN_SETSIGDEF))
+            pid = ctypes.c_int()
+            error = _libc.posix_spawn(ctypes.byref(pid), path, actions, attr, argv, envp)
+            if error: raise OSError(error, os.strerror(error), args[0])
+        except:
+            for fds in pipes.values():
+                for fd in fds: os.close(fd)
+            raise
+        finally:
+            _libc.posix_spawn_file_actions_destroy(actions)
+            _libc.posix_spawnattr_destroy(attr)
+        self.pid = pid.value
+        for stream, (read_fd, write_fd) in pipes.items():
+            if stream == 'stdin': read_fd, write_fd = write_fd, read_fd
+            os.close(write_fd) # The child has its own copy.
+            setattr(self, stream, os.fdopen(read_fd, 'wb' if stream == 'stdin' else 'rb', 0))
+        return None
+    
+    def poll(self):
+        """Returns the exit code (negative signal number if killed) if the process has exited, None otherwise."""
+        if self.returncode is not None: return self.returncode
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno != errno.ECHILD: raise
+            pid, status = self.pid, 0 # Reaped by someone else, the exit status is lost. Same as subprocess.
+        if pid: self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return self.returncode
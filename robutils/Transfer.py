@@ -0,0 +1,373 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""
+Copies files to and from remote hosts on the same authenticated SSH connections used by ExternalCmd.run_remote().
+
+Transfer provides the Transfer class which uploads and downloads batches of files without spawning scp or logging in
+again: it borrows channels from robutils.SSHPool like run_remote() does. Large files go over SFTP with pipelined writes
+and prefetched reads, several at once, and resume where a previous partial transfer stopped. Small files are packed
+into a single tar stream over one channel, so a batch of hundreds of scripts costs about one round trip instead of
+several per file.
+
+The remote host needs tar (GNU or BSD) for the small file batches. If tar fails the files are sent over SFTP instead.
+
+For more information:
+    * import robutils.Transfer; help(robutils.Transfer)
+    * import robutils.SSHPool; help(robutils.SSHPool)
+"""
+
+
+__author__ = 'Robpol86 (http://robpol86.com)'
+__copyright__ = 'Copyright 2012, Robpol86'
+__license__ = 'MIT'
+__all__ = ['Transfer',]
+
+
+import os, stat, posixpath, tarfile, threading, collections, traceback
+import psutil # http://code.google.com/p/psutil/
+import paramiko # https://github.com/paramiko/paramiko
+from robutils.SSHPool import default_pool
+
+
+def _quote(path):
+    """Quotes a path for the remote shell."""
+    return "'{0}'".format(path.replace("'", "'\\''"))
+
+
+class Transfer:
+    """
+    Uploads and downloads files to one remote host. upload() and download() block until the whole batch is done and
+    return a dictionary of the files which failed (source path: error string), empty if everything was copied.
+    
+    Files of at least small_file_size bytes are copied over SFTP, max_workers of them at the same time (each on its own
+    SFTP channel of the same connection). Writes are pipelined and reads prefetched, so throughput isn't bound by the
+    round trip time. If resume is True and the destination already exists but is shorter than the source, only the
+    missing part is copied (rsync --append style, the existing part isn't compared). Destinations as long as the source
+    are skipped.
+    
+    Smaller files are sent in one tar stream per batch (untar on the remote side for uploads, tar on the remote side for
+    downloads) on one exec channel, keeping their modes.
+    
+    Examples
+    --------
+    >>> transfer = Transfer('server1', user='root', on_progress=lambda path, done, total: None)
+    >>> transfer.upload([('deploy.sh', '/tmp/deploy.sh'), ('/srv/images/base.img', '/var/lib/images/base.img')])
+    {}
+    >>> ExternalCmd('/tmp/deploy.sh').run_remote('server1', user='root')
+    >>> transfer.download({'/var/log/messages': 'server1.messages', '/tmp/missing': 'missing'})
+    {'/tmp/missing': '[Errno 2] No such file'}
+    >>> (transfer.files, transfer.transferred)
+    (3, 1073783820)
+    >>>
+    """
+    
+    host = None # SSH remote hostname/IP.
+    user = None # SSH username.
+    key = None # SSH private key.
+    port = None # SSH port on the remote host.
+    pool = None # robutils.SSHPool.SSHPool instance channels are borrowed from.
+    max_workers = 4 # Maximum number of files copied over SFTP at the same time.
+    small_file_size = 65536 # Files smaller than this many bytes are batched in a tar stream.
+    resume = True # Continue partial transfers instead of starting over.
+    on_progress = None # Callback function, see __init__().
+    chunk_size = 32768 # Bytes per SFTP write, the largest request size every server accepts.
+    read_size = 1048576 # Bytes per read from a prefetched SFTP file.
+    max_batch_args = 65536 # Maximum length of the paths passed to one remote tar command when downloading.
+    files = 0 # Number of files copied (or found complete) so far.
+    transferred = 0 # Number of bytes copied so far.
+    _lock = None # threading.Lock guarding the counters.
+    
+    def __init__(self, host, user='', key=None, port=22, pool=None, max_workers=4, small_file_size=65536, resume=True,
+                 on_progress=None):
+        """
+        Prepares transfers to and from host, connections are opened (or borrowed from the pool) when needed.
+        
+        Parameters
+        ----------
+        host : string
+            The IP address or host name of the remote host.
+        user : string, default ''
+            The SSH user name to use. Uses the user name which owns this running python process by default.
+        key : string, default None
+            The SSH key to use, see ExternalCmd.run_remote().
+        port : integer, default 22
+            The SSH port to use.
+        pool : robutils.SSHPool.SSHPool, default None
+            Pool of authenticated connections to use. Uses robutils.SSHPool.default_pool if not set.
+        max_workers : integer, default 4
+            Maximum number of large files copied at the same time, each uses one SFTP channel.
+        small_file_size : integer, default 65536
+            Files smaller than this are batched in a tar stream. 0 sends everything over SFTP.
+        resume : boolean, default True
+            Only copy the missing end of destinations shorter than their source.
+        on_progress : function, default None
+            Called as on_progress(path, done, total) as files are copied, where path is the source, done the number of
+            bytes of it copied so far and total its size. Runs in background threads, so it should return quickly.
+        """
+        if not user:
+            user = psutil.Process(os.getpid()).username # If user not specified, use current user.
+            if callable(user): user = user() # psutil >= 2.0
+        self.host = host
+        self.user = user
+        self.key = key
+        self.port = port
+        self.pool = pool or default_pool
+        self.max_workers = max(int(max_workers), 1)
+        self.small_file_size = small_file_size
+        self.resume = resume
+        self.on_progress = on_progress
+        self._lock = threading.Lock()
+        return None
+    
+    def _progress(self, path, done, total, size=0, complete=False):
+        """Counts size more bytes copied (and the file if complete) and calls on_progress."""
+        with self._lock:
+            self.transferred += size
+            if complete: self.files += 1
+        if self.on_progress:
+            try: self.on_progress(path, done, total)
+            except Exception: traceback.print_exc() # Don't let a broken callback abort the transfer.
+        return None
+    
+    def _open_sftp(self):
+        return self.pool.open_sftp(self.host, self.port, self.user, self.key)
+    
+    def _exec(self, command):
+        """Runs a command on its own channel. Returns the channel, which must be given back with pool.release()."""
+        channel = self.pool.open_session(self.host, self.port, self.user, self.key)
+        try:
+            channel.exec_command(command)
+        except:
+            self.pool.release(channel)
+            raise
+        return channel
+    
+    def _workers(self, jobs, function):
+        """
+        Runs function(sftp, *job) for every job on up to max_workers threads, each with its own SFTP client. The first
+        item of each job is the source path. Returns a dictionary of source path: error string.
+        """
+        queue = collections.deque(jobs)
+        errors = {}
+        open_errors = []
+        def worker():
+            try:
+                sftp = self._open_sftp()
+            except Exception as err:
+                open_errors.append(str(err) or err.__class__.__name__) # Other workers may still get a channel.
+                return None
+            try:
+                while True:
+                    try: job = queue.popleft()
+                    except IndexError: return None
+                    try: function(sftp, *job)
+                    except Exception as err: # Reported like I/O errors, the job would be lost otherwise.
+                        errors[job[0]] = str(err) or err.__class__.__name__
+            finally:
+                self.pool.release(sftp.get_channel())
+        threads = [threading.Thread(target=worker, name='robutils.Transfer.worker')
+                   for i in range(min(self.max_workers, len(queue)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads: thread.join()
+        for job in queue: # No worker could open an SFTP channel (or they all died).
+            errors[job[0]] = open_errors[-1] if open_errors else 'No SFTP channel could be opened'
+        return errors
+    
+    def _put(self, sftp, local, remote, size):
+        """Uploads one file over SFTP, resuming if possible."""
+        offset = 0
+        if self.resume:
+            try: offset = sftp.stat(remote).st_size
+            except IOError: pass # Doesn't exist yet.
+            if offset > size: offset = 0
+        if offset == size:
+            self._progress(local, size, size, complete=True) # Nothing left to copy.
+            return None
+        with open(local, 'rb') as source:
+            target = sftp.open(remote, 'r+b' if offset else 'wb')
+            try:
+                target.set_pipelined(True) # Don't wait for each write to be acknowledged.
+                target.seek(offset)
+                source.seek(offset)
+                done = offset
+                for data in iter(lambda: source.read(self.chunk_size), b''):
+                    target.write(data)
+                    done += len(data)
+                    self._progress(local, done, size, len(data))
+            finally:
+                target.close() # Waits for the outstanding writes, raises if one of them failed.
+        if not offset: sftp.chmod(remote, stat.S_IMODE(os.stat(local).st_mode))
+        self._progress(local, done, size, complete=True)
+        return None
+    
+    def _get(self, sftp, remote, local, size):
+        """Downloads one file over SFTP, resuming if possible."""
+        offset = os.path.getsize(local) if self.resume and os.path.isfile(local) else 0
+        if offset > size: offset = 0
+        if offset == size:
+            self._progress(remote, size, size, complete=True) # Nothing left to copy.
+            return None
+        source = sftp.open(remote, 'rb')
+        try:
+            source.seek(offset)
+            try: source.prefetch(size) # Request every block at once, read() then takes them as they arrive.
+            except TypeError: source.prefetch() # paramiko < 1.16 stats the file itself.
+            with open(local, 'ab' if offset else 'wb') as target:
+                done = offset
+                while done < size:
+                    data = source.read(min(self.read_size, size - done))
+                    if not data: break # Truncated while we were reading.
+                    target.write(data)
+                    done += len(data)
+                    self._progress(remote, done, size, len(data))
+        finally:
+            source.close()
+        self._progress(remote, done, size, complete=True)
+        return None
+    
+    def _tar_upload(self, batch):
+        """Uploads small files in one tar stream. Returns the (local, remote, size) tuples which have to be retried."""
+        try:
+            channel = self._exec('tar xpPf -') # -P: absolute member names are extracted as they are.
+        except (paramiko.SSHException, EnvironmentError):
+            return batch
+        try:
+            stream = channel.makefile('wb')
+            archive = tarfile.open(fileobj=stream, mode='w|')
+            for local, remote, size in batch:
+                info = archive.gettarinfo(local)
+                info.name = remote # gettarinfo(arcname=remote) would strip a leading slash.
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                with open(local, 'rb') as source: archive.addfile(info, source)
+            archive.close()
+            stream.flush()
+            channel.shutdown_write()
+            code = channel.recv_exit_status()
+        except (paramiko.SSHException, EnvironmentError):
+            code = -1
+        finally:
+            self.pool.release(channel)
+        if code: return batch # Let SFTP report what exactly is wrong.
+        for local, remote, size in batch: self._progress(local, size, size, size, complete=True)
+        return []
+    
+    def _tar_download(self, batch):
+        """Downloads small files in one tar stream. Returns the (remote, local, size) tuples to retry."""
+        wanted = dict((remote.lstrip('/'), (remote, local, size)) for remote, local, size in batch)
+        try:
+            # -h: archive what symlinks point to, download() checked the files they point to.
+            channel = self._exec('tar chf - ' + ' '.join(_quote(remote) for remote, local, size in batch))
+        except (paramiko.SSHException, EnvironmentError):
+            return batch
+        try:
+            archive = tarfile.open(fileobj=channel.makefile('rb'), mode='r|')
+            for member in archive:
+                # Only write the requested files, and only where they were requested to go.
+                if not member.isfile() or member.name not in wanted: continue
+                remote, local, size = wanted.pop(member.name)
+                with open(local, 'wb') as target:
+                    source = archive.extractfile(member)
+                    for data in iter(lambda: source.read(self.read_size), b''): target.write(data)
+                self._progress(remote, member.size, member.size, member.size, complete=True)
+            channel.recv_exit_status()
+        except (paramiko.SSHException, EnvironmentError, tarfile.TarError):
+            pass # Whatever is left in wanted is retried.
+        finally:
+            self.pool.release(channel)
+        return list(wanted.values())
+    
+    def upload(self, files):
+        """
+        Copies local files to the remote host. Remote directories must exist, except for small files (tar creates
+        them). Relative remote paths are relative to the user's home directory.
+        
+        Parameters
+        ----------
+        files : list or dict
+            (local path, remote path) tuples, or a dictionary of local path: remote path.
+        
+        Returns
+        -------
+        dict : Local path: error string, for every file which couldn't be copied.
+        """
+        errors = {}
+        small, large = [], []
+        for local, remote in (files.items() if isinstance(files, dict) else files):
+            try:
+                size = os.path.getsize(local)
+            except EnvironmentError as err:
+                errors[local] = str(err)
+                continue
+            (small if size < self.small_file_size else large).append((local, remote, size))
+        retry = []
+        workers = threading.Thread(target=lambda: errors.update(self._workers(large, self._put)))
+        workers.start() # Large files over SFTP while the small ones are packed.
+        if small: retry = self._tar_upload(small)
+        workers.join()
+        if retry: errors.update(self._workers(retry, self._put))
+        return errors
+    
+    def download(self, files):
+        """
+        Copies remote files to this host. Local directories must exist. Relative remote paths are relative to the
+        user's home directory.
+        
+        Parameters
+        ----------
+        files : list or dict
+            (remote path, local path) tuples, or a dictionary of remote path: local path.
+        
+        Returns
+        -------
+        dict : Remote path: error string, for every file which couldn't be copied.
+        """
+        errors = {}
+        files = list(files.items() if isinstance(files, dict) else files)
+        if not files: return errors
+        # Get the sizes with one listing per directory instead of one stat per file when there are several.
+        directories = collections.defaultdict(list)
+        for remote, local in files: directories[posixpath.dirname(remote)].append((remote, local))
+        small, large = [], []
+        try:
+            sftp = self._open_sftp()
+        except (paramiko.SSHException, EnvironmentError) as err:
+            return dict((remote, str(err) or err.__class__.__name__) for remote, local in files)
+        try:
+            for directory, entries in directories.items():
+                listing = {}
+                if len(entries) > 2:
+                    try: listing = dict((a.filename, a) for a in sftp.listdir_attr(directory or '.'))
+                    except IOError: pass # Fall back to stat, it reports the right error.
+                for remote, local in entries:
+                    try:
+                        attr = listing.get(posixpath.basename(remote))
+                        # sftp-server lists lstat() attributes, follow symlinks like stat() would.
+                        if attr is None or stat.S_ISLNK(attr.st_mode or 0): attr = sftp.stat(remote)
+                    except IOError as err:
+                        errors[remote] = str(err)
+                        continue
+                    if not stat.S_ISREG(attr.st_mode or 0):
+                        errors[remote] = 'Not a regular file'
+                        continue
+                    (small if attr.st_size < self.small_file_size else large).append((remote, local, attr.st_size))
+        finally:
+            self.pool.release(sftp.get_channel())
+        retry = []
+        workers = threading.Thread(target=lambda: errors.update(self._workers(large, self._get)))
+        workers.start()
+        while small:
+            batch, length = [], 0
+            while small and (not batch or length + len(small[-1][0]) + 3 <= self.max_batch_args):
+                batch.append(small.pop())
+                length += len(batch[-1][0]) + 3
+            retry.extend(self._tar_download(batch))
+        workers.join()
+        if retry: errors.update(self._workers(retry, self._get))
+        return errors
@@ -10,6 +10,7 @@ Convenience classes for CLI Python applications.
 robutils is a module providing a handful of convenient classes designed for use in command line python applications.
 It is designed for Python 2.7.3+ on Linux. Included are the following features:
     * Wrapper for executing external commands over SSH (paramiko) or locally (subprocess) with timeouts.
+    * Run large batches of external commands with a concurrency limit.
     * Enforce single instances using locking PID files.
     * Color text on Bash terminals, demonizing the main process, console redirects (for Altiris), logging, and email.
     * Centralizing exit messages for different exit codes. Also useful for Altiris.
@@ -24,6 +25,21 @@ For more information, documentation, and examples:
     * Visit https://github.com/Robpol86/robutils
     * import robutils; help(robutils)
     * import robutils.ExternalCmd; help(robutils.ExternalCmd)
+    * import robutils.AsyncExternalCmd; help(robutils.AsyncExternalCmd)
+    * import robutils.ExternalCmdPool; help(robutils.ExternalCmdPool)
+    * import robutils.Scheduler; help(robutils.Scheduler)
+    * import robutils.Pipeline; help(robutils.Pipeline)
+    * import robutils.Matcher; help(robutils.Matcher)
+    * import robutils.Spawn; help(robutils.Spawn)
+    * import robutils.Limits; help(robutils.Limits)
+    * import robutils.SSHPool; help(robutils.SSHPool)
+    * import robutils.KeyCache; help(robutils.KeyCache)
+    * import robutils.RemoteShell; help(robutils.RemoteShell)
+    * import robutils.Transfer; help(robutils.Transfer)
+    * import robutils.Capture; help(robutils.Capture)
+    * import robutils.Clock; help(robutils.Clock)
+    * import robutils.ResultCache; help(robutils.ResultCache)
+    * import robutils.ResultStore; help(robutils.ResultStore)
     * import robutils.Instance; help(robutils.Instance)
     * import robutils.Message; help(robutils.Message)
     * import robutils.Progress; help(robutils.Progress)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Fixtures shared by the regression tests."""
+
+
+import os, sys
+import pytest # http://pytest.org/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import sshd_stub
+
+
+@pytest.fixture(scope='session')
+def sshd():
+    """Starts benchmarks/sshd_stub.py's server on 127.0.0.1 with $HOME pointed at its known_hosts. Returns the port."""
+    home = os.environ.get('HOME')
+    port = sshd_stub.setup()
+    yield port
+    if home is not None: os.environ['HOME'] = home
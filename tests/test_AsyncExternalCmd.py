@@ -0,0 +1,53 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.AsyncExternalCmd. Run with: python -m pytest tests"""
+
+
+import asyncio, tracemalloc
+import pytest # http://pytest.org/
+from robutils.AsyncExternalCmd import AsyncExternalCmd
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_unread_output_is_not_buffered(loop):
+    cmd = AsyncExternalCmd('head -c 50000000 /dev/zero', tail_bytes=100, loop=loop)
+    tracemalloc.start()
+    try:
+        loop.run_until_complete(cmd.run_local())
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert (cmd.code, cmd.stdout_size, len(cmd.stdout)) == (0, 50000000, 100)
+    assert peak < 5000000
+
+
+def test_readline_and_read_chunk(loop):
+    cmd = AsyncExternalCmd('echo one; sleep 0.1; printf "two\\nthree"; echo err >&2', loop=loop)
+    async def consume():
+        done = cmd.run_local()
+        lines = [line async for line in cmd]
+        chunks = []
+        while True:
+            chunk = await cmd.read_chunk('stderr')
+            if not chunk: break
+            chunks.append(chunk)
+        await done
+        return lines, b''.join(chunks)
+    assert loop.run_until_complete(consume()) == ([b'one\n', b'two\n', b'three'], b'err\n')
+
+
+def test_positional_arguments_match_external_cmd(loop):
+    cmd = AsyncExternalCmd(['seq', '1', '1000'], 0, None, 0, 0, 3, loop=loop) # tail_lines=3
+    loop.run_until_complete(cmd.run_local())
+    assert (cmd.stdout, cmd._loop) == (b'998\n999\n1000\n', loop)
+    with pytest.raises(TypeError): AsyncExternalCmd('true', lop=loop)
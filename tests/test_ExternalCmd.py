@@ -0,0 +1,128 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.ExternalCmd. Run with: python -m pytest tests"""
+
+
+import time, getpass, subprocess
+import paramiko # https://github.com/paramiko/paramiko
+from robutils.ExternalCmd import ExternalCmd, Supervisor, Resources, as_completed, wait_any, wait_all
+from robutils.SSHPool import SSHPool
+from robutils.Capture import Capture
+
+
+def test_supervisor_survives_broken_command(monkeypatch):
+    def broken(self, pid): raise RuntimeError('broken sample')
+    monkeypatch.setattr(Resources, '_sample', broken)
+    bad = ExternalCmd('sleep 30')
+    good = ExternalCmd('sleep 0.2; echo ok')
+    bad.run_local(sample_interval=0.1)
+    good.run_local()
+    assert bad.wait(5)
+    assert bad.error == 'broken sample'
+    assert good.wait(5)
+    assert (good.code, good.stdout) == (0, b'ok\n')
+
+
+def test_supervisor_restarts_after_crash(monkeypatch):
+    def crash(self): raise RuntimeError('crash')
+    monkeypatch.setattr(Supervisor, '_loop', crash)
+    cmd = ExternalCmd('sleep 30')
+    cmd.run_local()
+    assert cmd.wait(5)
+    assert cmd.error == 'crash'
+    monkeypatch.undo()
+    cmd = ExternalCmd(['echo', 'ok'])
+    cmd.run_local()
+    assert cmd.wait(5)
+    assert (cmd.code, cmd.stdout) == (0, b'ok\n')
+
+
+def test_remote_stdout_while_running(sshd):
+    cmd = ExternalCmd('echo first; sleep 1; echo done')
+    cmd.run_remote('127.0.0.1', getpass.getuser(), port=sshd)
+    deadline = time.time() + 5
+    while cmd.stdout != b'first\n' and time.time() < deadline: time.sleep(0.01)
+    assert (cmd.code, cmd.stdout, cmd.stderr) == (None, b'first\n', b'')
+    assert cmd.wait(5)
+    assert (cmd.code, cmd.stdout) == (0, b'first\ndone\n')
+
+
+def test_remote_unexpected_exception(sshd, monkeypatch):
+    def broken(self, command): raise TypeError('broken exec')
+    monkeypatch.setattr(paramiko.Channel, 'exec_command', broken)
+    pool = SSHPool()
+    cmd = ExternalCmd('true')
+    cmd.run_remote('127.0.0.1', getpass.getuser(), port=sshd, pool=pool)
+    assert cmd.wait(5)
+    assert cmd.ssh_error == 'broken exec'
+    assert not pool._channels # Slot given back.
+    pool.close()
+
+
+def test_remote_default_user(sshd):
+    cmd = ExternalCmd(['echo', 'ok'])
+    cmd.run_remote('127.0.0.1', port=sshd)
+    assert cmd.wait(5)
+    assert (cmd.ssh_error, cmd.code, cmd.stdout) == (None, 0, b'ok\n')
+
+
+def _in_order(chunks, full):
+    """True if chunks are disjoint pieces of full, in order."""
+    position = 0
+    for chunk in chunks:
+        index = full.find(chunk, position)
+        if index < 0: return False
+        position = index + len(chunk)
+    return True
+
+
+def test_iter_chunks_tail_bytes():
+    full = b''.join(('{0}\n'.format(i)).encode('ascii') for i in range(1, 200001))
+    cmd = ExternalCmd(['seq', '1', '200000'], tail_bytes=100)
+    cmd.run_local()
+    chunks = list(cmd.iter_chunks())
+    assert cmd.wait(5)
+    assert sum(len(chunk) for chunk in chunks) <= len(full)
+    assert _in_order(chunks, full)
+    assert b''.join(chunks).endswith(cmd.stdout)
+
+
+def test_iter_chunks_spilled(monkeypatch):
+    monkeypatch.setattr(Capture, 'read_size', 1000)
+    full = b''.join(('{0}\n'.format(i)).encode('ascii') for i in range(1, 200001))
+    cmd = ExternalCmd(['seq', '1', '200000'], spill_threshold=10000)
+    cmd.run_local()
+    assert b''.join(cmd.iter_chunks()) == full
+    assert cmd.wait(5)
+    cmd.stdout.close()
+
+
+def test_local_without_preexec_fn(monkeypatch):
+    calls = []
+    popen = subprocess.Popen
+    def spy(*args, **kwargs):
+        calls.append(kwargs)
+        return popen(*args, **kwargs)
+    monkeypatch.setattr(subprocess, 'Popen', spy)
+    cmd = ExternalCmd('echo $(ps -o sid= -p $$); yes | head -1')
+    cmd.run_local()
+    assert cmd.wait(5)
+    assert 'preexec_fn' not in calls[0] # Keeps the vfork() fast path.
+    assert (cmd.code, cmd.stdout.split()) == (0, [str(cmd.pid).encode('ascii'), b'y'])
+
+
+def test_wait_any_removes_callbacks():
+    cmds = [ExternalCmd('sleep 30') for _ in range(3)]
+    for cmd in cmds: cmd.run_local()
+    for _ in range(100): assert wait_any(cmds, 0.001) is None
+    assert [len(cmd._done_callbacks) for cmd in cmds] == [0, 0, 0]
+    for cmd in cmds: Supervisor.terminate(cmd)
+    completed = as_completed(cmds, 5)
+    assert next(completed) in cmds
+    completed.close()
+    assert [len(cmd._done_callbacks) for cmd in cmds] == [0, 0, 0]
+    assert wait_all(cmds, 5)
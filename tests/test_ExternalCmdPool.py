@@ -0,0 +1,24 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.ExternalCmdPool. Run with: python -m pytest tests"""
+
+
+import getpass
+from robutils.ExternalCmd import ExternalCmd
+from robutils.ExternalCmdPool import FanOut
+
+
+def test_fan_out_errors_kept_apart(sshd, monkeypatch):
+    run_remote = ExternalCmd.run_remote
+    def broken(self, host, *args, **kwargs):
+        if host == 'localhost': raise TypeError('broken run_remote')
+        return run_remote(self, host, *args, **kwargs)
+    monkeypatch.setattr(ExternalCmd, 'run_remote', broken)
+    fan = FanOut(['true'], ['127.0.0.1', 'localhost'], user=getpass.getuser(), port=sshd)
+    fan.run()
+    assert fan.join(5)
+    assert (fan.codes, fan.ssh_errors, fan.errors) == ({0: 1}, {}, {'localhost': 'broken run_remote'})
@@ -0,0 +1,110 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.RemoteShell. Run with: python -m pytest tests"""
+
+
+import os, time, getpass, resource
+import pytest # http://pytest.org/
+from robutils.ExternalCmd import ExternalCmd
+from robutils.SSHPool import SSHPool
+from robutils.Matcher import Matcher
+from robutils.RemoteShell import RemoteShell
+
+
+class OneByteChannel:
+    """Stands in for a paramiko channel, receiving scripted output one byte at a time."""
+    
+    eof_received = False
+    closed = False
+    
+    def __init__(self, stdout, stderr):
+        self.in_buffer, self.in_stderr_buffer = bytearray(stdout), bytearray(stderr)
+        self._received = {'stdout':False, 'stderr':False} # Ready again only after one more recv_ready() call.
+        self._pipe = os.pipe()
+        os.write(self._pipe[1], b'x') # Always readable, like a channel with data waiting.
+    
+    def fileno(self):
+        return self._pipe[0]
+    
+    def _ready(self, stream, buf):
+        received, self._received[stream] = self._received[stream], False
+        return bool(buf) and not received
+    
+    def _recv(self, stream, buf):
+        self._received[stream] = True
+        data = bytes(buf[:1])
+        del buf[:1]
+        return data
+    
+    def recv_ready(self):
+        return self._ready('stdout', self.in_buffer)
+    
+    def recv_stderr_ready(self):
+        return self._ready('stderr', self.in_stderr_buffer)
+    
+    def recv(self, size):
+        return self._recv('stdout', self.in_buffer)
+    
+    def recv_stderr(self, size):
+        return self._recv('stderr', self.in_stderr_buffer)
+
+
+def test_sentinel_split_across_reads():
+    shell = RemoteShell('localhost', user='nobody')
+    shell._channel = OneByteChannel(b'out\0\nmore\0MAR\0MARK 3\n', b'err\0MARK\n')
+    chunks = []
+    cmd = ExternalCmd('true', on_output=lambda cmd, stream, data: chunks.append((stream, data)))
+    assert shell._collect(cmd, b'MARK', None) == 3
+    cmd._finish(3)
+    assert (cmd.stdout, cmd.stderr) == (b'out\0\nmore\0MAR', b'err')
+    assert (b'MARK' not in b''.join(d for s, d in chunks), len(chunks) > 10) == (True, True) # Fed as it arrived.
+
+
+def test_output_is_fed_while_running(sshd):
+    seen = []
+    with RemoteShell('127.0.0.1', getpass.getuser(), port=sshd) as shell:
+        cmd = ExternalCmd('echo first; sleep 0.5; echo second', on_output=lambda c, s, d: seen.append(time.time()))
+        shell.run(cmd)
+        assert (cmd.code, cmd.stdout) == (0, b'first\nsecond\n')
+        assert seen[0] < cmd.end_time - 0.3
+        cmd = shell.run(ExternalCmd('seq 1 200000', tail_bytes=100))
+        full = b''.join(('{0}\n'.format(i)).encode('ascii') for i in range(1, 200001))
+        assert (cmd.code, cmd.stdout_size, cmd.stdout) == (0, len(full), full[-100:])
+
+
+def test_matcher_terminates(sshd):
+    with RemoteShell('127.0.0.1', getpass.getuser(), port=sshd) as shell:
+        matcher = Matcher(r'^5000$', terminate=True)
+        cmd = shell.run(ExternalCmd('seq 1 100000000', matchers=[matcher]), timeout=30)
+        assert (cmd.code, cmd.stopped_by) == (-1, matcher)
+        assert cmd.end_time - cmd.start_time < 10
+        assert shell.run('echo ok').stdout == b'ok\n' # New shell.
+
+
+def test_high_fds(sshd):
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2048: pytest.skip('needs more than 2048 open files')
+    filler = [os.open(os.devnull, os.O_RDONLY) for _ in range(1100)] # Channel fds end up above FD_SETSIZE.
+    try:
+        with RemoteShell('127.0.0.1', getpass.getuser(), port=sshd) as shell: cmd = shell.run('echo ok', timeout=5)
+    finally:
+        for fd in filler: os.close(fd)
+    assert (cmd.ssh_error, cmd.code, cmd.stdout) == (None, 0, b'ok\n')
+
+
+def test_unexpected_exception(sshd, monkeypatch):
+    def broken(self, cmd, marker, deadline): raise ValueError('broken collect')
+    monkeypatch.setattr(RemoteShell, '_collect', broken)
+    pool = SSHPool()
+    shell = RemoteShell('127.0.0.1', getpass.getuser(), port=sshd, pool=pool)
+    cmd = shell.run('echo ok', timeout=5)
+    assert (cmd.ssh_error, cmd.code) == ('broken collect', None)
+    assert cmd.wait(0)
+    assert (shell._channel, pool._channels) == (None, {}) # Channel given back.
+    monkeypatch.undo()
+    assert shell.run('echo ok').stdout == b'ok\n' # New shell.
+    shell.close()
+    pool.close()
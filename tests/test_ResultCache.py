@@ -0,0 +1,25 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.ResultCache. Run with: python -m pytest tests"""
+
+
+import time
+from robutils.ResultCache import ResultCache
+
+
+def test_expiry_ignores_system_time(monkeypatch):
+    cache = ResultCache(ttl=60)
+    first = cache.run_local(['date', '+%N'])
+    assert first.wait(5)
+    monkeypatch.setattr(time, 'time', lambda: 4102444800.0) # System clock set to 2100.
+    assert cache.run_local(['date', '+%N']) is first
+    monkeypatch.undo()
+    cache = ResultCache(ttl=0.1)
+    first = cache.run_local(['date', '+%N'])
+    assert first.wait(5)
+    time.sleep(0.2)
+    assert cache.run_local(['date', '+%N']) is not first
@@ -0,0 +1,36 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.SSHPool. Run with: python -m pytest tests"""
+
+
+import time, getpass
+from robutils.ExternalCmd import ExternalCmd
+from robutils.SSHPool import SSHPool
+
+
+def test_evict_idle_connection(sshd):
+    pool = SSHPool(idle_timeout=0) # Evicted as soon as its channel is released.
+    for i in range(2):
+        cmd = ExternalCmd(['echo', 'ok'])
+        cmd.run_remote('127.0.0.1', getpass.getuser(), port=sshd, pool=pool)
+        assert cmd.wait(5)
+        assert (cmd.error, cmd.ssh_error, cmd.code, cmd.stdout) == (None, None, 0, b'ok\n')
+        assert not pool._pool
+    pool.close()
+
+
+def test_evict_ignores_clock_steps(sshd, monkeypatch):
+    pool = SSHPool(idle_timeout=60)
+    cmd = ExternalCmd(['echo', 'ok'])
+    cmd.run_remote('127.0.0.1', getpass.getuser(), port=sshd, pool=pool)
+    assert cmd.wait(5)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 3600) # System time set an hour ahead.
+    with pool._cond: assert pool._evict() == []
+    monkeypatch.undo()
+    assert pool._pool
+    pool.close()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.Scheduler. Run with: python -m pytest tests"""
+
+
+import time
+import pytest # http://pytest.org/
+from robutils.ExternalCmd import ExternalCmd
+from robutils.Scheduler import Scheduler
+
+
+@pytest.mark.parametrize('interval', [0, -1, float('nan')])
+def test_add_rejects_bad_interval(interval):
+    scheduler = Scheduler()
+    with pytest.raises(ValueError): scheduler.add('true', interval)
+    assert not scheduler.jobs
+
+
+def test_key_reaches_run_remote(monkeypatch):
+    keys, changes = [], []
+    def run_remote(self, host, user='', key=None, port=22, pool=None):
+        keys.append(key)
+        self.run_local()
+    monkeypatch.setattr(ExternalCmd, 'run_remote', run_remote)
+    scheduler = Scheduler()
+    job = scheduler.add(['echo', 'same'], 0.05, hosts=['host1'], key='~/.ssh/id_rsa',
+                        on_change=lambda host, cmd: changes.append(host))
+    scheduler.start()
+    deadline = time.time() + 5
+    while job.runs < 3 and time.time() < deadline: time.sleep(0.01)
+    assert scheduler.stop(timeout=5)
+    assert job.runs >= 3
+    assert set(keys) == set(['~/.ssh/id_rsa'])
+    assert changes == ['host1'] # Same output every run, only the first one is a change.
@@ -0,0 +1,69 @@
+#!/usr/bin/env python -u
+#
+# Copyright (c) 2012, Robpol86
+# This software is made available under the terms of the MIT License that can
+# be found in the LICENSE.txt file.
+#
+"""Regression tests for robutils.Transfer. Run with: python -m pytest tests"""
+
+
+import os, getpass
+from robutils.Transfer import Transfer
+
+
+def _upload(sshd, tmpdir):
+    local = str(tmpdir.join('big'))
+    with open(local, 'wb') as handle: handle.write(os.urandom(200000)) # Copied over SFTP, not tar.
+    transfer = Transfer('127.0.0.1', getpass.getuser(), port=sshd)
+    return local, transfer.upload({local: str(tmpdir.join('copy'))}), transfer
+
+
+def test_unexpected_open_error(sshd, tmpdir, monkeypatch):
+    def broken(self): raise TypeError('broken open')
+    monkeypatch.setattr(Transfer, '_open_sftp', broken)
+    local, errors, transfer = _upload(sshd, tmpdir)
+    assert errors == {local: 'broken open'}
+
+
+def test_unexpected_copy_error(sshd, tmpdir, monkeypatch):
+    def broken(self, sftp, local, remote, size): raise TypeError('broken put')
+    monkeypatch.setattr(Transfer, '_put', broken)
+    local, errors, transfer = _upload(sshd, tmpdir)
+    assert errors == {local: 'broken put'}
+    assert not transfer.pool._channels # Channel given back.
+    monkeypatch.undo()
+    local, errors, transfer = _upload(sshd, tmpdir)
+    assert errors == {}
+    assert open(local, 'rb').read() == open(str(tmpdir.join('copy')), 'rb').read()
+
+
+def test_download_batches_within_max_batch_args(sshd, tmpdir, monkeypatch):
+    files = {}
+    for i in range(20):
+        remote = str(tmpdir.join('f' * (1 if i == 0 else 40) + str(i))) # Only the first path is short.
+        with open(remote, 'wb') as handle: handle.write(b'data')
+        files[remote] = remote + '.copy'
+    batches = []
+    tar_download = Transfer._tar_download
+    def spy(self, batch):
+        batches.append(batch)
+        return tar_download(self, batch)
+    monkeypatch.setattr(Transfer, '_tar_download', spy)
+    transfer = Transfer('127.0.0.1', getpass.getuser(), port=sshd)
+    transfer.max_batch_args = 200
+    assert transfer.download(files) == {}
+    assert sorted(remote for batch in batches for remote, local, size in batch) == sorted(files)
+    for batch in batches:
+        assert len(batch) == 1 or sum(len(remote) + 3 for remote, local, size in batch) <= transfer.max_batch_args
+
+
+def test_download_symlinks_from_listing(sshd, tmpdir):
+    target = str(tmpdir.join('target'))
+    with open(target, 'wb') as handle: handle.write(b'data')
+    files = {}
+    for i in range(3): # More than 2 files in the directory, their attributes come from one listing.
+        remote = str(tmpdir.join('link{0}'.format(i)))
+        os.symlink(target, remote)
+        files[remote] = remote + '.copy'
+    assert Transfer('127.0.0.1', getpass.getuser(), port=sshd).download(files) == {}
+    for local in files.values(): assert open(local, 'rb').read() == b'data'